@@ -1,29 +1,21 @@
 from pathlib import Path
-from image_captioning_with_blip.metrics import (HuggingFaceEvaluator, load_ground_truth, load_predictions, huggingface_metrics)
+from image_captioning_with_blip.metrics import (BatchEvaluator, load_references, load_predictions, huggingface_metrics)
 import pandas as pd
 
 PREDICTIONS = Path("./captions.txt")
 REFERENCE = Path("./mastani/Frames.json")
 
 predictions = load_predictions(PREDICTIONS)
-ground_truths = load_ground_truth(REFERENCE)
+references = load_references(REFERENCE)
+filenames = [f for f in predictions if f in references]
 
-df = pd.DataFrame({
-    "predictions": predictions,
-    "ground_truths": ground_truths,
-})
-
-
-evaluator = HuggingFaceEvaluator("bleu", "bertscore")
-def evaluate(row):
-    pred = row["predictions"]
-    gt = row["ground_truths"]
-    return evaluator.evaluate(pred, gt)
-
-results: pd.DataFrame = df.apply(
-    evaluate,
-    axis=1,
-    result_type="expand",
+# Scores the whole prediction set at once (BERTScore in batches of 512)
+evaluator = BatchEvaluator("bleu", "bertscore", bertscore_cache=".cache/bertscore")
+scores, corpus = evaluator.evaluate(
+    [predictions[f] for f in filenames],
+    references.references(filenames),
 )
 
-results.to_csv("./bert_score.tsv", sep="\t", index=True)
\ No newline at end of file
+results = pd.DataFrame(scores, index=filenames)
+results.to_csv("./bert_score.tsv", sep="\t", index=True)
+print(pd.Series(corpus).to_string())
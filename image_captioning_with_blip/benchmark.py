@@ -0,0 +1,1086 @@
+import json
+import logging
+import math
+import platform
+import shutil
+import time
+from collections.abc import Callable, Sequence
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+import transformers
+from PIL import Image
+from torch import Tensor
+from torch.utils.data import BatchSampler, DataLoader, SequentialSampler
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import (  # type: ignore
+    Blip2Config,
+    Blip2ForConditionalGeneration,
+    Blip2Processor,
+    BlipImageProcessor,
+    GenerationConfig,
+    GPT2TokenizerFast,
+    Phi3Config,
+    Phi3ForCausalLM,
+    Phi4MultimodalConfig,
+    Phi4MultimodalFeatureExtractor,
+    Phi4MultimodalForCausalLM,
+    Phi4MultimodalImageProcessorFast,
+    Phi4MultimodalProcessor,
+)
+
+from .caption_cache import CaptionCache, dhash
+from .data import ImageFolderDataset, list_images
+from .instrumentation import Instrumentation
+from .metrics import BatchEvaluator
+from .models.base import Model
+from .models.blip2 import Blip2PL, ImageDataset
+from .models.phi4 import Phi4PL, PhiImageDataset
+from .models.phi4ensemble import PhiEnsemble, PhiEnsembleDataset
+from .models.phi4sam import Phi4Sam, PhiSamImageDataset
+from .prefix_cache import PrefixCache
+from .preprocessing import ProcessedImageDataset, pad_collate
+from .samplers import ShardedBatchSampler
+from .scheduler import ContinuousBatcher
+from .sinks import make_sink, pa, read_captions_file, shard_files
+
+logger = logging.getLogger(__name__)
+
+# Bump when the tiny checkpoints or the synthetic corpus change, so they are rebuilt
+BENCHMARK_VERSION = 2
+default_work_dir = Path(".cache/benchmark")
+default_baseline = Path("benchmarks/baseline.json")
+
+_special_tokens = [
+    "<|endoftext|>",
+    "<|system|>",
+    "<|user|>",
+    "<|assistant|>",
+    "<|end|>",
+    "<|image_1|>",
+    "<|audio_1|>",
+]
+_chat_template = (
+    "{% for message in messages %}<|{{ message['role'] }}|>"
+    "{{ message['content'] }}<|end|>{% endfor %}"
+    "{% if add_generation_prompt %}<|assistant|>{% endif %}"
+)
+_labels = [
+    "person",
+    "man",
+    "woman",
+    "child",
+    "car",
+    "chair",
+    "table",
+    "tree",
+    "building",
+    "dog",
+    "saree",
+    "window",
+    "door",
+    "lamp",
+]
+_image_sizes = [(854, 480), (640, 360), (1280, 720), (480, 640)]
+
+
+def _words() -> list[str]:
+    text = " ".join(
+        [
+            PhiImageDataset.prompt,
+            PhiSamImageDataset.prompt,
+            PhiEnsembleDataset.prompt,
+            Blip2PL.prompt,
+        ]
+        + _labels
+    )
+    return sorted(set(text.replace("\n", " ").split()))
+
+
+def tiny_tokenizer(image_token: bool = True) -> GPT2TokenizerFast:
+    """
+    Byte-level BPE tokenizer trained on the prompts of the models, with the Phi special
+    tokens and chat template, so that every prompt and caption can be encoded.
+    Args:
+        image_token (bool, optional): Declare `<|image_1|>` as the image token, as the Phi 4
+            multimodal processor needs. Blip2's processor adds its own. Defaults to True.
+    """
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(
+        [" ".join(_words())] * 4,
+        trainers.BpeTrainer(
+            vocab_size=512,
+            special_tokens=_special_tokens,
+            initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        ),
+    )
+    extra = (
+        {"image_token": "<|image_1|>", "audio_token": "<|audio_1|>"}
+        if image_token
+        else {}
+    )
+    return GPT2TokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<|endoftext|>",
+        eos_token="<|endoftext|>",
+        pad_token="<|endoftext|>",
+        unk_token="<|endoftext|>",
+        chat_template=_chat_template,
+        extra_special_tokens=extra,
+    )
+
+
+def _phi4_multimodal(folder: Path) -> None:
+    tokenizer = tiny_tokenizer()
+    processor = Phi4MultimodalProcessor(
+        Phi4MultimodalImageProcessorFast(dynamic_hd=2),
+        Phi4MultimodalFeatureExtractor(),
+        tokenizer,
+    )
+    end = tokenizer.convert_tokens_to_ids("<|end|>")
+    config = Phi4MultimodalConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=[tokenizer.eos_token_id, end],
+        pad_token_id=tokenizer.pad_token_id,
+        vision_config=dict(
+            hidden_size=32,
+            intermediate_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=2,
+            image_token_id=tokenizer.convert_tokens_to_ids("<|image_1|>"),
+        ),
+        audio_config=dict(
+            hidden_size=32,
+            intermediate_size=32,
+            num_blocks=1,
+            num_attention_heads=2,
+            ext_pw_out_channel=32,
+            depthwise_seperable_out_channel=32,
+            nemo_conv_channels=32,
+            audio_token_id=tokenizer.convert_tokens_to_ids("<|audio_1|>"),
+        ),
+    )
+    processor.save_pretrained(folder)
+    Phi4MultimodalForCausalLM(config).save_pretrained(folder)
+    GenerationConfig(
+        bos_token_id=config.bos_token_id,
+        eos_token_id=config.eos_token_id,
+        pad_token_id=config.pad_token_id,
+    ).save_pretrained(folder)
+
+
+def _phi4_mini(folder: Path) -> None:
+    tokenizer = tiny_tokenizer()
+    end = tokenizer.convert_tokens_to_ids("<|end|>")
+    config = Phi3Config(
+        vocab_size=len(tokenizer),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=[tokenizer.eos_token_id, end],
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    tokenizer.save_pretrained(folder)
+    Phi3ForCausalLM(config).save_pretrained(folder)
+    GenerationConfig(
+        bos_token_id=config.bos_token_id,
+        eos_token_id=config.eos_token_id,
+        pad_token_id=config.pad_token_id,
+    ).save_pretrained(folder)
+
+
+def _blip2(folder: Path) -> None:
+    processor = Blip2Processor(
+        BlipImageProcessor(size={"height": 64, "width": 64}),
+        tiny_tokenizer(image_token=False),
+        num_query_tokens=4,
+    )
+    tokenizer = (
+        processor.tokenizer
+    )  # with the image token added by the processor
+    config = Blip2Config(
+        vision_config=dict(
+            hidden_size=32,
+            intermediate_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=2,
+            image_size=64,
+            patch_size=16,
+        ),
+        qformer_config=dict(
+            vocab_size=len(tokenizer),
+            hidden_size=32,
+            intermediate_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=2,
+            encoder_hidden_size=32,
+        ),
+        text_config=dict(
+            model_type="t5",
+            vocab_size=len(tokenizer),
+            d_model=32,
+            d_kv=8,
+            d_ff=64,
+            num_layers=2,
+            num_heads=4,
+            decoder_start_token_id=tokenizer.pad_token_id,
+            pad_token_id=tokenizer.pad_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+        ),
+        num_query_tokens=4,
+        image_token_index=tokenizer.convert_tokens_to_ids("<image>"),
+    )
+    processor.save_pretrained(folder)
+    Blip2ForConditionalGeneration(config).save_pretrained(folder)
+    GenerationConfig(
+        decoder_start_token_id=tokenizer.pad_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    ).save_pretrained(folder)
+
+
+# Tiny randomly initialized stand-ins for the checkpoints of the models, by name
+CHECKPOINT_BUILDERS: dict[str, Callable[[Path], None]] = {
+    "phi4-multimodal": _phi4_multimodal,
+    "phi4-mini": _phi4_mini,
+    "blip2": _blip2,
+}
+
+
+def build_checkpoints(folder: str | Path, seed: int = 0) -> dict[str, Path]:
+    """
+    Save the tiny checkpoints of `CHECKPOINT_BUILDERS` in `folder` (those that do not exist
+    yet), so that the models and datasets load them with `from_pretrained` as usual.
+    Returns:
+        dict[str, Path]: Checkpoint directory by name.
+    """
+    checkpoints: dict[str, Path] = {}
+    for name, build in CHECKPOINT_BUILDERS.items():
+        checkpoint = Path(folder) / name
+        if not (checkpoint / "config.json").exists():
+            logger.info(f"Building tiny checkpoint {checkpoint}")
+            torch.manual_seed(seed)
+            build(checkpoint)
+        checkpoints[name] = checkpoint
+    return checkpoints
+
+
+def synthetic_corpus(
+    folder: str | Path, num_images: int, seed: int = 0
+) -> tuple[Path, Path]:
+    """
+    Write `num_images` JPEG frames of a few video resolutions and a SAM output file with
+    a random set of labelled boxes per frame, if they do not exist yet.
+    Returns:
+        tuple[Path, Path]: The image directory and the SAM output (.tsv) file.
+    """
+    folder = Path(folder)
+    images = folder / "frames"
+    sam_outputs = folder / "sam.tsv"
+    if sam_outputs.exists() and len(list(images.glob("*.jpg"))) == num_images:
+        return images, sam_outputs
+    shutil.rmtree(images, ignore_errors=True)
+    images.mkdir(parents=True)
+    rng = np.random.default_rng(seed)
+    rows = ["image\tdescriptor"]
+    for i in range(num_images):
+        w, h = _image_sizes[i % len(_image_sizes)]
+        # Smooth random colours with some noise compress like video frames, unlike white noise
+        coarse = rng.integers(0, 256, (h // 32, w // 32, 3), dtype=np.uint8)
+        image = Image.fromarray(coarse).resize(
+            (w, h), Image.Resampling.BILINEAR
+        )
+        noise = rng.integers(-8, 9, (h, w, 3))
+        image = Image.fromarray(
+            np.clip(np.asarray(image) + noise, 0, 255).astype(np.uint8)
+        )
+        filename = f"{1000 * (i + 1)}.jpg"
+        image.save(images / filename, quality=90)
+        objects = []
+        for _ in range(rng.integers(0, 16)):
+            x0, x1 = np.sort(rng.uniform(0, w, 2))
+            y0, y1 = np.sort(rng.uniform(0, h, 2))
+            objects.append(
+                {
+                    "label": str(rng.choice(_labels)),
+                    "rect_box": [float(x0), float(y0), float(x1), float(y1)],
+                    "score": float(rng.uniform(0.3, 1.0)),
+                }
+            )
+        rows.append(f"{filename}\t{json.dumps(objects)}")
+    sam_outputs.write_text("\n".join(rows) + "\n")
+    return images, sam_outputs
+
+
+def synthetic_captions(
+    folder: str | Path,
+    filenames: Sequence[str],
+    sources: int = 3,
+    words: int = 60,
+    seed: int = 0,
+) -> list[Path]:
+    """Write one caption file per source, with captions of random prompt words."""
+    rng = np.random.default_rng(seed)
+    vocabulary = _words()
+    files = []
+    for source in range(sources):
+        path = Path(folder) / f"captions_{source}.tsv"
+        path.unlink(missing_ok=True)
+        sink = make_sink("tsv", path)
+        sink.write(
+            filenames,
+            [
+                ". ".join(
+                    " ".join(rng.choice(vocabulary, 12))
+                    for _ in range(words // 12)
+                )
+                + "."
+                for _ in filenames
+            ],
+        )
+        sink.finalize()
+        files.append(path)
+    return files
+
+
+def _timed(fn: Callable[[], Any], repeat: int) -> float:
+    """Best time of `repeat` calls of `fn`, in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def _with_checkpoint(cls: type, checkpoint: Path) -> type:
+    """`cls` loading its processor/tokenizer from a local checkpoint instead of its own."""
+    return type(cls.__name__, (cls,), {"checkpoint": str(checkpoint)})
+
+
+def _batches(n: int, batch_size: int) -> list[list[int]]:
+    return [
+        list(range(i, min(i + batch_size, n))) for i in range(0, n, batch_size)
+    ]
+
+
+def benchmark_datasets(
+    datasets: dict[str, Callable[[Optional[Path]], Any]],
+    batch_size: int,
+    cache_dir: Path,
+    repeat: int = 3,
+) -> dict[str, dict[str, float]]:
+    """
+    Cost of the batches of each dataset: `__getitem__` without a cache and, for datasets
+    with one, building the cache, `__getitem__` from it and padding cached items on their
+    own (`pad_collate` or `PhiEnsembleDataset._pad`).
+    Args:
+        datasets (dict[str, Callable]): Dataset factories by name, called with the cache directory
+            (None for no cache).
+        batch_size (int): Images per batch.
+        cache_dir (Path): Root of the caches, emptied first.
+        repeat (int, optional): Runs of each measurement, the fastest is kept. Defaults to 3.
+    Returns:
+        dict[str, dict[str, float]]: Seconds per batch (`*_s`), and for the cache in total, by dataset.
+    """
+    results: dict[str, dict[str, float]] = {}
+    for name, make in datasets.items():
+        dataset = make(None)
+        batches = _batches(len(dataset), batch_size)
+        result = {
+            "getitem_s": _timed(lambda: [dataset[b] for b in batches], repeat)
+            / len(batches)
+        }
+        if isinstance(dataset, (ProcessedImageDataset, PhiEnsembleDataset)):
+            shutil.rmtree(cache_dir / name, ignore_errors=True)
+            cached = make(cache_dir / name)
+            if isinstance(cached, ProcessedImageDataset):
+                result["build_cache_s"] = _timed(cached.preprocess, 1)
+                cache = cached.cache
+                assert cache is not None
+                items = [
+                    [cache.get(cached.cache_key(i)) for i in b]
+                    for b in batches
+                ]
+                collate = lambda: [pad_collate(b) for b in items]
+            else:
+                result["build_cache_s"] = _timed(cached.precompute, 1)
+                collate = lambda: [cached._pad(b) for b in batches]
+            result["cached_getitem_s"] = _timed(
+                lambda: [cached[b] for b in batches], repeat
+            ) / len(batches)
+            result["collate_s"] = _timed(collate, repeat) / len(batches)
+        results[name] = result
+        logger.info(f"Dataset {name}: {result}")
+    return results
+
+
+def benchmark_model(
+    model: Model,
+    dataset: Any,
+    batch_size: int,
+    max_new_tokens: int,
+) -> dict[str, float]:
+    """
+    Caption every image of the dataset, with exactly `max_new_tokens` tokens per caption,
+    after one warm-up batch.
+    Returns:
+        dict[str, float]: Images and tokens per second, padding ratio, batch latency and the
+            mean time per batch of each `Instrumentation` stage.
+    """
+    model.max_new_tokens = max_new_tokens
+    generation_config = getattr(model, "generation_config", None)
+    if generation_config is None:  # Blip2 generates with the model's own
+        generation_config = model.model.generation_config
+        generation_config.max_new_tokens = max_new_tokens
+    generation_config.min_new_tokens = max_new_tokens
+    model.eval()
+    batches = _batches(len(dataset), batch_size)
+    with torch.no_grad():
+        model.predict_step(model.transfer(dataset[batches[0]]), 0)
+        model.instrumentation = Instrumentation()
+        for batch_idx, b in enumerate(batches):
+            model.instrumentation.start_batch()
+            model.predict_step(model.transfer(dataset[b]), batch_idx)
+            model.instrumentation.end_batch()
+    summary = model.instrumentation.summary()
+    result = {
+        "images_per_s": summary["totals"]["batch_size"] / summary["wall_time"]
+    }
+    result |= {
+        k: v for k, v in summary["throughput"].items() if k != "images_per_s"
+    }
+    result["batch_latency_p50_s"] = summary["batch_latency"]["p50"]
+    result |= {
+        f"{k.removeprefix('time/')}_s": v / summary["batches"]
+        for k, v in summary["totals"].items()
+        if k.startswith("time/") and k != "time/batch"
+    }
+    return result
+
+
+class _SaveBenchmark(Model):
+    name = "SaveBenchmark"
+    checkpoint = "none"
+
+
+def benchmark_save(
+    folder: Path, num_captions: int, batch_size: int, repeat: int = 3
+) -> dict[str, dict[str, float]]:
+    """
+    Cost of `Model._save` with each sink on its own, for captions of a typical length,
+    and of finalizing the output files.
+    Returns:
+        dict[str, dict[str, float]]: Captions per second and finalize time, by sink.
+    """
+    rng = np.random.default_rng(0)
+    vocabulary = _words()
+    filenames = [f"{i}.jpg" for i in range(num_captions)]
+    captions = [" ".join(rng.choice(vocabulary, 150)) for _ in filenames]
+    sinks = ["jsonl", "tsv"] + (["parquet"] if pa is not None else [])
+    results: dict[str, dict[str, float]] = {}
+    for sink in sinks:
+        save_s: list[float] = []
+        finalize_s: list[float] = []
+        for _ in range(repeat):
+            shutil.rmtree(folder, ignore_errors=True)
+            folder.mkdir(parents=True)
+            model = _SaveBenchmark(
+                out_file=folder / "captions.tsv", sinks=[sink]
+            )
+            start = time.perf_counter()
+            for i in range(0, num_captions, batch_size):
+                model._save(
+                    filenames[i : i + batch_size], captions[i : i + batch_size]
+                )
+            save_s.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            model.finalize_outputs()
+            finalize_s.append(time.perf_counter() - start)
+        results[sink] = {
+            "captions_per_s": num_captions / min(save_s),
+            "finalize_s": min(finalize_s),
+        }
+    return results
+
+
+def benchmark_evaluator(
+    num_captions: int, repeat: int = 3
+) -> dict[str, float]:
+    """Samples per second of `BatchEvaluator` for the n-gram metrics, with 3 references per sample."""
+    rng = np.random.default_rng(0)
+    vocabulary = _words()
+    sentence = lambda: " ".join(rng.choice(vocabulary, 40))
+    predictions = [sentence() for _ in range(num_captions)]
+    references = [[sentence() for _ in range(3)] for _ in range(num_captions)]
+    evaluator = BatchEvaluator("bleu", "sacrebleu", "rouge", "exact_match")
+    seconds = _timed(
+        lambda: evaluator.evaluate(predictions, references), repeat
+    )
+    return {"samples_per_s": num_captions / seconds}
+
+
+def run_benchmarks(
+    work_dir: str | Path = default_work_dir,
+    num_images: int = 16,
+    batch_size: int = 4,
+    max_new_tokens: int = 16,
+    repeat: int = 3,
+    seed: int = 0,
+) -> dict[str, Any]:
+    """
+    Benchmark the datasets, models, output sinks and evaluator on CPU, with tiny random
+    checkpoints (see `build_checkpoints`) and a synthetic corpus (see `synthetic_corpus`),
+    so that no checkpoint is downloaded. The numbers only compare runs of this benchmark
+    on the same machine, not the real models.
+    Args:
+        work_dir (str | Path, optional): Directory of the checkpoints, corpus and caches. Defaults to ".cache/benchmark".
+        num_images (int, optional): Images in the corpus. Defaults to 16.
+        batch_size (int, optional): Images per batch. Defaults to 4.
+        max_new_tokens (int, optional): Tokens generated per caption. Defaults to 16.
+        repeat (int, optional): Runs of the CPU-bound measurements, the fastest is kept. Defaults to 3.
+        seed (int, optional): Seed of the checkpoints and corpus. Defaults to 0.
+    Returns:
+        dict[str, Any]: The results, see `write_baseline`.
+    """
+    work_dir = Path(work_dir) / f"v{BENCHMARK_VERSION}"
+    checkpoints = build_checkpoints(work_dir / "checkpoints", seed)
+    images, sam_outputs = synthetic_corpus(
+        work_dir / "corpus", num_images, seed
+    )
+    filenames = sorted(p.name for p in images.glob("*.jpg"))
+    caption_files = synthetic_captions(
+        work_dir / "corpus", filenames, seed=seed
+    )
+    phi4 = checkpoints["phi4-multimodal"]
+    datasets: dict[str, Callable[[Optional[Path]], Any]] = {
+        "Blip2": lambda cache_dir: ImageDataset(images),
+        "Phi4": lambda cache_dir: _with_checkpoint(PhiImageDataset, phi4)(
+            images, cache_dir=cache_dir
+        ),
+        "Phi4Sam": lambda cache_dir: _with_checkpoint(
+            PhiSamImageDataset, phi4
+        )(images, sam_outputs, cache_dir=cache_dir),
+        "PhiEnsemble": lambda cache_dir: _with_checkpoint(
+            PhiEnsembleDataset, checkpoints["phi4-mini"]
+        )(caption_files, cache_dir=cache_dir),
+    }
+    out_dir = work_dir / "outputs"
+    shutil.rmtree(out_dir, ignore_errors=True)
+    out_dir.mkdir(parents=True)
+    native = {"attn_implementation": "sdpa"}
+    model_factories: dict[str, Callable[[], Model]] = {
+        "Blip2": lambda: Blip2PL(
+            out_file=out_dir / "blip2.tsv",
+            checkpoint=str(checkpoints["blip2"]),
+        ),
+        "Phi4": lambda: Phi4PL(
+            out_file=out_dir / "phi4.tsv", checkpoint=str(phi4), **native
+        ),
+        "Phi4Sam": lambda: Phi4Sam(
+            out_file=out_dir / "phi4sam.tsv", checkpoint=str(phi4), **native
+        ),
+        "PhiEnsemble": lambda: PhiEnsemble(
+            out_file=out_dir / "ensemble.tsv",
+            checkpoint=str(checkpoints["phi4-mini"]),
+            in_files=caption_files,
+        ),
+    }
+    results: dict[str, Any] = {
+        "version": BENCHMARK_VERSION,
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "machine": platform.machine(),
+            "threads": torch.get_num_threads(),
+        },
+        "config": {
+            "num_images": num_images,
+            "batch_size": batch_size,
+            "max_new_tokens": max_new_tokens,
+            "repeat": repeat,
+            "seed": seed,
+        },
+        "datasets": benchmark_datasets(
+            datasets, batch_size, work_dir / "cache", repeat
+        ),
+        "models": {},
+    }
+    for name, make_model in model_factories.items():
+        torch.manual_seed(seed)
+        model = make_model()
+        # The tiny checkpoints use the library's Phi 4 code, which names it `logits_to_keep`
+        if "num_logits_to_keep" in model.forward_kwargs:
+            model.forward_kwargs = {"logits_to_keep": 1}
+        results["models"][name] = benchmark_model(
+            model, datasets[name](None), batch_size, max_new_tokens
+        )
+        logger.info(f"Model {name}: {results['models'][name]}")
+    results["save"] = benchmark_save(
+        work_dir / "save", 64 * batch_size, batch_size, repeat
+    )
+    results["evaluator"] = benchmark_evaluator(512, repeat)
+    return results
+
+
+class _FilenameDataset(ImageFolderDataset):
+    def __getitem__(self, idx: list[int]) -> tuple[list[str], torch.Tensor]:
+        return self.get_filenames(idx), torch.zeros(len(idx))  # type: ignore
+
+
+class _EchoModel(Model):
+    """Captions every image with its file name, so that runs can be compared exactly."""
+
+    name = "Echo"
+    checkpoint = "none"
+    generation_config = GenerationConfig()
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.layer = torch.nn.Linear(1, 1)
+
+    def predict_step(self, batch: Any, batch_idx: int) -> list[str]:
+        filenames, _ = batch
+        captions = [f"A frame.\nIts file is {f}." for f in filenames]
+        self._save(filenames, captions)
+        return captions
+
+
+def _sharded_run(
+    folder: Path,
+    images: list[Path],
+    cached: Path,
+    devices: int,
+    batch_size: int,
+    sinks: Sequence[str],
+) -> Path:
+    """Caption `images` with `_EchoModel` on `devices` CPU processes, returns the output file."""
+    shutil.rmtree(folder, ignore_errors=True)
+    folder.mkdir(parents=True)
+    cache = CaptionCache(folder / "captions.sqlite", max_distance=0)
+    model = _EchoModel(
+        out_file=folder / "captions.tsv", sinks=sinks, caption_cache=cache
+    )
+    cache.put_many(model.cache_config(), [(dhash(cached), "From the cache.")])
+    skip = model.completed | model.apply_caption_cache(images)
+    dataset = _FilenameDataset(images, skip=skip)
+    model.set_output_order(dataset.filenames)
+    trainer = pl.Trainer(
+        accelerator="cpu",
+        devices=devices,
+        strategy="ddp_spawn" if devices > 1 else "auto",
+        use_distributed_sampler=False,
+        logger=False,
+        enable_progress_bar=False,
+        enable_model_summary=False,
+    )
+    trainer.predict(
+        model,
+        DataLoader(
+            dataset,
+            sampler=ShardedBatchSampler(
+                BatchSampler(SequentialSampler(dataset), batch_size, False)
+            ),
+            batch_size=None,
+        ),
+        return_predictions=False,
+    )
+    return model.out_file
+
+
+def check_sharded(
+    folder: str | Path,
+    num_images: int = 16,
+    batch_size: int = 2,
+    devices: int = 2,
+    seed: int = 0,
+) -> list[str]:
+    """
+    Caption the synthetic corpus (plus a copy of its first frame, and a frame found in the
+    caption cache) with `_EchoModel` on one process and on `devices` processes (gloo
+    backend), and compare the outputs: the ordered files (.tsv and .json) must be
+    identical and in image order, the others must have the same captions, and no shard
+    file may be left.
+    Returns:
+        list[str]: The differences found, empty if the outputs match.
+    """
+    folder = Path(folder)
+    corpus, _ = synthetic_corpus(folder / "corpus", num_images, seed)
+    images_dir = folder / "sharded" / "images"
+    shutil.rmtree(images_dir, ignore_errors=True)
+    images_dir.mkdir(parents=True)
+    for path in list_images(corpus):
+        shutil.copyfile(path, images_dir / path.name)
+    first = list_images(images_dir)[0]
+    shutil.copyfile(first, images_dir / f"{first.stem}_copy.jpg")
+    images = list_images(images_dir)
+    sinks = ["jsonl", "tsv"] + (["parquet"] if pa is not None else [])
+    outputs = [
+        _sharded_run(
+            folder / "sharded" / f"devices{n}",
+            images,
+            images[len(images) // 2],
+            n,
+            batch_size,
+            sinks,
+        )
+        for n in (1, devices)
+    ]
+    problems = []
+    expected = [p.name for p in images]
+    for suffix in (".tsv", ".json"):
+        single, sharded = (out.with_suffix(suffix) for out in outputs)
+        if single.read_bytes() != sharded.read_bytes():
+            problems.append(f"{sharded} differs from {single}")
+        names = [r["filename"] for r in read_captions_file(sharded)]
+        if names != expected:
+            problems.append(f"{sharded} is not in image order")
+    for kind in sinks:
+        suffix = make_sink(kind, outputs[0]).path.suffix
+        single, sharded = (
+            sorted(
+                (r["filename"], r["caption"])
+                for r in read_captions_file(out.with_suffix(suffix))
+            )
+            for out in outputs
+        )
+        if single != sharded:
+            problems.append(f"{suffix} captions differ")
+    if shard_files(outputs[1]):
+        problems.append(f"Shard files left: {shard_files(outputs[1])}")
+    return problems
+
+
+class _ModeLM(Phi3ForCausalLM):
+    """
+    Stand-in for the remote Phi-4-multimodal model, which reads `input_mode` on every
+    forward call to select its LoRA adapter: the mode is required and shifts the logits.
+    """
+
+    # The signature of the parent's forward, which `generate` inspects
+    def forward(
+        self,
+        input_ids: Optional[Tensor] = None,
+        attention_mask: Optional[Tensor] = None,
+        position_ids: Optional[Tensor] = None,
+        past_key_values: Any = None,
+        inputs_embeds: Optional[Tensor] = None,
+        use_cache: Optional[bool] = None,
+        cache_position: Optional[Tensor] = None,
+        logits_to_keep: int | Tensor = 0,
+        input_mode: Optional[Tensor] = None,
+        **kwargs,
+    ):
+        if input_mode is None:
+            raise ValueError("Forward call without input_mode")
+        out = super().forward(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            inputs_embeds=inputs_embeds,
+            use_cache=use_cache,
+            cache_position=cache_position,
+            logits_to_keep=logits_to_keep,
+            **kwargs,
+        )
+        generator = torch.Generator().manual_seed(int(input_mode[0]))
+        bias = torch.randn(out.logits.shape[-1], generator=generator)
+        out.logits = out.logits + 0.03 * bias.to(out.logits.device)
+        return out
+
+
+def _until_eos(tokens: Sequence[int], eos: set[int]) -> list[int]:
+    """`tokens` up to the first end-of-sequence token, included."""
+    tokens = list(tokens)
+    for i, token in enumerate(tokens):
+        if token in eos:
+            return tokens[: i + 1]
+    return tokens
+
+
+def check_decoding(
+    folder: str | Path,
+    num_prompts: int = 12,
+    batch_size: int = 4,
+    max_new_tokens: int = 16,
+    seed: int = 0,
+) -> list[str]:
+    """
+    Greedy decoding of prompts that share a long prefix with the tiny Phi-4 mini model
+    (as `_ModeLM`), compared token for token with `generate` on every prompt alone:
+    `PrefixCache.generate` on left-padded batches (the `[prefix][pads][suffix]`
+    rearrangement), and `ContinuousBatcher` with and without the prefix cache (eviction,
+    joining groups and the trimming of padding columns). Suffixes have different
+    lengths, and end-of-sequence tokens are picked so that sequences finish at
+    different steps.
+    Returns:
+        list[str]: The differences found, empty if every output matches.
+    """
+    checkpoint = build_checkpoints(Path(folder) / "checkpoints", seed)[
+        "phi4-mini"
+    ]
+    tokenizer = tiny_tokenizer()
+    torch.manual_seed(seed)
+    model = _ModeLM.from_pretrained(checkpoint).eval()
+    words = _words()
+    rng = np.random.default_rng(seed)
+    # The ensemble prompt up to the captions
+    prefix = "<|user|>" + PhiEnsembleDataset.prompt.split("{captions}")[0]
+    prompts = [
+        prefix
+        + " ".join(rng.choice(words, size=int(rng.integers(1, 12))))
+        + "<|end|><|assistant|>"
+        for _ in range(num_prompts)
+    ]
+    mode = torch.tensor([1])
+    pad_token_id = tokenizer.pad_token_id
+
+    def generate_alone(eos: list[int]) -> list[list[int]]:
+        outputs = []
+        for prompt in prompts:
+            inputs = tokenizer(prompt, return_tensors="pt")
+            out = model.generate(
+                **inputs,
+                input_mode=mode,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                eos_token_id=eos,
+                pad_token_id=pad_token_id,
+            )
+            outputs.append(out[0, inputs["input_ids"].shape[1] :].tolist())
+        return outputs
+
+    # End-of-sequence tokens taken from the outputs (but never among their first two
+    # tokens), so that sequences stop at different steps
+    first = generate_alone([])
+    early = {token for tokens in first for token in tokens[:2]}
+    eos = sorted(
+        {
+            tokens[min(3 + i % 10, len(tokens) - 1)]
+            for i, tokens in enumerate(first)
+        }
+        - early
+    )
+    expected = generate_alone(eos)
+    eos_set = set(eos)
+    lengths = sorted({len(tokens) for tokens in expected})
+    logger.info(f"Output lengths of the decoding check: {lengths}")
+
+    prefix_cache = PrefixCache.from_text(tokenizer, prefix)
+    problems = []
+    if not len(prefix_cache):
+        problems.append("PrefixCache found no shared prefix")
+    tokenizer.padding_side = "left"
+    for start in range(0, num_prompts, batch_size):
+        inputs = tokenizer(
+            prompts[start : start + batch_size],
+            return_tensors="pt",
+            padding=True,
+        )
+        out = prefix_cache.generate(
+            model,
+            inputs["input_ids"],
+            inputs["attention_mask"],
+            pad_token_id=pad_token_id,
+            prefix_inputs={"input_mode": mode},
+            input_mode=mode,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            eos_token_id=eos,
+        )
+        for i, tokens in enumerate(out.tolist(), start):
+            if _until_eos(tokens, eos_set) != expected[i]:
+                problems.append(f"PrefixCache.generate differs on prompt {i}")
+
+    requests = [
+        (i, {**tokenizer(p, return_tensors="pt"), "input_mode": mode})
+        for i, p in enumerate(prompts)
+    ]
+    for cache in (None, prefix_cache):
+        batcher = ContinuousBatcher(
+            model,
+            max_active=batch_size,
+            max_new_tokens=max_new_tokens,
+            eos_token_id=eos,
+            pad_token_id=pad_token_id,
+            prefix_cache=cache,
+            step_inputs=("input_mode",),
+        )
+        outputs = dict(batcher.run(requests))
+        label = "with" if cache is not None else "without"
+        for i, tokens in enumerate(expected):
+            if outputs.get(i) != tokens:
+                problems.append(
+                    f"ContinuousBatcher {label} the prefix cache differs on prompt {i}"
+                )
+    return problems
+
+
+def _round(value: Any, digits: int = 4) -> Any:
+    """Round floats to `digits` significant digits, so that the baseline diffs stay readable."""
+    if isinstance(value, dict):
+        return {k: _round(v, digits) for k, v in value.items()}
+    if isinstance(value, float) and value and math.isfinite(value):
+        return round(value, digits - 1 - math.floor(math.log10(abs(value))))
+    return value
+
+
+def write_baseline(results: dict[str, Any], path: str | Path) -> None:
+    """Write benchmark results as JSON, with sorted keys and rounded numbers."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(_round(results), f, indent=2, sort_keys=True)
+        f.write("\n")
+    logger.info(f"Wrote benchmark results to {path}")
+
+
+def _flatten(results: dict[str, Any], prefix: str = "") -> dict[str, float]:
+    flat: dict[str, float] = {}
+    for k, v in results.items():
+        if isinstance(v, dict):
+            flat |= _flatten(v, f"{prefix}{k}.")
+        elif isinstance(v, (int, float)):
+            flat[f"{prefix}{k}"] = v
+    return flat
+
+
+def compare(
+    baseline: dict[str, Any],
+    results: dict[str, Any],
+    tolerance: float = 0.2,
+    min_time: float = 1e-3,
+) -> list[str]:
+    """
+    Measurements that got worse than the baseline by more than `tolerance` (a fraction):
+    rates (`*_per_s`) that dropped and times (`*_s`) that grew. Times below `min_time`
+    seconds in both runs are too noisy to compare and are skipped.
+    """
+    old = {k: v for k, v in _flatten(baseline).items() if k.endswith("_s")}
+    new = _flatten(results)
+    regressions = []
+    for key, before in old.items():
+        after = new.get(key)
+        if after is None or not before:
+            continue
+        if not key.endswith("_per_s") and max(before, after) < min_time:
+            continue
+        change = after / before - 1
+        worse = -change if key.endswith("_per_s") else change
+        if worse > tolerance:
+            regressions.append(f"{key}: {before:.4g} -> {after:.4g}")
+    return regressions
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the captioning pipeline offline, with tiny random models on CPU."
+    )
+    parser.add_argument(
+        "--out",
+        type=Path,
+        default=default_baseline,
+        help="Results file (JSON). Defaults to benchmarks/baseline.json.",
+    )
+    parser.add_argument(
+        "--compare",
+        type=Path,
+        help="Baseline to compare with, exits with 1 if a measurement regressed.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative slowdown tolerated by --compare.",
+    )
+    parser.add_argument("--work-dir", type=Path, default=default_work_dir)
+    parser.add_argument("--images", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--max-new-tokens", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--check-sharded",
+        type=int,
+        metavar="DEVICES",
+        help="Only check that a run on DEVICES CPU processes (gloo) writes the same output as on one, "
+        "exits with 1 if not.",
+    )
+    parser.add_argument(
+        "--check-decoding",
+        action="store_true",
+        help="Only check that decoding with the prefix cache and continuous batching gives the same tokens "
+        "as generate on every prompt alone, exits with 1 if not.",
+    )
+    args = parser.parse_args()
+    if args.check_decoding:
+        problems = check_decoding(
+            args.work_dir / f"v{BENCHMARK_VERSION}",
+            batch_size=args.batch_size,
+            max_new_tokens=args.max_new_tokens,
+            seed=args.seed,
+        )
+        for line in problems:
+            print(f"Mismatch: {line}")
+        if problems:
+            raise SystemExit(1)
+        print("Prefix-cached and continuous-batching outputs match generate")
+        return
+    if args.check_sharded is not None:
+        problems = check_sharded(
+            args.work_dir / f"v{BENCHMARK_VERSION}",
+            num_images=args.images,
+            batch_size=args.batch_size,
+            devices=args.check_sharded,
+            seed=args.seed,
+        )
+        for line in problems:
+            print(f"Mismatch: {line}")
+        if problems:
+            raise SystemExit(1)
+        print(f"Outputs on {args.check_sharded} processes match one process")
+        return
+
+    baseline = (
+        json.loads(args.compare.read_text())
+        if args.compare is not None
+        else None
+    )
+    results = run_benchmarks(
+        args.work_dir,
+        num_images=args.images,
+        batch_size=args.batch_size,
+        max_new_tokens=args.max_new_tokens,
+        repeat=args.repeat,
+        seed=args.seed,
+    )
+    write_baseline(results, args.out)
+    print(json.dumps(_round(results), indent=2, sort_keys=True))
+    if baseline is not None:
+        regressions = compare(baseline, results, args.tolerance)
+        for line in regressions:
+            print(f"Regression: {line}")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+import logging
+from collections import Counter, defaultdict
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from .utils.array_store import ArrayStore, content_key
+
+logger = logging.getLogger(__name__)
+
+default_model_type = "roberta-large"  # what bert_score uses for lang="en"
+
+
+class CachedBERTScorer:
+    """
+    BERTScore with a persistent, content-addressed cache of token embeddings.
+
+    The embeddings, token ids and IDF weights of every caption are stored in an
+    `ArrayStore` keyed by a hash of the model and the (stripped) caption text, so
+    a caption is only sent through the encoder the first time it is scored.
+    Scores match `bert_score.score` (and the Hugging Face `bertscore` module) for
+    the same model, layer and idf setting.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str | Path = ".cache/bertscore",
+        model_type: str = default_model_type,
+        num_layers: Optional[int] = None,
+        batch_size: int = 512,
+        device: str | torch.device = "cpu",
+        idf: bool = False,
+    ):
+        """
+        Args:
+            cache_dir (str | Path, optional): Root directory of the embedding caches. Defaults to ".cache/bertscore".
+            model_type (str, optional): Encoder checkpoint. Defaults to "roberta-large".
+            num_layers (int, optional): Layer to take the embeddings from. Defaults to bert_score's choice for the model.
+            batch_size (int, optional): Batch size for encoding and scoring. Defaults to 512.
+            device (str | torch.device, optional): Device for the encoder. Defaults to "cpu".
+            idf (bool, optional): Weight tokens by their IDF over the references (computed from the
+                cached token ids, so it does not need new forward passes). Defaults to False.
+        """
+        from bert_score.utils import model2layers
+
+        self.model_type = model_type
+        self.num_layers = (
+            num_layers if num_layers is not None else model2layers[model_type]
+        )
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.idf = idf
+        self.model_id = f"{self.model_type}@L{self.num_layers}"
+        self.store = ArrayStore(
+            Path(cache_dir) / content_key(self.model_id)[:16]
+        )
+        self._model = None
+        self._tokenizer = None
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            from bert_score.utils import get_tokenizer
+
+            self._tokenizer = get_tokenizer(self.model_type, use_fast=False)
+        return self._tokenizer
+
+    @property
+    def model(self):
+        if self._model is None:
+            from bert_score.utils import get_model
+
+            self._model = get_model(self.model_type, self.num_layers).to(
+                self.device
+            )
+        return self._model
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        # bert_score strips sentences before tokenizing, nothing else changes the embedding
+        return text.strip()
+
+    def key(self, text: str) -> str:
+        return content_key(self.model_id, self.normalize(text))
+
+    def embed(self, texts: Sequence[str]) -> int:
+        """
+        Encode and cache the texts that are not cached yet.
+        Returns:
+            int: Number of texts that were encoded.
+        """
+        from bert_score.utils import bert_encode, collate_idf
+
+        missing: dict[str, str] = {}
+        for text in texts:
+            key = self.key(text)
+            if key not in self.store and key not in missing:
+                missing[key] = text
+        if not missing:
+            return 0
+        logger.info(
+            f"Encoding {len(missing)} new captions ({len(self.store)} cached)"
+        )
+        # Sort by length so that batches need little padding
+        items = sorted(
+            missing.items(), key=lambda kv: len(kv[1]), reverse=True
+        )
+        idf_dict = self._uniform_idf()
+        for start in range(0, len(items), self.batch_size):
+            batch = items[start : start + self.batch_size]
+            padded, padded_idf, lens, mask = collate_idf(
+                [text for _, text in batch],
+                self.tokenizer,
+                idf_dict,
+                device=self.device,
+            )
+            embeddings = bert_encode(self.model, padded, attention_mask=mask)
+            embeddings = embeddings.float().cpu().numpy()
+            padded = padded.cpu().numpy()
+            padded_idf = padded_idf.cpu().numpy()
+            self.store.put_many(
+                {
+                    key: {
+                        "embedding": embeddings[i, :length],
+                        "token_ids": padded[i, :length].astype(np.int32),
+                        "idf": padded_idf[i, :length].astype(np.float32),
+                    }
+                    for i, ((key, _), length) in enumerate(
+                        zip(batch, lens.tolist())
+                    )
+                }
+            )
+        return len(missing)
+
+    def _uniform_idf(self) -> defaultdict[int, float]:
+        idf_dict: defaultdict[int, float] = defaultdict(lambda: 1.0)
+        idf_dict[self.tokenizer.sep_token_id] = 0
+        idf_dict[self.tokenizer.cls_token_id] = 0
+        return idf_dict
+
+    def _corpus_idf(self, references: Sequence[str]) -> np.ndarray:
+        """IDF weights by token id over the references, as in `bert_score.utils.get_idf_dict`."""
+        counts = np.zeros(len(self.tokenizer), dtype=np.float64)
+        # bert_score counts every reference, including duplicates
+        for key, n in Counter(self.key(r) for r in references).items():
+            counts[np.unique(self.store.get(key)["token_ids"])] += n
+        num_docs = len(references)
+        idf = np.log((num_docs + 1) / (counts + 1))
+        idf[self.tokenizer.sep_token_id] = 0
+        idf[self.tokenizer.cls_token_id] = 0
+        return idf
+
+    def _load(
+        self, texts: Sequence[str], idf: Optional[np.ndarray]
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        embeddings, weights = [], []
+        for text in texts:
+            arrays = self.store.get(self.key(text))
+            embeddings.append(torch.from_numpy(np.array(arrays["embedding"])))
+            weights.append(
+                torch.from_numpy(
+                    idf[arrays["token_ids"]].astype(np.float32)
+                    if idf is not None
+                    else np.array(arrays["idf"])
+                )
+            )
+        lens = torch.tensor([e.shape[0] for e in embeddings])
+        mask = (torch.arange(int(lens.max()))[None, :] < lens[:, None]).long()
+        return (
+            pad_sequence(embeddings, batch_first=True, padding_value=2.0).to(
+                self.device
+            ),
+            mask.to(self.device),
+            pad_sequence(weights, batch_first=True).to(self.device),
+        )
+
+    def score(
+        self,
+        predictions: Sequence[str],
+        references: Sequence[str | Sequence[str]],
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        BERTScore of each prediction against its reference(s).
+        With several references per prediction, each score is the maximum over the
+        references, as in `bert_score.score`.
+        Returns:
+            tuple[np.ndarray, np.ndarray, np.ndarray]: Precision, recall and F1 per sample.
+        """
+        if all(isinstance(r, str) for r in references):
+            return self._score(predictions, references)  # type: ignore
+        groups = [[r] if isinstance(r, str) else list(r) for r in references]
+        P, R, F1 = self._score(
+            [p for p, refs in zip(predictions, groups) for _ in refs],
+            [r for refs in groups for r in refs],
+        )
+        if not len(F1):
+            return P, R, F1
+        starts = np.cumsum([0] + [len(refs) for refs in groups[:-1]])
+        return tuple(  # type: ignore
+            np.maximum.reduceat(s, starts) for s in (P, R, F1)
+        )
+
+    def _score(
+        self, predictions: Sequence[str], references: Sequence[str]
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        from bert_score.utils import greedy_cos_idf
+
+        self.embed(list(references) + list(predictions))
+        idf = self._corpus_idf(references) if self.idf else None
+        results = []
+        for start in range(0, len(predictions), self.batch_size):
+            refs = self._load(references[start : start + self.batch_size], idf)
+            hyps = self._load(
+                predictions[start : start + self.batch_size], idf
+            )
+            P, R, F1 = greedy_cos_idf(*refs, *hyps)
+            results.append(torch.stack((P, R, F1), dim=-1).cpu())
+        if not results:
+            empty = np.zeros(0, dtype=np.float32)
+            return empty, empty, empty
+        scores = torch.cat(results).numpy()
+        return scores[:, 0], scores[:, 1], scores[:, 2]
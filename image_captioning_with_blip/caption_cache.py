@@ -0,0 +1,387 @@
+import logging
+import os
+import sqlite3
+import threading
+from collections.abc import Collection, Iterable, Iterator, Mapping, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+default_cache_file = Path(".cache/captions.sqlite")
+# Host parameters per statement, SQLite's limit before 3.32
+_max_variables = 999
+
+
+def dhash(path: str | Path, size: int = 8) -> int:
+    """
+    Difference hash of an image: one bit per pair of horizontally adjacent pixels of a
+    `size + 1` by `size` grayscale thumbnail, set where brightness increases. Re-encoded
+    or slightly changed images (compression noise, subtitles fading in) differ in a few
+    bits, see `hamming`.
+    Args:
+        path (str | Path): Image file. JPEGs are decoded at reduced scale, which is much faster.
+        size (int, optional): Rows of the thumbnail, the hash has `size * size` bits. Defaults to 8 (64 bits).
+    Returns:
+        int: The hash, as an unsigned integer.
+    """
+    with Image.open(path) as img:
+        img.draft("L", (4 * (size + 1), 4 * size))
+        pixels = np.asarray(
+            img.convert("L").resize(
+                (size + 1, size), Image.Resampling.BILINEAR
+            ),
+            dtype=np.int16,
+        )
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming(a: int, b: int) -> int:
+    """Number of differing bits between two hashes."""
+    return (a ^ b).bit_count()
+
+
+class HashIndex:
+    """
+    Nearest-hash search within `max_distance` bits (multi-index hashing): hashes are split
+    into `max_distance + 1` bands, two hashes within `max_distance` bits agree on at least
+    one band, so a lookup only compares the hashes that share a band with it instead of
+    every stored hash.
+    """
+
+    def __init__(self, max_distance: int, bits: int = 64):
+        if not 0 <= max_distance < bits:
+            raise ValueError(f"max_distance must be in [0, {bits})")
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        self._bounds = [bits * i // bands for i in range(bands + 1)]
+        self._tables: list[dict[int, list[int]]] = [{} for _ in range(bands)]
+        self.hashes: list[int] = []
+
+    def _bands(self, h: int) -> Iterator[int]:
+        for lo, hi in zip(self._bounds, self._bounds[1:]):
+            yield (h >> lo) & ((1 << (hi - lo)) - 1)
+
+    def add(self, h: int) -> int:
+        """Add a hash, returns its position in `hashes`."""
+        i = len(self.hashes)
+        self.hashes.append(h)
+        for table, band in zip(self._tables, self._bands(h)):
+            table.setdefault(band, []).append(i)
+        return i
+
+    def nearest(self, h: int) -> Optional[int]:
+        """Position of the closest hash within `max_distance` (the first added on ties), None if there is none."""
+        candidates: set[int] = set()
+        for table, band in zip(self._tables, self._bands(h)):
+            candidates.update(table.get(band, ()))
+        best = min(
+            candidates,
+            key=lambda i: (hamming(self.hashes[i], h), i),
+            default=None,
+        )
+        if best is None or hamming(self.hashes[best], h) > self.max_distance:
+            return None
+        return best
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+
+def _signed(h: int) -> int:
+    # SQLite integers are signed 64-bit
+    return h - (1 << 64) if h >= 1 << 63 else h
+
+
+class CaptionCache:
+    """
+    Captions by perceptual hash of the image, in a SQLite file, so that repeated frames
+    (title cards, certification screens, held shots) are captioned once across runs.
+
+    Captions are stored per `config`, a key of everything else that decides the caption
+    (checkpoint, prompt, generation settings, see `Model.cache_config`). A lookup returns
+    the caption of the closest stored image within `max_distance` bits (Hamming distance
+    between `dhash`es), 0 only matches identical hashes. Image hashes are also stored, by
+    path, size and modification time, so images are only decoded once.
+    """
+
+    def __init__(
+        self,
+        path: str | Path = default_cache_file,
+        max_distance: int = 3,
+        workers: int = 8,
+    ):
+        """
+        Args:
+            path (str | Path, optional): SQLite file, created if missing. Defaults to ".cache/captions.sqlite".
+            max_distance (int, optional): Largest Hamming distance (of 64 bits) between the hashes of
+                images that share a caption. Defaults to 3.
+            workers (int, optional): Threads hashing images. Defaults to 8.
+        """
+        self.path = Path(path)
+        self.max_distance = max_distance
+        self.workers = workers
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._connect()
+        # Stored hashes and captions of each config, loaded on first lookup
+        self._index: dict[str, tuple[HashIndex, list[str]]] = {}
+
+    def _connect(self) -> None:
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS images (
+                path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, hash INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS captions (
+                config TEXT, hash INTEGER, caption TEXT, PRIMARY KEY (config, hash)
+            );
+            """)
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        # Pickled with the model for spawned processes, which open their own connection
+        state = self.__dict__.copy()
+        del state["_db"], state["_lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._connect()
+
+    def hashes(self, paths: Sequence[str | Path]) -> list[int]:
+        """`dhash` of every image, from the database when the file did not change."""
+        keys = []
+        for path in paths:
+            stat = os.stat(path)
+            keys.append(
+                (str(Path(path).resolve()), stat.st_mtime_ns, stat.st_size)
+            )
+        # Only the rows of the requested paths, the table keeps every image ever hashed
+        resolved = list(dict.fromkeys(path for path, _, _ in keys))
+        known: dict[tuple[str, int, int], int] = {}
+        with self._lock:
+            for start in range(0, len(resolved), _max_variables):
+                chunk = resolved[start : start + _max_variables]
+                known.update(
+                    ((p, m, s), h)
+                    for p, m, s, h in self._db.execute(
+                        "SELECT path, mtime_ns, size, hash FROM images"
+                        f" WHERE path IN ({', '.join('?' * len(chunk))})",
+                        chunk,
+                    )
+                )
+        missing = [i for i, key in enumerate(keys) if key not in known]
+        if missing:
+            logger.info(f"Hashing {len(missing)} images")
+            with ThreadPoolExecutor(self.workers) as pool:
+                computed = list(
+                    pool.map(dhash, [paths[i] for i in missing], chunksize=64)
+                )
+            with self._lock, self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)",
+                    [
+                        (*keys[i], _signed(h))
+                        for i, h in zip(missing, computed)
+                    ],
+                )
+            for i, h in zip(missing, computed):
+                known[keys[i]] = _signed(h)
+        return [known[key] % (1 << 64) for key in keys]
+
+    def _load(self, config: str) -> tuple[HashIndex, list[str]]:
+        if config not in self._index:
+            index = HashIndex(self.max_distance)
+            captions = []
+            for h, caption in self._db.execute(
+                "SELECT hash, caption FROM captions WHERE config = ?",
+                (config,),
+            ):
+                index.add(h % (1 << 64))
+                captions.append(caption)
+            self._index[config] = (index, captions)
+        return self._index[config]
+
+    def get(self, config: str, h: int) -> Optional[str]:
+        """Caption of the closest stored image within `max_distance`, None if there is none."""
+        with self._lock:
+            index, captions = self._load(config)
+            i = index.nearest(h)
+            return captions[i] if i is not None else None
+
+    def put_many(self, config: str, items: Iterable[tuple[int, str]]) -> None:
+        """Store captions by image hash."""
+        items = list(items)
+        if not items:
+            return
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO captions VALUES (?, ?, ?)",
+                [(config, _signed(h), caption) for h, caption in items],
+            )
+            if config in self._index:
+                index, captions = self._index[config]
+                for h, caption in items:
+                    index.add(h)
+                    captions.append(caption)
+
+    def close(self) -> None:
+        self._db.close()
+
+
+def group_duplicates(
+    hashes: Mapping[str, int], max_distance: int
+) -> dict[str, list[str]]:
+    """
+    Group images whose hashes are within `max_distance` bits of the first image of a group,
+    in order, so that only that image needs a caption.
+    Returns:
+        dict[str, list[str]]: The other images of each group, by its first image.
+    """
+    index = HashIndex(max_distance)
+    firsts: list[str] = []
+    groups: dict[str, list[str]] = {}
+    for filename, h in hashes.items():
+        i = index.nearest(h)
+        if i is not None:
+            groups[firsts[i]].append(filename)
+            continue
+        index.add(h)
+        firsts.append(filename)
+        groups[filename] = []
+    return groups
+
+
+class CaptionReuse:
+    """
+    Captions of a run that do not come from the model, see `Model.apply_caption_cache`:
+    the hits of a `CaptionCache`, the hashes of the images to caption (stored with their
+    captions) and the near-duplicates that get the caption of their group's first image.
+    Also keeps the order of the images it was given, see `order`.
+    """
+
+    def __init__(self, cache: Optional[CaptionCache] = None):
+        """
+        Args:
+            cache (CaptionCache, optional): Captions of earlier runs. Without it, only the order
+                of the images is kept. Defaults to None.
+        """
+        self.cache = cache
+        # `Model.cache_config` of the run
+        self.config = ""
+        self.image_hashes: dict[str, int] = {}
+        self.duplicates: dict[str, list[str]] = {}
+        # Cache hits, until `take_hits`
+        self.hits: dict[str, str] = {}
+        # Every image given to `apply`, skipped ones included
+        self.image_order: list[str] = []
+
+    def apply(
+        self,
+        paths: Sequence[Path],
+        completed: Collection[str] = (),
+        config: Optional[str] = None,
+    ) -> set[str]:
+        """
+        Look up the images in the cache and group the others by near-duplicates.
+        Args:
+            paths (Sequence[Path]): The images of the dataset, in order.
+            completed (Collection[str], optional): Filenames captioned by an earlier run, left out. Defaults to ().
+            config (str, optional): `Model.cache_config`, needed with a cache. Defaults to None.
+        Returns:
+            set[str]: Filenames the model does not need to caption.
+        """
+        self.image_order = [p.name for p in paths]
+        if self.cache is None:
+            return set()
+        assert config is not None
+        self.config = config
+        paths = [p for p in paths if p.name not in completed]
+        hashes = dict(zip((p.name for p in paths), self.cache.hashes(paths)))
+        hits: dict[str, str] = {}
+        for filename, h in hashes.items():
+            caption = self.cache.get(config, h)
+            if caption is not None:
+                hits[filename] = caption
+        self.duplicates = group_duplicates(
+            {f: h for f, h in hashes.items() if f not in hits},
+            self.cache.max_distance,
+        )
+        self.image_hashes = {f: hashes[f] for f in self.duplicates}
+        skip = set(hits) | {
+            f for duplicates in self.duplicates.values() for f in duplicates
+        }
+        logger.info(
+            f"Caption cache: {len(hits)} of {len(paths)} images cached, "
+            f"{len(skip) - len(hits)} near-duplicates, {len(self.duplicates)} to caption"
+        )
+        self.hits = hits
+        return skip
+
+    def take_hits(self) -> dict[str, str]:
+        """The captions found in the cache by `apply`, returned once."""
+        hits, self.hits = self.hits, {}
+        return hits
+
+    def add(
+        self, filenames: list[str], captions: list[str]
+    ) -> tuple[list[str], list[str]]:
+        """
+        Store new captions in the cache.
+        Returns:
+            tuple[list[str], list[str]]: The filenames and captions, followed by the
+                near-duplicates of their images with the same captions.
+        """
+        if not self.image_hashes:
+            return filenames, captions
+        assert self.cache is not None
+        self.cache.put_many(
+            self.config,
+            (
+                (self.image_hashes[f], c)
+                for f, c in zip(filenames, captions)
+                if f in self.image_hashes
+            ),
+        )
+        all_filenames, all_captions = list(filenames), list(captions)
+        for f, c in zip(filenames, captions):
+            duplicates = self.duplicates.pop(f, [])
+            all_filenames += duplicates
+            all_captions += [c] * len(duplicates)
+        return all_filenames, all_captions
+
+    def order(
+        self,
+        output_order: Optional[Mapping[str, int]],
+        completed: Collection[str] = (),
+    ) -> Optional[dict[str, int]]:
+        """
+        Position of every filename that can be written, None without `output_order`.
+        Images left out of `output_order` (cache hits and near-duplicates) follow the
+        image before them in the images given to `apply`, and `completed` filenames
+        not among them come first.
+        Args:
+            output_order (Mapping[str, int], optional): Position of the filenames of the dataset.
+            completed (Collection[str], optional): Filenames captioned by an earlier run. Defaults to ().
+        """
+        if output_order is None:
+            return None
+        keys = {name: (i, 0) for name, i in output_order.items()}
+        anchor, offset = -1, 0
+        for name in self.image_order:
+            if name in output_order:
+                anchor, offset = output_order[name], 0
+            elif name not in keys:
+                offset += 1
+                keys[name] = (anchor, offset)
+        for offset, name in enumerate(sorted(set(completed) - keys.keys())):
+            keys[name] = (-2, offset)
+        return {
+            name: i
+            for i, name in enumerate(sorted(keys, key=keys.__getitem__))
+        }
@@ -0,0 +1,94 @@
+import logging
+import os
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+
+from .sinks import pa, read_captions_file
+from .utils.array_store import content_key
+
+logger = logging.getLogger(__name__)
+
+default_cache_dir = Path(".cache/captions")
+
+
+def read_captions(
+    path: str | Path, cache_dir: Optional[str | Path] = default_cache_dir
+) -> pd.DataFrame:
+    """
+    Read a caption file of any supported format (see `sinks.read_captions_file`)
+    into a table with a "caption" column, indexed by "filename".
+
+    Parsed tables are cached as Feather files in `cache_dir`, keyed by the file's
+    path, size and modification time, and in memory for the rest of the process (only
+    the latest version of each file), so repeated loads of the same outputs skip parsing
+    entirely.
+    If an image was captioned more than once (e.g. a resumed run), the last caption is kept.
+    Args:
+        path (str | Path): Path to the caption file.
+        cache_dir (str | Path, optional): Directory of the cached tables, None to disable
+            the on-disk cache. Defaults to ".cache/captions". Requires pyarrow.
+    Returns:
+        pd.DataFrame: The captions, in file order. Do not modify it in place, it is shared.
+    """
+    path = Path(path)
+    stat = os.stat(path)
+    resolved = str(path.resolve())
+    key = content_key(resolved, str(stat.st_mtime_ns), str(stat.st_size))
+    if resolved in _loaded and _loaded[resolved][0] == key:
+        return _loaded[resolved][1]
+    cache_file = (
+        Path(cache_dir) / f"{key}.feather"
+        if cache_dir is not None and pa is not None
+        else None
+    )
+    df = None
+    if cache_file is not None and cache_file.exists():
+        try:
+            df = pd.read_feather(cache_file).set_index("filename")
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable cache {cache_file}: {e}")
+    if df is None:
+        df = pd.DataFrame.from_records(
+            read_captions_file(path), columns=["filename", "caption"]
+        )
+        df = df.drop_duplicates("filename", keep="last").set_index("filename")
+        if cache_file is not None:
+            _save(df, cache_file)
+    # An output file that grew since the last load replaces its old table
+    _loaded[resolved] = (key, df)
+    return df
+
+
+def _save(df: pd.DataFrame, cache_file: Path) -> None:
+    # Write to a temporary file first, so a crash cannot leave a half-written cache
+    tmp = cache_file.with_name(f".{cache_file.name}.tmp")
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        df.reset_index().to_feather(tmp)
+        os.replace(tmp, cache_file)
+    except OSError as e:
+        logger.warning(f"Could not cache the captions in {cache_file}: {e}")
+
+
+def caption_table(
+    files: Mapping[str, str | Path],
+    cache_dir: Optional[str | Path] = default_cache_dir,
+) -> pd.DataFrame:
+    """
+    Captions of several files side by side, one column per name in `files`, indexed
+    by filename (missing captions are NaN).
+    """
+    return pd.concat(
+        {
+            name: read_captions(file, cache_dir)["caption"]
+            for name, file in files.items()
+        },
+        axis=1,
+    ).sort_index()
+
+
+# Resolved path of every loaded file -> (key of the version read, table)
+_loaded: dict[str, tuple[str, pd.DataFrame]] = {}
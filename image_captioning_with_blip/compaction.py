@@ -0,0 +1,111 @@
+import re
+from collections.abc import Sequence
+from typing import Any, Optional
+
+_sentence_end = re.compile(r"(?<=[.!?])\s+|\s*\n+\s*")
+_word = re.compile(r"\w+")
+
+
+def split_sentences(text: str) -> list[str]:
+    """Sentences (and lines) of a caption, without empty ones."""
+    return [s.strip() for s in _sentence_end.split(text) if s.strip()]
+
+
+def shingles(sentence: str, n: int = 3) -> frozenset[tuple[str, ...]]:
+    """Lower case word n-grams of a sentence (single words if it is shorter than `n`)."""
+    words = _word.findall(sentence.lower())
+    if len(words) < n:
+        return frozenset((w,) for w in words)
+    return frozenset(
+        tuple(words[i : i + n]) for i in range(len(words) - n + 1)
+    )
+
+
+def jaccard(a: frozenset, b: frozenset) -> float:
+    if not a or not b:
+        return float(a == b)
+    return len(a & b) / len(a | b)
+
+
+class _Sentence:
+    def __init__(self, source: int, index: int, text: str, grams: frozenset):
+        self.source = source
+        self.index = index
+        self.text = text
+        self.grams = grams
+        self.also: list[int] = []  # other sources with a near-duplicate
+
+    def render(self) -> str:
+        if not self.also:
+            return self.text
+        plural = "s" if len(self.also) > 1 else ""
+        return f"{self.text} (also in caption{plural} {', '.join(map(str, self.also))})"
+
+
+def compact_captions(
+    captions: Sequence[str],
+    tokenizer: Any = None,
+    max_tokens: Optional[int] = None,
+    threshold: float = 0.6,
+) -> list[str]:
+    """
+    Shorten the captions of one image from several sources before they go into a prompt.
+
+    Captions are split into sentences. A sentence that is a near-duplicate (word 3-gram
+    Jaccard similarity of at least `threshold`) of an earlier one is dropped; if it came
+    from another source, the kept sentence is marked "(also in caption N)", so agreement
+    between captions is still visible. The remaining sentences are then fitted to
+    `max_tokens`: sentences supported by the most sources first, then the earliest
+    sentences of every source in turn. A source stops at its first sentence that does not
+    fit, so captions are never cut mid-sentence.
+    Args:
+        captions (Sequence[str]): Caption of each source, numbered from 0 in the prompt.
+        tokenizer (optional): Tokenizer used to count tokens. Defaults to None (words are counted).
+        max_tokens (int, optional): Budget for the sentences of all sources (markers not included).
+            Defaults to None (no budget).
+        threshold (float, optional): Similarity above which sentences are near-duplicates. Defaults to 0.6.
+    Returns:
+        list[str]: The compacted caption of each source, in order (possibly empty).
+    """
+    kept: list[_Sentence] = []
+    for source, caption in enumerate(captions):
+        for index, text in enumerate(split_sentences(caption)):
+            grams = shingles(text)
+            duplicate = next(
+                (s for s in kept if jaccard(s.grams, grams) >= threshold),
+                None,
+            )
+            if duplicate is None:
+                kept.append(_Sentence(source, index, text, grams))
+            elif duplicate.source != source and source not in duplicate.also:
+                duplicate.also.append(source)
+    if max_tokens is not None and kept:
+        if tokenizer is not None:
+            lengths = [
+                len(ids)
+                for ids in tokenizer(
+                    [s.text for s in kept], add_special_tokens=False
+                )["input_ids"]
+            ]
+        else:
+            lengths = [len(s.text.split()) for s in kept]
+        order = sorted(
+            range(len(kept)),
+            key=lambda i: (-len(kept[i].also), kept[i].index, kept[i].source),
+        )
+        budget = max_tokens
+        selected: set[int] = set()
+        stopped: set[int] = set()
+        for i in order:
+            if kept[i].source in stopped:
+                continue
+            if lengths[i] > budget:
+                stopped.add(kept[i].source)
+                continue
+            budget -= lengths[i]
+            selected.add(i)
+        kept = [s for i, s in enumerate(kept) if i in selected]
+    compacted: list[list[str]] = [[] for _ in captions]
+    for sentence in kept:
+        compacted[sentence.source].append(sentence.render())
+    return [" ".join(sentences) for sentences in compacted]
@@ -1,4 +1,11 @@
+import csv
+import logging
+import os
+import shutil
 from pathlib import Path
+from collections.abc import Collection, Mapping, Sequence
+from typing import Literal, Optional
+import numpy as np
 from torch.utils.data import DataLoader, Dataset
 from torch import Tensor, nn
 from torchvision import transforms
@@ -6,15 +13,39 @@ from transformers.models.blip_2 import Blip2Processor
 from PIL import Image
 import pytorch_lightning as pl
 
+from .frame_selection import frame_signatures, select_frames, shot_boundaries
+
+logger = logging.getLogger(__name__)
+
 
 def split_dataset(
     input_data_folder: str | Path,
     split_size: int | float,
     output_data_folder: str | Path,
     overwrite: bool = False,
-):
+    method: Literal["scenes", "uniform"] = "scenes",
+    output: Literal["hardlink", "manifest", "copy"] = "hardlink",
+    workers: Optional[int] = None,
+    threshold: Optional[float] = None,
+) -> list[Path]:
     """
-    Split a dataset into training and validation sets.
+    Select a subset of the frames of a film to caption.
+    Args:
+        input_data_folder (str | Path): Folder of frames named by frame time (`<time>.jpg`).
+        split_size (int | float): Number of frames, or fraction of the frames if less than 1.
+        output_data_folder (str | Path): Existing folder the subset is written to.
+        overwrite (bool, optional): Replace existing files. Defaults to False.
+        method (str, optional): "scenes" detects shot boundaries from image signatures and picks
+            representative frames of every shot (see `frame_selection.select_frames`), "uniform" picks
+            evenly spaced frames. Defaults to "scenes".
+        output (str, optional): "hardlink" links the frames into the folder (copied if linking fails,
+            e.g. across file systems), "manifest" only writes their paths to `frames.tsv` in the folder
+            (with the shot of each frame, usable as an `ImageSource`), "copy" copies them. Defaults to "hardlink".
+        workers (int, optional): Processes computing the image signatures. Defaults to None (the number of CPUs).
+        threshold (float, optional): Shot boundary threshold, see `frame_selection.shot_boundaries`.
+            Defaults to None (adaptive).
+    Returns:
+        list[Path]: The selected frames, in order.
     """
     input_data_folder = Path(input_data_folder)
     output_data_folder = Path(output_data_folder)
@@ -28,36 +59,211 @@ def split_dataset(
         split_size = round(len(files) * split_size)
     if isinstance(split_size, float):
         raise ValueError("split_size must not be a float if greater than 1.")
-    indices = [round(i * len(files) / split_size) for i in range(split_size)]
-    for i in indices:
-        out_file = output_data_folder / files[i].name
-        if out_file.exists() and not overwrite:
-            raise ValueError(f"File {out_file} already exists.")
-        (out_file).write_bytes(files[i].read_bytes())
-
-
-class ImageDataset(Dataset):
-    def __init__(self, images: dict[str, Image.Image]):
-        filenames, _images = zip(*images.items())
-        self.filenames: list[str] = list(filenames)
-        self.images: list[Tensor] = [
-            transforms.ToTensor()(img) for img in _images
+    shot_of = np.zeros(len(files), dtype=np.int64)
+    if method == "uniform":
+        indices = [
+            round(i * len(files) / split_size) for i in range(split_size)
         ]
+    elif method == "scenes":
+        signatures = frame_signatures(files, workers)
+        shots = shot_boundaries(signatures, threshold)
+        shot_of = np.searchsorted(shots, np.arange(len(files)), "right") - 1
+        indices = select_frames(signatures, shots, split_size).tolist()
+        logger.info(
+            f"Selected {len(indices)} of {len(files)} frames from {len(shots)} shots"
+        )
+    else:
+        raise ValueError(f"Unknown method {method}.")
+    selected = [files[i] for i in indices]
+    if output == "manifest":
+        manifest = output_data_folder / "frames.tsv"
+        if manifest.exists() and not overwrite:
+            raise ValueError(f"File {manifest} already exists.")
+        with open(manifest, "w", newline="") as f:
+            f.write("# path\tshot\n")
+            writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+            for i in indices:
+                writer.writerow([files[i].resolve(), shot_of[i]])
+        return selected
+    if output not in ("hardlink", "copy"):
+        raise ValueError(f"Unknown output {output}.")
+    for file in selected:
+        out_file = output_data_folder / file.name
+        if out_file.exists():
+            if not overwrite:
+                raise ValueError(f"File {out_file} already exists.")
+            if out_file.samefile(file):
+                continue
+            out_file.unlink()
+        if output == "hardlink":
+            try:
+                os.link(file, out_file)
+                continue
+            except OSError as e:
+                logger.warning(f"Could not link {file}, copying it: {e}")
+        shutil.copyfile(file, out_file)
+    return selected
+
+
+type ImageSource = (
+    str | Path | Sequence[str | Path] | Mapping[str, Image.Image]
+)
+
+
+def list_images(images: ImageSource, pattern: str = "*.jpg") -> list[Path]:
+    """
+    Resolve an image source to a list of file paths, without decoding any image.
+    Args:
+        images (ImageSource): One of
+            - a directory, searched with `pattern`,
+            - a manifest file with one image path per line (the first column is used, columns are read with
+              `csv`, comma separated in .csv files and tab separated otherwise; relative paths are relative to
+              the manifest, empty lines and lines starting with # are skipped),
+            - a sequence of image paths,
+            - a dictionary of filenames and images opened with `Image.open` (only their paths are kept).
+        pattern (str, optional): Glob pattern used for directories. Defaults to "*.jpg".
+    Returns:
+        list[Path]: The image paths, sorted by name for directories, in the given order otherwise.
+    """
+    if isinstance(images, Mapping):
+        paths = []
+        for name, img in images.items():
+            if not getattr(img, "filename", None):
+                raise ValueError(
+                    f"Image {name} was not opened from a file, pass file paths instead."
+                )
+            paths.append(Path(img.filename))  # type: ignore
+        return paths
+    if isinstance(images, (str, Path)):
+        images = Path(images)
+        if images.is_dir():
+            return sorted(images.glob(pattern))
+        if images.is_file():
+            paths = []
+            delimiter = "," if images.suffix == ".csv" else "\t"
+            with open(images, "r", newline="") as f:
+                lines = (
+                    line
+                    for line in f
+                    if line.strip() and not line.startswith("#")
+                )
+                for row in csv.reader(lines, delimiter=delimiter):
+                    path = Path(row[0].strip())
+                    paths.append(
+                        path if path.is_absolute() else images.parent / path
+                    )
+            return paths
+        raise ValueError(f"{images} is neither a directory nor a manifest file.")
+    return [Path(p) for p in images]
+
+
+def image_size(path: str | Path) -> tuple[int, int]:
+    """Read the (width, height) of an image from its header, without decoding the pixels."""
+    with Image.open(path) as img:
+        return img.size
+
+
+class ImageFolderDataset(Dataset):
+    """
+    Base class for the image datasets. Only the file paths are kept, images are
+    decoded in `__getitem__`, i.e. in the DataLoader workers, so memory use in the
+    main process does not depend on the size of the corpus.
+    """
+
+    def __init__(
+        self,
+        images: ImageSource,
+        skip: Optional[Collection[str]] = None,
+        pattern: str = "*.jpg",
+    ):
+        """
+        Args:
+            images (ImageSource): Directory, manifest file or list of image paths, see `list_images`.
+            skip (Collection[str], optional): Filenames to leave out, e.g. `Model.completed` when resuming.
+            pattern (str, optional): Glob pattern used if `images` is a directory. Defaults to "*.jpg".
+        """
+        skip = skip or set()
+        self.paths: list[Path] = [
+            p for p in list_images(images, pattern) if p.name not in skip
+        ]
+        self.filenames: list[str] = [p.name for p in self.paths]
 
     def __len__(self):
-        return len(self.images)
+        return len(self.paths)
+
+    def _indices(self, idx: int | slice | list[int]) -> int | list[int]:
+        if isinstance(idx, slice):
+            return list(range(len(self)))[idx]
+        return idx
+
+    def load_image(self, idx: int) -> Image.Image:
+        with Image.open(self.paths[idx]) as img:
+            return img.convert("RGB")
+
+    def get_filenames(self, idx: int | slice | list[int]) -> str | list[str]:
+        idx = self._indices(idx)
+        if isinstance(idx, list):
+            return [self.filenames[i] for i in idx]
+        return self.filenames[idx]
+
+    def get_images(
+        self, idx: int | slice | list[int]
+    ) -> Image.Image | list[Image.Image]:
+        idx = self._indices(idx)
+        if isinstance(idx, list):
+            return [self.load_image(i) for i in idx]
+        return self.load_image(idx)
+
+    def index(self, filename: str) -> int:
+        """Position of an image in the dataset, by file name."""
+        if not hasattr(self, "_index"):
+            self._index = {name: i for i, name in enumerate(self.filenames)}
+        if filename not in self._index:
+            raise KeyError(f"{filename} is not in the dataset")
+        return self._index[filename]
 
+    def from_images(
+        self, filenames: list[str], images: list[Image.Image]
+    ) -> tuple[list[str], object]:
+        """
+        The batch `__getitem__` returns for these images, from images that were already
+        decoded (e.g. once for several models, see `pipeline.CaptionPipeline`).
+        """
+        raise NotImplementedError(
+            f"{type(self).__name__} does not take decoded images"
+        )
+
+
+class ImageDataset(ImageFolderDataset):
     def __getitem__(
-        self, idx: int | slice
+        self, idx: int | slice | list[int]
     ) -> tuple[str | list[str], Tensor | list[Tensor]]:
-        captions = self.filenames[idx]
-        images = self.images[idx]
+        captions = self.get_filenames(idx)
+        images = self.get_images(idx)
+        if isinstance(images, list):
+            return captions, [transforms.ToTensor()(img) for img in images]
+        return captions, transforms.ToTensor()(images)
+
+    def from_images(
+        self, filenames: list[str], images: list[Image.Image]
+    ) -> tuple[list[str], list[Tensor]]:
+        return filenames, [transforms.ToTensor()(img) for img in images]
 
-        return captions, images
+
+class DecodedImageDataset(ImageFolderDataset):
+    """Decoded images, to be shared by several models, see `pipeline.CaptionPipeline`."""
+
+    def __getitem__(
+        self, idx: int | slice | list[int]
+    ) -> tuple[list[str], list[Image.Image]]:
+        idx = self._indices(idx)
+        if not isinstance(idx, list):
+            idx = [idx]
+        return self.get_filenames(idx), self.get_images(idx)  # type: ignore
 
 
 class CaptionDataModule(pl.LightningDataModule):
-    def __init__(self, images: dict[str, Image.Image]):
+    def __init__(self, images: ImageSource):
         super().__init__()
         self.dataset = ImageDataset(images)
 
@@ -0,0 +1,361 @@
+import csv
+import json
+import logging
+import math
+import os
+import sys
+from collections.abc import Iterable, Sequence
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 2
+
+# Region of the image a box is in, by [row][column] of a 3x3 grid
+REGIONS = np.array(
+    [
+        ["top left", "top center", "top right"],
+        ["middle left", "center", "middle right"],
+        ["bottom left", "bottom center", "bottom right"],
+    ]
+)
+
+
+def grid_regions(points: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    """
+    Vectorized `phi4sam.get_pos`: the cell of a 3x3 grid each point falls in.
+    Args:
+        points (np.ndarray): (x, y) of each point, shape (m, 2).
+        sizes (np.ndarray): (width, height) of the image of each point, shape (m, 2).
+    Returns:
+        np.ndarray: Cell index `3 * row + column` of each point, shape (m,).
+    """
+    points = np.asarray(points, dtype=np.float64)
+    sizes = np.asarray(sizes, dtype=np.float64)
+    cells = (points >= sizes / 3).astype(np.int64) + (points >= 2 * sizes / 3)
+    return 3 * cells[:, 1] + cells[:, 0]
+
+
+def normalize_label(label: str) -> str:
+    """
+    Lower case label without list markers, punctuation at either end, repeated spaces
+    or a leading article, e.g. "- The Certificate." -> "certificate".
+    """
+    normalized = " ".join(label.lower().split()).strip(" -*,.;:'\"")
+    for article in ("the ", "a ", "an "):
+        if normalized.startswith(article):
+            normalized = normalized[len(article) :]
+            break
+    return normalized or label.strip()
+
+
+def box_areas(boxes: np.ndarray) -> np.ndarray:
+    """Area of each box `(x0, y0, x1, y1)`, shape (m,)."""
+    sides = np.clip(boxes[:, 2:] - boxes[:, :2], 0, None)
+    return sides[:, 0] * sides[:, 1]
+
+
+def box_iou(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Intersection over union of every pair of boxes, shape (len(a), len(b))."""
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    sides = np.clip(bottom_right - top_left, 0, None)
+    intersection = sides[..., 0] * sides[..., 1]
+    union = box_areas(a)[:, None] + box_areas(b)[None, :] - intersection
+    return np.divide(
+        intersection,
+        union,
+        out=np.zeros_like(intersection),
+        where=union > 0,
+    )
+
+
+def non_max_suppression(boxes: np.ndarray, iou_threshold: float) -> np.ndarray:
+    """
+    Greedy non-maximum suppression of boxes sorted best first: a box is dropped if it
+    overlaps a kept, better box with an IoU above `iou_threshold`.
+    Returns:
+        np.ndarray: Indices of the kept boxes, in order.
+    """
+    suppressed = box_iou(boxes, boxes) > iou_threshold
+    keep = np.ones(len(boxes), dtype=bool)
+    for i in range(len(boxes)):
+        if keep[i]:
+            keep[i + 1 :] &= ~suppressed[i, i + 1 :]
+    return np.flatnonzero(keep)
+
+
+class DescriptorStore:
+    """
+    Columnar index of the SAM outputs in a `batch_descriptors.tsv` file.
+
+    Objects of all images are kept in flat arrays: a label id (into `labels`), a box
+    `(x0, y0, x1, y1)` and a confidence (NaN if SAM did not give one) per object, with offsets (objects of image `i` are
+    `offsets[i]` to `offsets[i + 1]`). Polygons are not kept, prompts only use the boxes.
+    `DescriptorStore.load` caches the arrays in a `.npz` file next to the TSV file,
+    rebuilt whenever the TSV file's size or modification time changes.
+    """
+
+    def __init__(
+        self,
+        images: np.ndarray,
+        offsets: np.ndarray,
+        label_ids: np.ndarray,
+        boxes: np.ndarray,
+        scores: np.ndarray,
+        labels: np.ndarray,
+    ):
+        """
+        Args:
+            images (np.ndarray): File name of each image, shape (n,).
+            offsets (np.ndarray): Index of each image's first object, shape (n + 1,).
+            label_ids (np.ndarray): Label of each object, index into `labels`, shape (m,).
+            boxes (np.ndarray): Box of each object, `(x0, y0, x1, y1)`, shape (m, 4).
+            scores (np.ndarray): Confidence of each object, shape (m,).
+            labels (np.ndarray): The distinct labels, shape (k,).
+        """
+        self.images = images
+        self.offsets = offsets
+        self.label_ids = label_ids
+        self.boxes = boxes
+        self.scores = scores
+        self.labels = labels
+        self._rows = {name: i for i, name in enumerate(images.tolist())}
+
+    @classmethod
+    def from_rows(
+        cls, rows: Iterable[tuple[str, Sequence[dict]]]
+    ) -> "DescriptorStore":
+        """
+        Build the index from (image, descriptors) pairs, descriptors being dictionaries
+        with a `label`, a `rect_box` and optionally a `score` (or `confidence`).
+        A repeated image keeps its last descriptors.
+        """
+        descriptors: dict[str, Sequence[dict]] = dict(rows)
+        label_index: dict[str, int] = {}
+        offsets = [0]
+        label_ids: list[int] = []
+        boxes: list[Sequence[float]] = []
+        scores: list[float] = []
+        for objects in descriptors.values():
+            for obj in objects:
+                label_ids.append(
+                    label_index.setdefault(obj["label"], len(label_index))
+                )
+                boxes.append(obj["rect_box"])
+                scores.append(
+                    obj.get("score", obj.get("confidence", math.nan))
+                )
+            offsets.append(len(label_ids))
+        return cls(
+            np.array(list(descriptors), dtype=str),
+            np.array(offsets, dtype=np.int64),
+            np.array(label_ids, dtype=np.int64),
+            np.array(boxes, dtype=np.float64).reshape(-1, 4),
+            np.array(scores, dtype=np.float64),
+            np.array(list(label_index), dtype=str),
+        )
+
+    @classmethod
+    def from_tsv(cls, source: str | Path) -> "DescriptorStore":
+        """Parse a SAM output file (columns `image` and `descriptor`, a JSON list)."""
+        csv.field_size_limit(sys.maxsize)
+        with open(source, "r", newline="") as f:
+            reader = csv.DictReader(f, delimiter="\t")
+            return cls.from_rows(
+                (row["image"], json.loads(row["descriptor"])) for row in reader
+            )
+
+    @staticmethod
+    def cache_file(source: str | Path) -> Path:
+        source = Path(source)
+        return source.with_name(f"{source.stem}.descriptors.npz")
+
+    @classmethod
+    def load(cls, source: str | Path) -> "DescriptorStore":
+        """
+        Load the descriptors of a SAM output file, from the cached index if it is up to
+        date, otherwise by parsing the file (and caching the result).
+        The store of the current version of each file is also kept in memory, so repeated
+        calls in a process are free.
+        """
+        source = Path(source)
+        stat = os.stat(source)
+        path = str(source.resolve())
+        version = (stat.st_mtime_ns, stat.st_size)
+        if path in _loaded and _loaded[path][0] == version:
+            return _loaded[path][1]
+        store = cls._load_cache(source, stat)
+        if store is None:
+            logger.info(f"Indexing SAM descriptors in {source}")
+            store = cls.from_tsv(source)
+            store._save_cache(source, stat)
+        # A rewritten file replaces its old store instead of adding one
+        _loaded[path] = (version, store)
+        return store
+
+    @classmethod
+    def _load_cache(
+        cls, source: Path, stat: os.stat_result
+    ) -> "DescriptorStore | None":
+        cache_file = cls.cache_file(source)
+        if not cache_file.exists():
+            return None
+        try:
+            with np.load(cache_file) as data:
+                if data["meta"].tolist() != [
+                    CACHE_VERSION,
+                    stat.st_mtime_ns,
+                    stat.st_size,
+                ]:
+                    return None
+                return cls(
+                    data["images"],
+                    data["offsets"],
+                    data["label_ids"],
+                    data["boxes"],
+                    data["scores"],
+                    data["labels"],
+                )
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable cache {cache_file}: {e}")
+            return None
+
+    def _save_cache(self, source: Path, stat: os.stat_result) -> None:
+        cache_file = self.cache_file(source)
+        # Write to a temporary file first, so a crash cannot leave a half-written cache
+        tmp = cache_file.with_name(f".{cache_file.stem}.tmp.npz")
+        try:
+            np.savez(
+                tmp,
+                meta=np.array(
+                    [CACHE_VERSION, stat.st_mtime_ns, stat.st_size],
+                    dtype=np.int64,
+                ),
+                images=self.images,
+                offsets=self.offsets,
+                label_ids=self.label_ids,
+                boxes=self.boxes,
+                scores=self.scores,
+                labels=self.labels,
+            )
+            os.replace(tmp, cache_file)
+        except OSError as e:
+            logger.warning(
+                f"Could not cache the descriptors in {cache_file}: {e}"
+            )
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self._rows
+
+    def rows(self, filenames: Sequence[str]) -> np.ndarray:
+        """Row of each image, raises KeyError for an image without descriptors."""
+        missing = [f for f in filenames if f not in self._rows]
+        if missing:
+            raise KeyError(
+                f"No SAM descriptors for {len(missing)} images: {missing[:5]}"
+            )
+        return np.array([self._rows[f] for f in filenames], dtype=np.int64)
+
+    def select(
+        self,
+        rows: np.ndarray,
+        iou_threshold: Optional[float] = None,
+        max_objects: Optional[int] = None,
+    ) -> list[np.ndarray]:
+        """
+        Objects of each image to describe. Without options, every object in file order.
+        Otherwise objects are ranked by confidence, then by box area (largest first), boxes
+        overlapping a better one are suppressed, and the best `max_objects` are kept.
+        Args:
+            rows (np.ndarray): Rows of the images, see `rows`.
+            iou_threshold (float, optional): IoU above which the worse of two boxes is dropped. Defaults to None (no suppression).
+            max_objects (int, optional): Number of objects kept per image. Defaults to None (all).
+        Returns:
+            list[np.ndarray]: Object indices of each image, best first if ranked.
+        """
+        selected = []
+        ranked = iou_threshold is not None or max_objects is not None
+        for start, end in zip(
+            self.offsets[rows].tolist(), self.offsets[rows + 1].tolist()
+        ):
+            objects = np.arange(start, end)
+            if ranked:
+                scores = np.nan_to_num(self.scores[objects], nan=0.0)
+                # lexsort is stable and sorts by its last key first
+                objects = objects[
+                    np.lexsort((-box_areas(self.boxes[objects]), -scores))
+                ]
+            if iou_threshold is not None:
+                objects = objects[
+                    non_max_suppression(self.boxes[objects], iou_threshold)
+                ]
+            if max_objects is not None:
+                objects = objects[:max_objects]
+            selected.append(objects)
+        return selected
+
+    def describe(
+        self,
+        filenames: Sequence[str],
+        sizes: np.ndarray,
+        iou_threshold: Optional[float] = None,
+        max_objects: Optional[int] = None,
+        normalize: bool = False,
+    ) -> list[list[str]]:
+        """
+        `label (region)` of the objects of each image, as `phi4sam.get_prompt_description`,
+        with the regions of all boxes computed at once.
+        Args:
+            filenames (Sequence[str]): The images.
+            sizes (np.ndarray): (width, height) of each image, shape (n, 2), see `data.image_size`.
+            iou_threshold (float, optional): Non-maximum suppression threshold, see `select`. Defaults to None.
+            max_objects (int, optional): Number of objects described per image, see `select`. Defaults to None.
+            normalize (bool, optional): Use `normalize_label` and drop repeated descriptions. Defaults to False.
+        Returns:
+            list[list[str]]: The descriptions of each image's objects, in file order
+                (best first if `iou_threshold` or `max_objects` is given).
+        """
+        selected = self.select(
+            self.rows(filenames), iou_threshold, max_objects
+        )
+        counts = np.array([len(o) for o in selected], dtype=np.int64)
+        objects = (
+            np.concatenate(selected) if selected else np.zeros(0, np.int64)
+        )
+        boxes = self.boxes[objects]
+        centroids = (boxes[:, :2] + boxes[:, 2:]) / 2
+        regions = REGIONS.ravel()[
+            grid_regions(
+                centroids,
+                np.repeat(np.asarray(sizes).reshape(-1, 2), counts, axis=0),
+            )
+        ]
+        vocabulary = self.labels
+        if normalize:
+            vocabulary = np.array(
+                [normalize_label(label) for label in self.labels.tolist()],
+                dtype=str,
+            )
+        labels = vocabulary[self.label_ids[objects]]
+        descriptions = [
+            f"{label} ({region})"
+            for label, region in zip(labels.tolist(), regions.tolist())
+        ]
+        bounds = np.concatenate([[0], np.cumsum(counts)]).tolist()
+        if not normalize:
+            return [descriptions[a:b] for a, b in zip(bounds, bounds[1:])]
+        return [
+            list(dict.fromkeys(descriptions[a:b]))
+            for a, b in zip(bounds, bounds[1:])
+        ]
+
+
+# Resolved path -> ((mtime_ns, size), store), one entry per file
+_loaded: dict[str, tuple[tuple[int, int], DescriptorStore]] = {}
@@ -0,0 +1,186 @@
+import logging
+import os
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+HISTOGRAM_BINS = 16  # per RGB channel
+THUMBNAIL_SIZE = 8  # grayscale thumbnail of THUMBNAIL_SIZE x THUMBNAIL_SIZE
+
+
+def frame_signature(path: str | Path) -> np.ndarray:
+    """
+    Cheap signature of a frame: the RGB histogram (`HISTOGRAM_BINS` bins per channel,
+    summing to 1 over all channels) of a small copy of the image, followed by a
+    `THUMBNAIL_SIZE` by `THUMBNAIL_SIZE` grayscale thumbnail in [0, 1]. JPEGs are
+    decoded at reduced scale.
+    """
+    with Image.open(path) as img:
+        img.draft("RGB", (64, 64))
+        small = img.convert("RGB").resize((32, 32), Image.Resampling.BILINEAR)
+    pixels = np.asarray(small, dtype=np.uint8).reshape(-1, 3)
+    bins = pixels.astype(np.int64) * HISTOGRAM_BINS // 256
+    offsets = np.arange(3) * HISTOGRAM_BINS
+    histogram = np.bincount(
+        (bins + offsets).ravel(), minlength=3 * HISTOGRAM_BINS
+    ) / (3 * len(pixels))
+    thumbnail = np.asarray(
+        small.convert("L").resize(
+            (THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.Resampling.BILINEAR
+        ),
+        dtype=np.float32,
+    )
+    return np.concatenate([histogram, thumbnail.ravel() / 255]).astype(
+        np.float32
+    )
+
+
+def _signatures(paths: Sequence[str | Path]) -> np.ndarray:
+    return np.stack([frame_signature(path) for path in paths])
+
+
+def frame_signatures(
+    paths: Sequence[str | Path], workers: Optional[int] = None
+) -> np.ndarray:
+    """
+    `frame_signature` of every frame, computed in a process pool.
+    Args:
+        paths (Sequence[str | Path]): Image files.
+        workers (int, optional): Processes. Defaults to None (the number of CPUs).
+    Returns:
+        np.ndarray: Signatures, shape (len(paths), 3 * HISTOGRAM_BINS + THUMBNAIL_SIZE ** 2).
+    """
+    workers = workers or os.cpu_count() or 1
+    if not paths:
+        return np.zeros(
+            (0, 3 * HISTOGRAM_BINS + THUMBNAIL_SIZE**2), dtype=np.float32
+        )
+    if workers <= 1 or len(paths) < 2 * workers:
+        return _signatures(paths)
+    # A few chunks per worker, so that uneven chunks do not leave workers idle
+    chunk_size = -(-len(paths) // (4 * workers))
+    starts = range(0, len(paths), chunk_size)
+    with ProcessPoolExecutor(workers) as pool:
+        return np.concatenate(
+            list(
+                pool.map(
+                    _signatures, [paths[i : i + chunk_size] for i in starts]
+                )
+            )
+        )
+
+
+def shot_boundaries(
+    signatures: np.ndarray,
+    threshold: Optional[float] = None,
+    min_shot_length: int = 1,
+) -> np.ndarray:
+    """
+    Detect cuts between consecutive frames from the change of their histograms (half the L1
+    distance, from 0 for identical colours to 1 for disjoint ones).
+    Args:
+        signatures (np.ndarray): `frame_signatures` of the frames, in order.
+        threshold (float, optional): Change above which two frames are in different shots. Defaults to None
+            (adaptive: the median change plus 3 scaled median absolute deviations, at least 0.1).
+        min_shot_length (int, optional): Frames of the shortest shot, cuts closer to the previous
+            one are ignored. Defaults to 1.
+    Returns:
+        np.ndarray: Index of the first frame of every shot, starting with 0.
+    """
+    if len(signatures) == 0:
+        return np.zeros(0, dtype=np.int64)
+    histograms = signatures[:, : 3 * HISTOGRAM_BINS]
+    change = np.abs(np.diff(histograms, axis=0)).sum(axis=1) / 2
+    if threshold is None and len(change):
+        median = np.median(change)
+        mad = 1.4826 * np.median(np.abs(change - median))
+        threshold = max(0.1, float(median + 3 * mad))
+    starts = [0]
+    for i in np.flatnonzero(change > (threshold or 0.0)) + 1:
+        if i - starts[-1] >= min_shot_length:
+            starts.append(int(i))
+    return np.array(starts, dtype=np.int64)
+
+
+def _farthest_points(
+    features: np.ndarray, first: int, count: int
+) -> list[int]:
+    """Greedy farthest point sampling: `count` rows of `features`, starting from `first`."""
+    chosen = [first]
+    distance = np.abs(features - features[first]).sum(axis=1)
+    while len(chosen) < min(count, len(features)):
+        i = int(distance.argmax())
+        chosen.append(i)
+        distance = np.minimum(
+            distance, np.abs(features - features[i]).sum(axis=1)
+        )
+    return chosen
+
+
+def _medoid(features: np.ndarray) -> int:
+    """Row closest to the mean of `features`."""
+    return int(np.abs(features - features.mean(axis=0)).sum(axis=1).argmin())
+
+
+def select_frames(
+    signatures: np.ndarray, shots: np.ndarray, budget: int
+) -> np.ndarray:
+    """
+    Choose at most `budget` representative frames, spread over shots.
+
+    Every shot gets its most typical frame (closest to the mean signature of the shot) and
+    the rest of the budget is shared in proportion to the length of the shots; within a
+    shot, further frames are those least similar to the ones already chosen, so a long
+    static shot does not get many near-identical frames. With fewer frames than shots, the
+    most dissimilar shots are kept, starting with the longest one, so short but distinct
+    scenes are not lost.
+    Args:
+        signatures (np.ndarray): `frame_signatures` of the frames, in order.
+        shots (np.ndarray): First frame of every shot, from `shot_boundaries`.
+        budget (int): Number of frames to select.
+    Returns:
+        np.ndarray: Indices of the selected frames, sorted.
+    """
+    n = len(signatures)
+    if budget >= n:
+        return np.arange(n)
+    if budget <= 0:
+        return np.zeros(0, dtype=np.int64)
+    bounds = np.append(shots, n)
+    lengths = np.diff(bounds)
+    medoids = np.array(
+        [
+            start + _medoid(signatures[start:end])
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+    )
+    if budget <= len(shots):
+        kept = _farthest_points(
+            signatures[medoids], int(lengths.argmax()), budget
+        )
+        return np.sort(medoids[kept])
+    # One frame per shot, the rest by largest remainder of the proportional share
+    counts = np.ones(len(shots), dtype=np.int64)
+    share = (budget - len(shots)) * (lengths - 1) / max(1, n - len(shots))
+    counts += np.floor(share).astype(np.int64)
+    remainder = share - np.floor(share)
+    for i in np.argsort(-remainder, kind="stable"):
+        if counts.sum() >= budget:
+            break
+        if counts[i] < lengths[i]:
+            counts[i] += 1
+    selected = []
+    for start, end, medoid, count in zip(
+        bounds[:-1], bounds[1:], medoids, counts
+    ):
+        chosen = _farthest_points(
+            signatures[start:end], int(medoid - start), int(count)
+        )
+        selected.extend(start + i for i in chosen)
+    return np.sort(np.array(selected, dtype=np.int64))
@@ -0,0 +1,213 @@
+import json
+import logging
+import time
+from collections import defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+import torch
+from torch import Tensor
+from transformers import StoppingCriteria, StoppingCriteriaList  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+
+class _FirstToken(StoppingCriteria):
+    """Records when `generate` produced its first token, never stops generation."""
+
+    def __init__(self):
+        self.time: Optional[float] = None
+
+    def __call__(self, input_ids: Tensor, scores: Tensor, **kwargs) -> Tensor:
+        if self.time is None:
+            self.time = time.perf_counter()
+        return torch.zeros(
+            input_ids.shape[0], dtype=torch.bool, device=input_ids.device
+        )
+
+
+class Instrumentation:
+    """
+    Per-batch timings and token counts of a model's prediction loop.
+
+    Stages are timed with `stage` (CUDA is synchronized at the end of each stage, so the
+    time includes the kernels it launched); `generation` splits `generate` into the
+    prefill (up to the first token) and the decoding of the other tokens. `end_batch`
+    returns the metrics of the batch (for a Lightning logger) and `summary` those of
+    the whole run, `write_summary` saves them as JSON.
+    """
+
+    def __init__(self, device: Optional[torch.device | str] = None):
+        """
+        Args:
+            device (torch.device | str, optional): Device whose peak memory is reported. Defaults to None
+                (the current CUDA device, if there is one).
+        """
+        self.device = device
+        self.batches: list[dict[str, float]] = []
+        self._stages: dict[str, float] = defaultdict(float)
+        self._counts: dict[str, float] = defaultdict(float)
+        self._start: Optional[float] = None
+        self._last_end: Optional[float] = None
+        self._run_start: Optional[float] = None
+
+    @property
+    def _cuda(self) -> bool:
+        if not torch.cuda.is_available():
+            return False
+        return self.device is None or torch.device(self.device).type == "cuda"
+
+    def _sync(self) -> None:
+        if self._cuda:
+            torch.cuda.synchronize(self.device)
+
+    def start_batch(self) -> None:
+        """Start timing a batch, the time since the previous batch is its `wait` (data loading)."""
+        now = time.perf_counter()
+        if self._run_start is None:
+            self._run_start = now
+        if self._last_end is not None:
+            self._stages["wait"] += max(
+                0.0, now - self._last_end - sum(self._stages.values())
+            )
+        self._start = now
+        if self._cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time a stage of the current batch (stages with the same name add up)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._sync()
+            self._stages[name] += time.perf_counter() - start
+
+    @contextmanager
+    def generation(self) -> Iterator[StoppingCriteriaList]:
+        """
+        Time a `generate` call, pass the yielded `stopping_criteria` to it so that the
+        time is split into `prefill` and `decode`.
+        """
+        first_token = _FirstToken()
+        start = time.perf_counter()
+        try:
+            yield StoppingCriteriaList([first_token])
+        finally:
+            self._sync()
+            end = time.perf_counter()
+            split = first_token.time if first_token.time is not None else end
+            self._stages["prefill"] += split - start
+            self._stages["decode"] += end - split
+
+    def count_batch(self, batch_size: int) -> None:
+        """Count the samples of a batch without a text prompt."""
+        self._counts["batch_size"] += batch_size
+
+    def count_inputs(
+        self, input_ids: Tensor, attention_mask: Optional[Tensor] = None
+    ) -> None:
+        """Count the samples and prompt tokens of a batch, and the padding around them."""
+        self.count_batch(input_ids.shape[0])
+        self._counts["padded_tokens"] += input_ids.numel()
+        self._counts["prompt_tokens"] += (
+            int(attention_mask.sum())
+            if attention_mask is not None
+            else input_ids.numel()
+        )
+
+    def count_outputs(
+        self, generated: Tensor | int, pad_token_id: Optional[int] = None
+    ) -> None:
+        """Count generated tokens, from a number or the generated ids (padding excluded)."""
+        if isinstance(generated, Tensor):
+            generated = int(
+                generated.numel()
+                if pad_token_id is None
+                else (generated != pad_token_id).sum()
+            )
+        self._counts["generated_tokens"] += generated
+
+    def end_batch(self) -> dict[str, float]:
+        """Metrics of the current batch, also kept for `summary`."""
+        self._sync()
+        end = time.perf_counter()
+        metrics = {f"time/{k}": v for k, v in self._stages.items()}
+        metrics["time/batch"] = end - (self._start or end)
+        metrics.update(self._counts)
+        metrics.update(_rates(metrics))
+        if self._cuda:
+            metrics["peak_memory_gb"] = (
+                torch.cuda.max_memory_allocated(self.device) / 2**30
+            )
+        self.batches.append(metrics)
+        self._stages.clear()
+        self._counts.clear()
+        self._last_end = end
+        return metrics
+
+    def summary(self) -> dict[str, Any]:
+        """Totals, throughput and latency percentiles of every batch so far."""
+        if not self.batches:
+            return {"batches": 0}
+        keys = sorted({k for batch in self.batches for k in batch})
+        totals = {
+            k: float(sum(batch.get(k, 0.0) for batch in self.batches))
+            for k in keys
+            if k.startswith("time/") or k.endswith(("_tokens", "batch_size"))
+        }
+        latencies = np.array([batch["time/batch"] for batch in self.batches])
+        summary: dict[str, Any] = {
+            "batches": len(self.batches),
+            "wall_time": (self._last_end or 0.0) - (self._run_start or 0.0),
+            "totals": totals,
+            "throughput": _rates(totals),
+            "batch_latency": {
+                "mean": float(latencies.mean()),
+                "p50": float(np.percentile(latencies, 50)),
+                "p95": float(np.percentile(latencies, 95)),
+                "max": float(latencies.max()),
+            },
+        }
+        if summary["wall_time"] > 0:
+            summary["throughput"]["images_per_s"] = (
+                totals.get("batch_size", 0.0) / summary["wall_time"]
+            )
+        peaks = [
+            b["peak_memory_gb"] for b in self.batches if "peak_memory_gb" in b
+        ]
+        if peaks:
+            summary["peak_memory_gb"] = max(peaks)
+        return summary
+
+    def write_summary(
+        self, path: str | Path, extra: Optional[dict[str, Any]] = None
+    ) -> None:
+        """Write `summary` (with `extra` fields, e.g. the model's hyperparameters) as JSON."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump((extra or {}) | self.summary(), f, indent=2, default=str)
+        logger.info(f"Wrote throughput summary to {path}")
+
+
+def _rates(metrics: dict[str, float]) -> dict[str, float]:
+    """Tokens per second and padding ratio from token counts and stage times."""
+    rates: dict[str, float] = {}
+    prefill = metrics.get("time/prefill", 0.0)
+    decode = metrics.get("time/decode", 0.0)
+    if metrics.get("padded_tokens"):
+        rates["padding_ratio"] = (
+            1 - metrics.get("prompt_tokens", 0.0) / metrics["padded_tokens"]
+        )
+    if prefill > 0 and "prompt_tokens" in metrics:
+        rates["prompt_tokens_per_s"] = metrics["prompt_tokens"] / prefill
+    if prefill + decode > 0 and "generated_tokens" in metrics:
+        rates["generated_tokens_per_s"] = metrics["generated_tokens"] / (
+            prefill + decode
+        )
+    return rates
@@ -1,10 +1,19 @@
 from collections.abc import Sequence
-from typing import overload, NoReturn, Never, TypedDict, Literal
+from collections import Counter
+from typing import overload, NoReturn, Never, TypedDict, Literal, Optional
 from evaluate import EvaluationModule, combine, load
 import torch
+import numpy as np
 from functools import wraps
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import json
+import math
+from sacrebleu.metrics import BLEU
+from sacrebleu.tokenizers.tokenizer_13a import Tokenizer13a
+from .bertscore_cache import CachedBERTScorer
+from .references import ReferenceStore
+from .captions import read_captions
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -23,36 +32,33 @@ class JSONFormat(TypedDict):
 
 def load_ground_truth(file: str|Path) -> dict[str, str]:
     """
-    Load the ground truth captions from a JSON file.
+    Load the ground truth captions from a JSON file, one caption per image.
     Args:
         file (str|Path): Path to the JSON file containing the ground truth captions.
     Returns:
         dict[str, str]: A dictionary mapping image filenames to their corresponding captions.
     """
-    with open(file, "r") as f:
-        data: list[JSONFormat] = json.load(f)
-    ground_truths: dict[str, str] = {}
-    for item in data:
-        name: str = str(item["frame_time"])
-        caption: str = item["captions"].popitem()[0]
-        ground_truths[f'{name}.jpg'] = caption
-    return ground_truths
-    # //  ground_truths_list = [ground_truths[key] for key in sorted(ground_truths.keys())]
+    return ReferenceStore.load(file).ground_truth()
+
+def load_references(file: str|Path) -> ReferenceStore:
+    """
+    Load all the reference captions from a JSON file, see `ReferenceStore`.
+    Args:
+        file (str|Path): Path to the JSON file containing the ground truth captions.
+    Returns:
+        ReferenceStore: Mapping from image filenames to their reference captions.
+    """
+    return ReferenceStore.load(file)
 
 def load_predictions(file: str|Path) -> dict[str, str]:
     """
-    Load the predicted captions from a .txt file.
+    Load the predicted captions from a caption file (tab-separated .txt, or any format `read_captions` supports).
     Args:
-        file (str|Path): Path to the .txt file containing the predicted captions.
+        file (str|Path): Path to the file containing the predicted captions.
     Returns:
         dict[str, str]: A dictionary mapping image filenames to their corresponding captions.
     """
-    predictions: dict[str, str] = {}
-    with open(file, "r") as f:
-        for line in f:
-            name, caption = line.strip().split("\t")
-            predictions[name] = caption
-    return predictions
+    return read_captions(file)["caption"].to_dict()
 
 
 def ensure_matching_types(func):
@@ -113,3 +119,302 @@ class HuggingFaceEvaluator:
                     | self.bertscore.compute(predictions=prediction, references=reference, lang="en", device="cuda:3", batch_size=512)) # type: ignore
 
 
+def _ngram_counts(tokens: list[str], max_order: int) -> Counter[tuple[str, ...]]:
+    return Counter(
+        tuple(tokens[i : i + order])
+        for order in range(1, max_order + 1)
+        for i in range(len(tokens) - order + 1)
+    )
+
+
+def _as_references(
+    references: Sequence[str | Sequence[str]],
+) -> list[list[str]]:
+    """Normalise references to a list of reference captions per sample."""
+    return [[r] if isinstance(r, str) else list(r) for r in references]
+
+
+def bleu_statistics(
+    prediction: str, reference: str | Sequence[str], max_order: int = 4
+) -> list[int]:
+    """
+    Sufficient statistics for BLEU as computed by the Hugging Face `bleu` module
+    (13a tokenization, no smoothing): matches and possible matches for every order,
+    then the prediction and reference lengths.
+    With several references, n-gram counts are clipped by their maximum count in any
+    reference and the reference length is the shortest one, as in the `bleu` module.
+    Statistics can be summed over samples to get the corpus score, see `bleu_from_statistics`.
+    """
+    tokenize = Tokenizer13a()
+    pred_tokens = tokenize(prediction).split()
+    ref_counts: Counter[tuple[str, ...]] = Counter()
+    ref_lengths = []
+    for ref in [reference] if isinstance(reference, str) else reference:
+        ref_tokens = tokenize(ref).split()
+        ref_counts |= _ngram_counts(ref_tokens, max_order)
+        ref_lengths.append(len(ref_tokens))
+    overlap = _ngram_counts(pred_tokens, max_order) & ref_counts
+    matches = [0] * max_order
+    for ngram, count in overlap.items():
+        matches[len(ngram) - 1] += count
+    possible = [max(len(pred_tokens) - order, 0) for order in range(max_order)]
+    return matches + possible + [len(pred_tokens), min(ref_lengths)]
+
+
+def bleu_from_statistics(stats: np.ndarray, max_order: int = 4) -> np.ndarray:
+    """
+    BLEU scores (0 to 1) from rows of `bleu_statistics`.
+    Args:
+        stats (np.ndarray): Array of shape (..., 2 * max_order + 2).
+    """
+    stats = np.asarray(stats, dtype=np.float64)
+    matches = stats[..., :max_order]
+    possible = stats[..., max_order : 2 * max_order]
+    pred_len = stats[..., 2 * max_order]
+    ref_len = stats[..., 2 * max_order + 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precisions = np.where(possible > 0, matches / possible, 0.0)
+        geo_mean = np.where(
+            precisions.min(axis=-1) > 0,
+            np.exp(np.log(np.maximum(precisions, 1e-300)).mean(axis=-1)),
+            0.0,
+        )
+        ratio = pred_len / ref_len
+        brevity_penalty = np.where(
+            ratio > 1, 1.0, np.exp(1 - 1 / np.maximum(ratio, 1e-300))
+        )
+    return geo_mean * np.where(pred_len > 0, brevity_penalty, 0.0)
+
+
+def _nltk_resources() -> None:
+    import nltk
+
+    for resource, path in (
+        ("wordnet", "corpora/wordnet"),
+        ("punkt_tab", "tokenizers/punkt_tab"),
+        ("omw-1.4", "corpora/omw-1.4"),
+    ):
+        try:
+            nltk.data.find(path)
+        except LookupError:
+            nltk.download(resource, quiet=True)
+
+
+def ngram_scores(
+    predictions: Sequence[str],
+    references: Sequence[str | Sequence[str]],
+    metrics: Sequence[str],
+) -> dict[str, list[float]]:
+    """
+    Per-sample scores for the CPU-bound (n-gram based) metrics.
+    Args:
+        predictions (Sequence[str]): The predicted captions.
+        references (Sequence[str | Sequence[str]]): The reference caption(s) of each prediction.
+            With several references, every metric follows its usual multi-reference rule
+            (clipped counts for BLEU, best reference for ROUGE, METEOR and exact match).
+        metrics (Sequence[str]): Any of "bleu", "sacrebleu", "rouge", "meteor" and "exact_match".
+    Returns:
+        dict[str, list[float]]: Scores by metric name. "rouge" adds rouge1, rouge2, rougeL and rougeLsum,
+            "bleu" and "sacrebleu" add the sufficient statistics needed for the corpus score
+            (bleu_stat_* and sacrebleu_stat_* columns), which `corpus_scores` removes.
+    """
+    references = _as_references(references)
+    scores: dict[str, list[float]] = {}
+    if "bleu" in metrics:
+        stats = np.array(
+            [bleu_statistics(p, r) for p, r in zip(predictions, references)],
+            dtype=np.int64,
+        ).reshape(len(predictions), -1)
+        scores["bleu"] = bleu_from_statistics(stats).tolist()
+        for i, column in enumerate(stats.T):
+            scores[f"bleu_stat_{i}"] = column.tolist()
+    if "sacrebleu" in metrics:
+        # effective_order avoids zero scores for short sentences, as recommended by sacrebleu
+        sentence_bleu = BLEU(effective_order=True)
+        sentences = [
+            sentence_bleu.sentence_score(p, list(r))
+            for p, r in zip(predictions, references)
+        ]
+        scores["sacrebleu"] = [s.score for s in sentences]
+        # Statistics of each sentence: hypothesis and closest reference lengths, matching
+        # and total n-grams of each order, see `corpus_scores`
+        stats = [
+            [s.sys_len, s.ref_len, *s.counts, *s.totals] for s in sentences
+        ]
+        for i, column in enumerate(zip(*stats)):
+            scores[f"sacrebleu_stat_{i}"] = list(column)
+    if "rouge" in metrics:
+        from rouge_score import rouge_scorer
+
+        rouge_types = ["rouge1", "rouge2", "rougeL", "rougeLsum"]
+        scorer = rouge_scorer.RougeScorer(rouge_types)
+        rouge = [
+            scorer.score_multi(r, p) for p, r in zip(predictions, references)
+        ]
+        for rouge_type in rouge_types:
+            scores[rouge_type] = [s[rouge_type].fmeasure for s in rouge]
+    if "meteor" in metrics:
+        from nltk import word_tokenize
+        from nltk.translate import meteor_score
+
+        _nltk_resources()
+        scores["meteor"] = [
+            meteor_score.meteor_score(
+                [word_tokenize(ref) for ref in r],
+                word_tokenize(p),
+                alpha=0.9,
+                beta=3,
+                gamma=0.5,
+            )
+            for p, r in zip(predictions, references)
+        ]
+    if "exact_match" in metrics:
+        scores["exact_match"] = [
+            float(p in r) for p, r in zip(predictions, references)
+        ]
+    return scores
+
+
+class BatchEvaluator(Evaluator):
+    """
+    Scores a whole prediction set at once: the n-gram metrics in a single pass over the
+    samples and BERTScore in batches of `batch_size`, instead of one module call per sample.
+    """
+
+    def __init__(
+        self,
+        *metrics: str,
+        batch_size: int = 512,
+        device: str | torch.device = device,
+        bertscore_cache: Optional[str | Path] = None,
+        workers: int = 1,
+    ) -> None:
+        """
+        Args:
+            *metrics (str): Metric names, see `huggingface_metrics`. Defaults to all of them.
+            batch_size (int, optional): BERTScore batch size. Defaults to 512.
+            device (str | torch.device, optional): Device for BERTScore. Defaults to cuda if available.
+            bertscore_cache (str | Path, optional): Directory of the BERTScore embedding cache. If given,
+                captions that were scored before (e.g. the references) are not encoded again,
+                see `CachedBERTScorer`. Defaults to None.
+            workers (int, optional): Number of processes for the n-gram metrics. Defaults to 1 (no pool).
+        """
+        self.metrics = list(metrics) if metrics else list(huggingface_metrics)
+        self.batch_size = batch_size
+        self.workers = workers
+        self.device = str(device)
+        self.bertscore: EvaluationModule | CachedBERTScorer | None
+        if "bertscore" not in self.metrics:
+            self.bertscore = None
+        elif bertscore_cache is not None:
+            self.bertscore = CachedBERTScorer(
+                bertscore_cache, batch_size=batch_size, device=device
+            )
+        else:
+            self.bertscore = load("bertscore")
+
+    @ensure_matching_types
+    def evaluate(
+        self,
+        prediction: Sequence[str],
+        reference: Sequence[str | Sequence[str]],
+    ) -> tuple[dict[str, list[float]], dict[str, float]]:
+        """
+        Evaluate the predictions against the references.
+        Args:
+            prediction (str|Sequence[str]): The predicted caption(s).
+            reference (str|Sequence[str | Sequence[str]]): The reference/ground-truth caption(s),
+                optionally several per prediction (e.g. from `load_references`).
+        Returns:
+            tuple[dict[str, list[float]], dict[str, float]]: Per-sample scores and corpus scores by metric name.
+        """
+        return corpus_scores(self.sample_scores(prediction, reference))
+
+    def sample_scores(
+        self,
+        prediction: Sequence[str],
+        reference: Sequence[str | Sequence[str]],
+    ) -> dict[str, list[float]]:
+        """
+        Per-sample scores, including the BLEU statistics columns. Subsets of the rows
+        can be passed to `corpus_scores` to get the corpus scores of that subset.
+        """
+        scores = self._ngram_scores(prediction, reference)
+        if isinstance(self.bertscore, CachedBERTScorer):
+            precision, recall, f1 = self.bertscore.score(prediction, reference)
+            scores["bertscore_precision"] = precision.tolist()
+            scores["bertscore_recall"] = recall.tolist()
+            scores["bertscore_f1"] = f1.tolist()
+        elif self.bertscore is not None:
+            # Falsy, see HuggingFaceEvaluator
+            bertscore = self.bertscore.compute(
+                predictions=prediction,
+                references=reference,
+                lang="en",
+                device=self.device,
+                batch_size=self.batch_size,
+            )
+            scores["bertscore_precision"] = bertscore["precision"]  # type: ignore
+            scores["bertscore_recall"] = bertscore["recall"]  # type: ignore
+            scores["bertscore_f1"] = bertscore["f1"]  # type: ignore
+        return scores
+
+    def _ngram_scores(
+        self,
+        prediction: Sequence[str],
+        reference: Sequence[str | Sequence[str]],
+    ) -> dict[str, list[float]]:
+        if self.workers <= 1 or len(prediction) < 2 * self.workers:
+            return ngram_scores(prediction, reference, self.metrics)
+        # A few chunks per worker, so that uneven chunks do not leave workers idle
+        chunk_size = -(-len(prediction) // (4 * self.workers))
+        starts = range(0, len(prediction), chunk_size)
+        scores: dict[str, list[float]] = {}
+        with ProcessPoolExecutor(self.workers) as pool:
+            for chunk in pool.map(
+                ngram_scores,
+                [prediction[i : i + chunk_size] for i in starts],
+                [reference[i : i + chunk_size] for i in starts],
+                [self.metrics] * len(starts),
+            ):
+                for name, values in chunk.items():
+                    scores.setdefault(name, []).extend(values)
+        return scores
+
+
+def corpus_scores(
+    scores: dict[str, list[float]],
+) -> tuple[dict[str, list[float]], dict[str, float]]:
+    """
+    Compute corpus scores from the output of `ngram_scores` (and per-sample BERTScore).
+    BLEU and sacreBLEU are computed from the summed sufficient statistics, the other
+    metrics are averaged over samples.
+    Returns:
+        tuple[dict[str, list[float]], dict[str, float]]: The per-sample scores without the
+            statistics columns, and the corpus scores.
+    """
+    scores = dict(scores)
+    corpus: dict[str, float] = {}
+    for metric in ("bleu", "sacrebleu"):
+        columns = [k for k in scores if k.startswith(f"{metric}_stat_")]
+        if not columns:
+            continue
+        stats = np.array([scores.pop(k) for k in columns], dtype=np.int64)
+        totals = stats.sum(axis=1)
+        if metric == "bleu":
+            corpus[metric] = float(bleu_from_statistics(totals))
+        else:
+            sys_len, ref_len, *ngrams = totals.tolist()
+            order = len(ngrams) // 2
+            # The defaults of `BLEU().corpus_score`
+            corpus[metric] = BLEU.compute_bleu(
+                ngrams[:order],
+                ngrams[order:],
+                sys_len,
+                ref_len,
+                smooth_method="exp",
+            ).score
+    for name, values in scores.items():
+        if name not in corpus:
+            corpus[name] = float(np.mean(values)) if values else math.nan
+    return scores, corpus
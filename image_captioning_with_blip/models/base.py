@@ -1,7 +1,28 @@
+import logging
+import torch
 import pytorch_lightning as pl
-from typing import Optional, TypeAlias
+from torch import Tensor
+from typing import Any, Optional, TypeAlias
 from pathlib import Path
-import json
+from collections.abc import Iterable, Mapping, Sequence
+from ..sinks import (
+    CaptionSink,
+    make_sink,
+    read_existing,
+    JSONLinesSink,
+    merge_shards,
+    outputs_exist,
+    shard_file,
+    shard_files,
+)
+from ..preprocessing import sequence_keys
+from ..scheduler import ContinuousBatcher
+from ..instrumentation import Instrumentation
+from ..caption_cache import CaptionCache, CaptionReuse
+from ..data import ImageSource, list_images
+from ..utils.array_store import content_key
+
+logger = logging.getLogger(__name__)
 
 type JSON = "dict[str, str | int | float | bool | JSON] | list[str | int | float | bool | JSON]"
 JSON_dict = dict[str, str | int | float | bool | JSON]
@@ -12,6 +33,14 @@ class Model(pl.LightningModule):
     checkpoint: str
     out_file: Path
     prompt: Optional[str] = None
+    # Decoder-only models that `predict_continuous` can decode with a `ContinuousBatcher`
+    continuous_batching: bool = False
+    # Passed to every forward call of `self.model`, by `predict_step` (where the model
+    # supports it) and `predict_continuous`
+    forward_kwargs: dict[str, Any] = {}
+    # Non-sequence inputs that `self.model` reads on every forward call, not only in the
+    # prefill, passed on every decode step by `predict_continuous` and to the prefix forward of `PrefixCache`
+    step_inputs: tuple[str, ...] = ()
 
     def __init__(
         self,
@@ -19,6 +48,12 @@ class Model(pl.LightningModule):
         checkpoint: Optional[str] = None,
         *args,
         hyperparameters: Optional[JSON_dict] = None,
+        sinks: Sequence[str] = ("jsonl", "tsv"),
+        flush_every: int = 1,
+        flush_interval: Optional[float] = None,
+        resume: bool | Path | str = False,
+        caption_cache: Optional[CaptionCache] = None,
+        shard: Optional[tuple[int, int]] = None,
         **kwargs,
     ):
         """
@@ -27,6 +62,20 @@ class Model(pl.LightningModule):
             checkpoint (str, optional): Checkpoint name. Defaults to None.
             *args: Additional arguments for the parent class.
             hyperparameters (JSON_dict, optional): Hyperparameters for the model. Defaults to None.
+            sinks (Sequence[str], optional): Output writers to use, see `sinks.SINKS`. Defaults to ("jsonl", "tsv").
+                The legacy .json array is written from the jsonl file once, at the end of the run.
+            flush_every (int, optional): Number of buffered captions after which the sinks write to disk. Defaults to 1.
+            flush_interval (float, optional): Seconds after which the sinks write to disk regardless of count. Defaults to None.
+            resume (bool | Path | str, optional): Continue an interrupted run instead of starting a new output file.
+                If True, the latest `out_file`/`out_file__N` variant is reused; if a path, that output file is reused.
+                Filenames already captioned there are collected in `self.completed`, pass them to the dataset's `skip`.
+                Defaults to False.
+            caption_cache (CaptionCache, optional): Captions of earlier runs by image hash, see
+                `apply_caption_cache`. New captions are added to it. Defaults to None.
+            shard (tuple[int, int], optional): (index, count) of this job when the images are split over
+                independent jobs (e.g. one per node, give each job `list_images(images)[index::count]`). Captions are
+                written to the job's shard files, `out_file` is used as is (no `__N` variant) and the shards are
+                not merged at the end, call `sinks.merge_shards` once every job is done. Defaults to None.
             **kwargs: Additional keyword arguments for the parent class.
         """
         super().__init__(*args, **kwargs)
@@ -41,12 +90,35 @@ class Model(pl.LightningModule):
         )
         self.json_file = self.out_file.with_suffix(".json")
         count = 1
-        if self.out_file:
+        if not isinstance(resume, bool):
+            self.out_file = Path(resume).with_suffix(".tsv")
+        elif self.out_file and shard is None:
             original = self.out_file
-            while self.out_file.exists():
+            latest = original
+            # Any file of the sinks (or shards of an interrupted sharded run) means
+            # the stem is taken
+            while outputs_exist(self.out_file, sinks):
+                latest = self.out_file
                 self.out_file = original.with_stem(f"{original.stem}__{count}")
                 count += 1
+            if resume:
+                self.out_file = latest
         self.json_file = self.out_file.with_suffix(".json")
+        self.sink_kinds = tuple(sinks)
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.sinks: list[CaptionSink] = self._make_sinks(self.out_file)
+        # (index, count) of this process when each process writes its own files
+        self.shard: Optional[tuple[int, int]] = None
+        self.job_shard = shard
+        self.completed: set[str] = set()
+        self.output_order: Optional[Mapping[str, int]] = None
+        # Stage timings and token counts of `predict_step`, see `on_predict_end`
+        self.instrumentation = Instrumentation()
+        # Cache hits and near-duplicates of the run, see `apply_caption_cache`
+        self.caption_reuse = CaptionReuse(caption_cache)
+        if resume:
+            self._resume()
 
         if hyperparameters is None:
             hyperparameters = {}
@@ -55,29 +127,330 @@ class Model(pl.LightningModule):
             "checkpoint": self.checkpoint,
             "name": self.name,
             "prompt": self.prompt,
+            "sinks": list(sinks),
+            "resume": bool(resume),
         } | hyperparameters
 
         self.save_hyperparameters(hyperparameters)
+        if shard is not None:
+            self.use_shard(*shard)
+
+    def _resume(self) -> None:
+        """Index the captions already written to the output files."""
+        records = read_existing(self.out_file)
+        self.completed = {r["filename"] for r in records}
+        # Captions of an interrupted sharded run are still in the shard files
+        for shard in shard_files(self.out_file):
+            self.completed.update(r["filename"] for r in read_existing(shard))
+        jsonl_sink = next(
+            (s for s in self.sinks if isinstance(s, JSONLinesSink)), None
+        )
+        if (
+            records
+            and jsonl_sink is not None
+            and not jsonl_sink.path.exists()
+        ):
+            # Older runs only have the .tsv/.json, carry their captions over so
+            # the final .json is complete
+            jsonl_sink.write(
+                [r["filename"] for r in records],
+                [r["caption"] for r in records],
+            )
+            jsonl_sink.flush()
+        logger.info(
+            f"Resuming {self.out_file}, {len(self.completed)} images already captioned"
+        )
 
     def _save(self, filenames: list[str], captions: list[str]) -> None:
+        filenames, captions = self.caption_reuse.add(filenames, captions)
         if not self.out_file:
             return
-        with open(self.out_file, "a") as f:
-            for fname, c in zip(filenames, captions):
-                print(f"{fname}\t{c}", file=f)
-        if self.json_file.exists():
-            cur_json = json.load(self.json_file.open())
-        else:
-            cur_json = []
-        for filename, caption in zip(filenames, captions):
-            cur_json.append(
-                {
-                    "filename": (filename),
-                    "caption": (caption),
-                }
+        with self.instrumentation.stage("save"):
+            for sink in self.sinks:
+                sink.write(filenames, captions)
+
+    def _make_sinks(self, out_file: Path) -> list[CaptionSink]:
+        return [
+            make_sink(kind, out_file, self.flush_every, self.flush_interval)
+            for kind in self.sink_kinds
+        ]
+
+    def use_shard(self, index: int, count: int) -> None:
+        """
+        Write the captions of this process to the files of shard `index` of `count`
+        (`<stem>.shard<NNN>.*`, without the legacy .json), see `merge_shards`.
+        """
+        if self.shard == (index, count):
+            return
+        self.shard = (index, count)
+        path = shard_file(self.out_file, index)
+        self.sinks = self._make_sinks(path)
+        for sink in self.sinks:
+            if isinstance(sink, JSONLinesSink):
+                sink.json_file = None
+        self.hparams["shard"] = [index, count]
+        logger.info(f"Writing shard {index} of {count} to {path}")
+
+    def merge_shards(self) -> None:
+        """
+        Move the captions of the shard files into the output files, in the order set by
+        `set_output_order`, see `sinks.merge_shards`. Called by rank 0 at the end of a
+        `Trainer` run on several devices.
+        """
+        merge_shards(
+            self.out_file,
+            self.sink_kinds,
+            self.final_order(),
+            self.flush_every,
+            self.flush_interval,
+        )
+
+    @property
+    def caption_cache(self) -> Optional[CaptionCache]:
+        return self.caption_reuse.cache
+
+    def cache_config(self) -> str:
+        """Key of everything besides the image that decides a caption, see `CaptionCache`."""
+        generation_config = (
+            getattr(self, "generation_config", None)
+            or self.model.generation_config
+        )
+        return content_key(
+            self.name,
+            self.checkpoint,
+            self.prompt or "",
+            generation_config.to_json_string(use_diff=True),
+            str(getattr(self, "max_new_tokens", "")),
+        )
+
+    def apply_caption_cache(self, images: ImageSource) -> set[str]:
+        """
+        Caption the images found in `caption_cache` (within its Hamming distance) without
+        running the model (they are written when prediction starts), and group the others
+        by near-duplicates, so that only the first image of each group is captioned; the
+        others get its caption when it is saved. Images in `self.completed` are left out.
+        The order of `images` is kept for the skipped images, see `final_order`.
+        Args:
+            images (ImageSource): The images of the dataset, see `data.list_images`.
+        Returns:
+            set[str]: Filenames the model does not need to caption, pass them (with
+                `self.completed`) to the dataset's `skip`.
+        """
+        config = (
+            self.cache_config() if self.caption_cache is not None else None
+        )
+        return self.caption_reuse.apply(
+            list_images(images), self.completed, config
+        )
+
+    def _save_cached(self) -> None:
+        """Write the captions found by `apply_caption_cache`, from rank 0 only."""
+        hits = self.caption_reuse.take_hits()
+        if hits and self.global_rank == 0:
+            self._save(list(hits), list(hits.values()))
+
+    def set_output_order(self, filenames: Sequence[str]) -> None:
+        """
+        Write the final .json and .tsv files in this order, e.g. the dataset order when
+        a sampler reorders the batches (the .jsonl file keeps the order captions were generated in).
+        """
+        self.output_order = {
+            filename: i for i, filename in enumerate(filenames)
+        }
+
+    def final_order(self) -> Optional[dict[str, int]]:
+        """
+        Position of every filename that can be written, from `set_output_order`, None if it
+        was not called. Images left out of the dataset by `apply_caption_cache` (cache hits
+        and near-duplicates) follow the image before them in the images it was given, and
+        captions of earlier runs (`self.completed`) not among them come first.
+        """
+        return self.caption_reuse.order(self.output_order, self.completed)
+
+    def finalize_outputs(self) -> None:
+        """Flush all sinks and write the legacy .json file."""
+        order = self.final_order()
+        for sink in self.sinks:
+            sink.finalize(order)
+
+    def setup(self, stage: str) -> None:
+        # Every rank writes its own shard files, merged by rank 0 in `on_predict_end`
+        if stage == "predict" and self.trainer.world_size > 1:
+            index, count = self.job_shard or (0, 1)
+            world_size = self.trainer.world_size
+            self.use_shard(
+                index * world_size + self.global_rank, count * world_size
+            )
+
+    def on_predict_start(self) -> None:
+        self._save_cached()
+
+    def on_predict_batch_start(
+        self, batch: Any, batch_idx: int, dataloader_idx: int = 0
+    ) -> None:
+        self.instrumentation.start_batch()
+
+    def on_predict_batch_end(
+        self, outputs: Any, batch: Any, batch_idx: int, dataloader_idx: int = 0
+    ) -> None:
+        metrics = self.instrumentation.end_batch()
+        # `self.log` is not supported in predict, write to the logger directly
+        if self._trainer is not None and self.logger is not None:
+            self.logger.log_metrics(metrics, step=batch_idx)
+
+    def metrics_file(self) -> Path:
+        """
+        Where `on_predict_end` writes the throughput summary: `throughput.json` in the
+        logger's `lightning_logs/version_*` folder, else next to `out_file` (one per rank on several devices).
+        """
+        log_dir = (
+            getattr(self.logger, "log_dir", None)
+            if self._trainer is not None
+            else None
+        )
+        world_size = self.trainer.world_size if self._trainer is not None else 1
+        if log_dir is None:
+            if world_size > 1:
+                return self.out_file.with_suffix(
+                    f".rank{self.global_rank}.metrics.json"
+                )
+            return self.out_file.with_suffix(".metrics.json")
+        if world_size > 1:
+            return Path(log_dir) / f"throughput.rank{self.global_rank}.json"
+        return Path(log_dir) / "throughput.json"
+
+    def on_predict_end(self) -> None:
+        self.finalize_outputs()
+        if (
+            self.job_shard is None
+            and self._trainer is not None
+            and self.trainer.world_size > 1
+        ):
+            self.trainer.strategy.barrier("merge_shards")
+            if self.global_rank == 0:
+                self.merge_shards()
+        self.instrumentation.write_summary(
+            self.metrics_file(), {"hyperparameters": dict(self.hparams)}
+        )
+
+    def transfer(self, batch: Any) -> Any:
+        """Run the batch transfer hooks, as `Trainer.predict` does before `predict_step`."""
+        batch = self.on_before_batch_transfer(batch, 0)
+        batch = self.transfer_batch_to_device(batch, self.device, 0)
+        return self.on_after_batch_transfer(batch, 0)
+
+    def _text_tokenizer(self) -> Any:
+        tokenizer = getattr(self, "tokenizer", None) or self.processor
+        return getattr(tokenizer, "tokenizer", tokenizer)
+
+    def split_batch(
+        self, batch: tuple[str | list[str], Mapping[str, Tensor]]
+    ) -> list[tuple[str, dict[str, Tensor]]]:
+        """
+        Split a batch of model inputs into single samples for `ContinuousBatcher`,
+        removing the padding of `input_ids` and `attention_mask`.
+        """
+        filenames, inputs = batch
+        if isinstance(filenames, str):
+            filenames = [filenames]
+        mask = inputs["attention_mask"].bool()
+        samples = []
+        for i, filename in enumerate(filenames):
+            sample: dict[str, Tensor] = {}
+            for key, value in inputs.items():
+                if key in sequence_keys:
+                    value = value[i : i + 1, mask[i]]
+                elif value.ndim and value.shape[0] == len(filenames):
+                    value = value[i : i + 1]
+                sample[key] = value
+            samples.append((filename, sample))
+        return samples
+
+    def predict_continuous(
+        self,
+        dataloader: Iterable,
+        max_active: int = 32,
+        admit_size: int = 1,
+    ) -> list[str]:
+        """
+        Alternative to `Trainer.predict` for decoder-only models: decode with a fixed pool
+        of `max_active` sequences, see `ContinuousBatcher`. A caption is written as soon as it
+        is finished and its slot is given to the next sample of the dataloader, so a batch no
+        longer waits for its longest caption. Runs in this process on `self.device`, move the
+        model first (e.g. `model.to("cuda")`). Output files are finalized at the end, in the
+        order set by `set_output_order`.
+
+        Models without `continuous_batching` (encoder-decoder models such as Blip2) fall back
+        to `predict_step` on every batch of the dataloader.
+        Args:
+            dataloader (Iterable): Batches as for `Trainer.predict`, their size only sets how many
+                samples are prepared at once.
+            max_active (int, optional): Number of sequences decoded together. Defaults to 32.
+            admit_size (int, optional): Free slots to wait for before prefilling new samples. Defaults to 1.
+        Returns:
+            list[str]: The captions, in the order they were finished.
+        """
+        self._save_cached()
+        batches = (self.transfer(batch) for batch in dataloader)
+        captions: list[str] = []
+        if not self.continuous_batching:
+            logger.warning(
+                f"{self.name} does not support continuous batching, generating static batches"
+            )
+            with torch.no_grad():
+                for batch_idx, batch in enumerate(batches):
+                    self.instrumentation.start_batch()
+                    captions += self.predict_step(batch, batch_idx)
+                    self.instrumentation.end_batch()
+            self.on_predict_end()
+            return captions
+        tokenizer = self._text_tokenizer()
+        generation_config = (
+            getattr(self, "generation_config", None)
+            or self.model.generation_config
+        )
+        if generation_config.do_sample:
+            raise ValueError(
+                "Continuous batching only supports greedy decoding (do_sample=False)"
             )
-        with open(self.json_file, "w") as f:
-            json.dump(cur_json, f, indent=2)
+        batcher = ContinuousBatcher(
+            self.model,
+            max_active=max_active,
+            max_new_tokens=self.max_new_tokens,
+            eos_token_id=generation_config.eos_token_id
+            or tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id or 0,
+            admit_size=admit_size,
+            prefix_cache=getattr(self, "prefix_cache", None),
+            forward_kwargs=self.forward_kwargs,
+            step_inputs=self.step_inputs,
+        )
+        instrumentation = self.instrumentation
+
+        def requests():
+            for batch in batches:
+                _, inputs = batch
+                instrumentation.count_inputs(
+                    inputs["input_ids"], inputs["attention_mask"]
+                )
+                yield from self.split_batch(batch)
+
+        # The whole run is one "batch" of the instrumentation, its decode time includes
+        # the prefills and the writing of the captions
+        instrumentation.start_batch()
+        with instrumentation.stage("decode"):
+            for filename, tokens in batcher.run(requests()):
+                instrumentation.count_outputs(len(tokens))
+                caption = tokenizer.decode(
+                    tokens,
+                    skip_special_tokens=True,
+                    clean_up_tokenization_spaces=False,
+                )
+                self._save([str(filename)], [caption])
+                captions.append(caption)
+        instrumentation.end_batch()
+        self.on_predict_end()
+        return captions
 
 
 class Ensemble(Model):
@@ -104,3 +477,14 @@ class Ensemble(Model):
             hyperparameters={"in_files": [str(f) for f in self.in_files]},
             **kwargs,
         )
+
+    def collate_captions(
+        self, filenames: list[str], captions: Sequence[Sequence[str]]
+    ) -> Any:
+        """
+        Batch for `predict_step` from the captions of each image (one per ensembled model),
+        used when the captions come straight from the models, see `pipeline.CaptionPipeline`.
+        """
+        raise NotImplementedError(
+            f"{self.name} does not take captions directly"
+        )
@@ -1,13 +1,16 @@
 import logging
 from PIL import Image
 from pathlib import Path
-from typing import cast
-from collections.abc import Sequence
+from typing import cast, Optional
+from collections.abc import Collection, Sequence
 import torch
 from transformers.models.blip import BlipProcessor, BlipForConditionalGeneration
 import pytorch_lightning as pl
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import DataLoader
 from .base import Model
+from ..processors import get_processor
+from ..data import ImageSource
+from ..preprocessing import ProcessedImageDataset
 
 logger = logging.getLogger(__name__)
 
@@ -19,8 +22,8 @@ class BlipPL(Model):
         super().__init__(*args, **kwargs)
         self.processor = cast(
             BlipProcessor,
-            BlipProcessor.from_pretrained(
-                self.checkpoint
+            get_processor(
+                self.checkpoint, BlipProcessor
             ),
         )
         self.model = BlipForConditionalGeneration.from_pretrained(
@@ -33,41 +36,49 @@ class BlipPL(Model):
         batch_idx
     ) -> str | list[str]:
         filenames, images = batch
-        out = self.model.generate(**images)
-        captions = self.processor.batch_decode(out, skip_special_tokens=True)
-        if self.out_file:
-            with open(self.out_file, "a") as f:
-                for fname, c in zip(filenames, captions):
-                    print(f'{fname}\t{c}', file=f)
+        self.instrumentation.count_batch(len(filenames))
+        with self.instrumentation.generation() as stopping_criteria:
+            out = self.model.generate(**images, stopping_criteria=stopping_criteria)
+        self.instrumentation.count_outputs(
+            out, self.processor.tokenizer.pad_token_id
+        )
+        with self.instrumentation.stage("batch_decode"):
+            captions = self.processor.batch_decode(out, skip_special_tokens=True)
+        self._save(filenames, captions)
         return captions
 
-class ImageDatasetBlip(Dataset):
-    def __init__(self, images: dict[str, Image.Image]):
-        filenames, _images = zip(*images.items())
-        self.filenames: list[str] = list(filenames)
-        self.images: list[Image.Image] = list(_images)
-        self.processor: BlipProcessor = BlipProcessor.from_pretrained(
-            "Salesforce/blip-image-captioning-base"
-        )  # type: ignore
-        self.processor.tokenizer.padding_side = "left"  # type: ignore
+class ImageDatasetBlip(ProcessedImageDataset):
+    checkpoint = "Salesforce/blip-image-captioning-base"
+    processor_class = BlipProcessor
+    processor_kwargs = {"padding_side": "left"}
 
-    def __len__(self):
-        return len(self.images)
+    def __init__(
+        self,
+        images: ImageSource,
+        skip: Optional[Collection[str]] = None,
+        cache_dir: Optional[str | Path] = None,
+    ):
+        super().__init__(images, skip, cache_dir)
 
-    def __getitem__(self, idx: int|slice) -> tuple[str|list[str], dict[str, torch.Tensor]]:
-        captions = self.filenames[idx]
-        images = self.images[idx]
-        images = self.processor(
+    def process(self, images, prompts):
+        return self.processor(
             images=images, padding=True, return_tensors="pt"
         )
+
+    def __getitem__(self, idx: int|slice|list[int]) -> tuple[str|list[str], dict[str, torch.Tensor]]:
+        captions, images = super().__getitem__(idx)
         images = {
             k: v.squeeze() for k, v in images.items()
         }  # here, squeezing was needed
         return captions, images
 
+    def from_images(self, filenames, images):
+        filenames, inputs = super().from_images(filenames, images)
+        return filenames, {k: v.squeeze() for k, v in inputs.items()}
+
 
 class CaptionDataModuleBlip(pl.LightningDataModule):
-    def __init__(self, images: dict[str, Image.Image]):
+    def __init__(self, images: ImageSource):
         super().__init__()
         self.dataset = ImageDatasetBlip(images)
 
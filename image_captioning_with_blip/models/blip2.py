@@ -9,8 +9,10 @@ from transformers.models.blip_2 import (
     Blip2ForConditionalGeneration,
 )
 import pytorch_lightning as pl
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import DataLoader
 from .base import Model
+from ..processors import get_processor
+from ..data import ImageFolderDataset, ImageSource
 from torchvision import transforms
 
 logger = logging.getLogger(__name__)
@@ -29,17 +31,33 @@ This image depicts a scene from an Indian movie. In the scene,"""
 
         self.processor = cast(
             Blip2Processor,
-            Blip2Processor.from_pretrained(self.checkpoint),
+            get_processor(
+                self.checkpoint, Blip2Processor, padding_side="left"
+            ),
         )
-        self.processor.tokenizer.padding_side = "left"  # type: ignore
         self.model = Blip2ForConditionalGeneration.from_pretrained(
             self.checkpoint
         )
 
     def predict_step(self, batch, batch_idx) -> str | list[str]:
         filenames, images = batch
-        out = self.model.generate(**images)
-        captions = self.processor.batch_decode(out, skip_special_tokens=True)
+        if "input_ids" in images:
+            self.instrumentation.count_inputs(
+                images["input_ids"], images.get("attention_mask")
+            )
+        else:
+            self.instrumentation.count_batch(len(filenames))
+        with self.instrumentation.generation() as stopping_criteria:
+            out = self.model.generate(
+                **images, stopping_criteria=stopping_criteria
+            )
+        self.instrumentation.count_outputs(
+            out, self.processor.tokenizer.pad_token_id
+        )
+        with self.instrumentation.stage("batch_decode"):
+            captions = self.processor.batch_decode(
+                out, skip_special_tokens=True
+            )
         self._save(filenames, captions)
         return captions
 
@@ -47,47 +65,44 @@ This image depicts a scene from an Indian movie. In the scene,"""
         self, batch: tuple[Sequence[str], list[Tensor]], dataloader_idx: int
     ) -> tuple[Sequence[str], dict[str, Tensor]]:
         filenames, images = batch
-        if self.prompt:
-            images = self.processor(
-                images=images,
-                text=[self.prompt] * len(images),
-                padding=True,
-                return_tensors="pt",
-                do_rescale=False,
-            )
-        else:
-            images = self.processor(
-                images=images,
-                padding=True,
-                return_tensors="pt",
-                do_rescale=False,
-            )
+        with self.instrumentation.stage("preprocess"):
+            if self.prompt:
+                images = self.processor(
+                    images=images,
+                    text=[self.prompt] * len(images),
+                    padding=True,
+                    return_tensors="pt",
+                    do_rescale=False,
+                )
+            else:
+                images = self.processor(
+                    images=images,
+                    padding=True,
+                    return_tensors="pt",
+                    do_rescale=False,
+                )
         images = {k: v.squeeze() for k, v in images.items()}
         return filenames, images
 
 
-class ImageDataset(Dataset):
-    def __init__(self, images: dict[str, Image.Image]):
-        filenames, _images = zip(*images.items())
-        self.filenames: list[str] = list(filenames)
-        self.images: list[Tensor] = [
-            transforms.ToTensor()(img) for img in _images
-        ]
-
-    def __len__(self):
-        return len(self.images)
-
+class ImageDataset(ImageFolderDataset):
     def __getitem__(
-        self, idx: int | slice
+        self, idx: int | slice | list[int]
     ) -> tuple[str | list[str], Tensor | list[Tensor]]:
-        captions = self.filenames[idx]
-        images = self.images[idx]
+        captions = self.get_filenames(idx)
+        images = self.get_images(idx)
+        if isinstance(images, list):
+            return captions, [transforms.ToTensor()(img) for img in images]
+        return captions, transforms.ToTensor()(images)
 
-        return captions, images
+    def from_images(
+        self, filenames: list[str], images: list[Image.Image]
+    ) -> tuple[list[str], list[Tensor]]:
+        return filenames, [transforms.ToTensor()(img) for img in images]
 
 
 class CaptionDataModule(pl.LightningDataModule):
-    def __init__(self, images: dict[str, Image.Image]):
+    def __init__(self, images: ImageSource):
         super().__init__()
         self.dataset = ImageDataset(images)
 
@@ -2,75 +2,80 @@ from PIL import Image
 import soundfile as sf
 from transformers import AutoModelForCausalLM, AutoProcessor, GenerationConfig  # type: ignore
 from .base import Model
+from ..processors import get_processor
+from ..prefix_cache import PrefixCache
+from ..data import ImageSource
+from ..preprocessing import ProcessedImageDataset
 from torch import Tensor
-from torch.utils.data import Dataset
 from torchvision import transforms
+from collections.abc import Collection
+from typing import Optional
+from pathlib import Path
 
 checkpoint = "microsoft/Phi-4-multimodal-instruct"
 
 
-class PhiImageDataset(Dataset):
+class PhiImageDataset(ProcessedImageDataset):
     checkpoint = checkpoint
-    prompt = """<|user|><|image_1|>This image depicts a scene from an Indian movie.
+    processor_kwargs = {"trust_remote_code": True}
+    # Prompt attempt 2: the instructions of attempt 1, moved before the image tag so that
+    # `PrefixCache` can share them (attempt 1 started with "<|user|><|image_1|>")
+    prompt = """<|user|>This image depicts a scene from an Indian movie.
 Do not attempt to guess the name of the movie, or comment on the fact that it is a movie.
 Describe the scene in detail, including the characters, their actions and clothing, and the setting:
-<|end|><|assistant|>"""
+<|image_1|><|end|><|assistant|>"""
 
-    def __init__(self, images: dict[str, Image.Image]):
-        filenames, _images = zip(*images.items())
-        self.filenames: list[str] = list(filenames)
-        self.images: list[Image.Image] = list(_images)
-        self.processor = AutoProcessor.from_pretrained(
-            self.checkpoint, trust_remote_code=True
-        )
+    def __init__(
+        self,
+        images: ImageSource,
+        skip: Optional[Collection[str]] = None,
+        cache_dir: Optional[str | Path] = None,
+    ):
+        """
+        Args:
+            images (ImageSource): Directory, manifest file or list of image paths, see `data.list_images`.
+            skip (Collection[str], optional): Filenames to leave out, e.g. `Model.completed` when resuming.
+            cache_dir (str | Path, optional): Preprocessing cache, see `ProcessedImageDataset`. Defaults to None.
+        """
+        super().__init__(images, skip, cache_dir)
 
-    def __len__(self):
-        return len(self.images)
-
-    def __getitem__(
-        self, idx: int | slice | list[int]
-    ) -> tuple[str | list[str], Tensor | list[Tensor]]:
-        filenames = (
-            [self.filenames[i] for i in idx]
-            if isinstance(idx, list)
-            else self.filenames[idx]
-        )
-        images = (
-            [self.images[i] for i in idx]
-            if isinstance(idx, list)
-            else self.images[idx]
-        )
-        prompts = (
-            [self.prompt] * len(images)
-            if isinstance(images, list)
-            else self.prompt
-        )
-        images = self.processor(
-            images=images,
-            text=prompts,
-            padding=True,
-            truncation=True,
-            return_tensors="pt",
-        )
-        return filenames, images
+    def get_prompt(self, idx: int) -> str:
+        return self.prompt
 
 
 class Phi4PL(Model):
     name = "Phi4"
     checkpoint = checkpoint
     prompt = PhiImageDataset.prompt
-    # Prompt attempt 1
+    continuous_batching = True
+    forward_kwargs = {"num_logits_to_keep": 1}
+    # Selects the vision LoRA adapter on every forward call
+    step_inputs = ("input_mode",)
+    # Prompt attempt 2
 
-    def __init__(self, *args, temperature: float = 0.0, **kwargs):
+    def __init__(
+        self,
+        *args,
+        temperature: float = 0.0,
+        prefix_cache: bool = False,
+        attn_implementation: str = "flash_attention_2",
+        **kwargs,
+    ):
+        """
+        Args:
+            prefix_cache (bool, optional): Reuse the keys/values of the prompt text before the
+                image tag (the instructions) for every batch, see `PrefixCache`. Only text before
+                `<|image_1|>` can be shared, everything after it attends to the image. Defaults to False.
+            attn_implementation (str, optional): Attention kernel of the model, "eager" or "sdpa" on GPUs
+                older than Ampere or on CPU. Defaults to "flash_attention_2".
+        """
         super().__init__(*args, **kwargs)
-        self.processor = AutoProcessor.from_pretrained(
-            self.checkpoint, trust_remote_code=True
-        )
+        self.processor = get_processor(self.checkpoint, trust_remote_code=True)
         self.model = AutoModelForCausalLM.from_pretrained(
             self.checkpoint,
             torch_dtype="auto",
             trust_remote_code=True,
-            _attn_implementation="flash_attention_2",
+            _attn_implementation=attn_implementation,
         )
         # if you do not use Ampere or later GPUs, change attention to "eager"
         self.generation_config = GenerationConfig.from_pretrained(
@@ -78,18 +83,55 @@ class Phi4PL(Model):
         )  # ! temperature might be a bad choice to change, default is 1.0
         # (do_sample sets temperature to 0 in effect, and a warning is produced otherwise)
         self.max_new_tokens = 1024
+        self.prefix_cache = (
+            PrefixCache.from_text(
+                self.processor.tokenizer, self.prompt.split("<|image_1|>")[0]
+            )
+            if prefix_cache
+            else None
+        )
 
     def predict_step(self, batch, batch_idx) -> str | list[str]:
         filenames, images = batch
-        out = self.model.generate(
-            **images,
-            max_new_tokens=self.max_new_tokens,
-            generation_config=self.generation_config,
-            num_logits_to_keep=1,  # ! Won't work if not set, might really need a different number I don't know
-        )
-        out = out[:, images["input_ids"].shape[1] :]
-        captions = self.processor.batch_decode(
-            out, skip_special_tokens=True, clean_up_tokenization_spaces=False
+        pad_token_id = self.processor.tokenizer.pad_token_id or 0
+        self.instrumentation.count_inputs(
+            images["input_ids"], images["attention_mask"]
         )
+        with self.instrumentation.generation() as stopping_criteria:
+            if self.prefix_cache is not None:
+                out = self.prefix_cache.generate(
+                    self.model,
+                    images["input_ids"],
+                    images["attention_mask"],
+                    pad_token_id=pad_token_id,
+                    prefix_inputs={
+                        k: images[k] for k in self.step_inputs if k in images
+                    },
+                    **{
+                        k: v
+                        for k, v in images.items()
+                        if k not in ("input_ids", "attention_mask")
+                    },
+                    max_new_tokens=self.max_new_tokens,
+                    generation_config=self.generation_config,
+                    stopping_criteria=stopping_criteria,
+                    **self.forward_kwargs,
+                )
+            else:
+                out = self.model.generate(
+                    **images,
+                    max_new_tokens=self.max_new_tokens,
+                    generation_config=self.generation_config,
+                    stopping_criteria=stopping_criteria,
+                    **self.forward_kwargs,  # ! Won't work without num_logits_to_keep, might really need a different number I don't know
+                )
+                out = out[:, images["input_ids"].shape[1] :]
+        self.instrumentation.count_outputs(out, pad_token_id)
+        with self.instrumentation.stage("batch_decode"):
+            captions = self.processor.batch_decode(
+                out,
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=False,
+            )
         self._save(filenames, captions)
         return captions
@@ -1,11 +1,20 @@
 from pathlib import Path
-from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationConfig  # type: ignore
+from transformers import AutoModelForCausalLM, AutoTokenizer, BatchEncoding, GenerationConfig  # type: ignore
 from .base import Ensemble
+from ..processors import get_tokenizer
+from ..prefix_cache import PrefixCache
+from ..captions import read_captions
+from ..compaction import compact_captions
+from ..preprocessing import file_hash
+from ..utils.array_store import ArrayStore, content_key
+import json
+import numpy as np
 import torch
 from torch import Tensor
 from torch.utils.data import Dataset
 import pandas as pd
-from typing import Sequence
+from typing import Sequence, Optional
+from collections.abc import Collection
 import logging
 
 logger = logging.getLogger(__name__)
@@ -19,34 +28,188 @@ Only include information supported by 2 or more captions, do not repeat informat
 """
 
 
+def format_prompt(
+    tokenizer,
+    prompt: str,
+    captions: Sequence[str],
+    compact: bool = True,
+    caption_tokens: Optional[int] = 512,
+) -> str:
+    """
+    Chat-formatted summarization prompt for the captions of one image, in model order.
+    Args:
+        tokenizer: Tokenizer with the chat template.
+        prompt (str): Prompt with a `{captions}` field.
+        captions (Sequence[str]): Caption of each model.
+        compact (bool, optional): Drop repeated sentences and fit the captions to `caption_tokens`,
+            see `compact_captions`. If False, each caption is cut at 1000 characters. Defaults to True.
+        caption_tokens (int, optional): Token budget of all captions together. Defaults to 512.
+    """
+    if compact:
+        captions = compact_captions(captions, tokenizer, caption_tokens)
+    else:
+        captions = [caption[:1000] for caption in captions]
+    numbered = "\n".join(
+        f"{i}. {caption.replace('\n', ' ')}"
+        for i, caption in enumerate(captions)
+    )
+    messages = [
+        {"role": "user", "content": f"{prompt.format(captions=numbered)}"},
+    ]
+    return tokenizer.apply_chat_template(
+        messages,
+        tokenize=False,
+        add_generation_prompt=True,
+    )
+
+
 class PhiEnsembleDataset(Dataset):
     checkpoint = checkpoint
     prompt = system_prompt
 
-    def __init__(self, in_files: Sequence[Path | str]):
+    def __init__(
+        self,
+        in_files: Sequence[Path | str],
+        skip: Optional[Collection[str]] = None,
+        compact: bool = True,
+        caption_tokens: Optional[int] = 512,
+        cache_dir: Optional[str | Path] = None,
+    ):
+        """
+        Args:
+            in_files (Sequence[Path | str]): Caption files of the models to ensemble, in any format `read_captions` supports.
+            skip (Collection[str], optional): Filenames to leave out, e.g. `Model.completed` when resuming.
+            compact (bool, optional): Compact the captions in the prompts, see `format_prompt`. Defaults to True.
+            caption_tokens (int, optional): Token budget of the captions of a prompt. Defaults to 512.
+            cache_dir (str | Path, optional): Cache of the tokenized prompts, see `precompute`.
+                Defaults to None (prompts are built and tokenized in every batch).
+        """
+        self.compact = compact
+        self.caption_tokens = caption_tokens
+        self.store = ArrayStore(cache_dir) if cache_dir is not None else None
+        self._tokens: Optional[dict[str, np.ndarray]] = None
+        self._key: Optional[str] = None
         self.in_files: list[str] = [str(f) for f in in_files]
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            self.checkpoint, trust_remote_code=True
-        )
         self.frames: dict[str, pd.DataFrame] = dict()
         for f in self.in_files:
-            if Path(f).suffix == ".tsv":
-                self.frames[f] = pd.read_csv(
-                    f, sep="\t", header=None, names=["filename", "caption"]
-                )
-            elif Path(f).suffix == ".json":
-                self.frames[f] = pd.read_json(f)
-            elif Path(f).suffix == ".csv":
-                self.frames[f] = pd.read_csv(f, names=["filename", "caption"])
-            else:
-                raise ValueError(f"Unsupported file format: {Path(f).suffix}")
+            self.frames[f] = read_captions(f).reset_index()
+            if skip:
+                self.frames[f] = self.frames[f][
+                    ~self.frames[f]["filename"].isin(skip)
+                ]
             self.frames[f] = (
                 self.frames[f].sort_values("filename").reset_index(drop=True)
             )
 
+    def __getstate__(self):
+        # Workers map the cached tokens themselves instead of receiving a copy
+        state = self.__dict__.copy()
+        state["_tokens"] = None
+        return state
+
+    @property
+    def tokenizer(self):
+        # Shared and loaded lazily, so it is not pickled into the DataLoader workers
+        return get_tokenizer(self.checkpoint, trust_remote_code=True)
+
     def __len__(self):
         return len(self.frames[self.in_files[0]])
 
+    def get_prompts(self, idx: list[int]) -> list[str]:
+        """Chat-formatted summarization prompts of the given rows."""
+        captions_batch: list[pd.Series[str]] = [
+            frame.loc[idx, "caption"] for frame in (self.frames.values())
+        ]
+        return [
+            format_prompt(
+                self.tokenizer,
+                self.prompt,
+                captions,
+                self.compact,
+                self.caption_tokens,
+            )
+            for captions in zip(*captions_batch)
+        ]
+
+    def cache_key(self) -> str:
+        """
+        Key of the tokenized prompts: hashes of the caption files, the rows, the checkpoint,
+        the tokenizer (class, source, chat template and truncation length), the prompt and
+        the compaction settings.
+        """
+        if self._key is None:
+            tokenizer = self.tokenizer
+            self._key = content_key(
+                *(file_hash(f) for f in self.in_files),
+                "\n".join(self.filenames),
+                self.checkpoint,
+                type(tokenizer).__name__,
+                tokenizer.name_or_path,
+                str(tokenizer.chat_template or ""),
+                str(tokenizer.model_max_length),
+                self.prompt,
+                json.dumps([self.compact, self.caption_tokens]),
+            )
+        return self._key
+
+    def precompute(self) -> bool:
+        """
+        Build and tokenize every prompt once, with the tokenizer's batch path, and keep the
+        token ids in the cache (one flat array and row offsets). Batches are then sliced
+        from the cache and padded, without building or tokenizing any prompt. A run with the
+        same caption files, rows, tokenizer and prompt settings reuses the cache.
+        Returns:
+            bool: Whether the prompts were tokenized (False if they were cached).
+        """
+        if self.store is None:
+            raise ValueError("precompute needs a cache_dir")
+        key = self.cache_key()
+        computed = key not in self.store
+        if computed:
+            logger.info(f"Tokenizing {len(self)} ensemble prompts")
+            ids = self.tokenizer(
+                self.get_prompts(list(range(len(self)))), truncation=True
+            )["input_ids"]
+            offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+            np.cumsum([len(row) for row in ids], out=offsets[1:])
+            self.store.put(
+                key,
+                {
+                    "input_ids": np.fromiter(
+                        (t for row in ids for t in row),
+                        dtype=np.int32,
+                        count=int(offsets[-1]),
+                    ),
+                    "offsets": offsets,
+                },
+            )
+        self._tokens = self.store.get(key)
+        return computed
+
+    @property
+    def tokens(self) -> Optional[dict[str, np.ndarray]]:
+        """Cached token ids (`input_ids` and row `offsets`), None if not precomputed."""
+        if self._tokens is None and self.store is not None:
+            key = self.cache_key()
+            if key in self.store:
+                self._tokens = self.store.get(key)
+        return self._tokens
+
+    def prompt_lengths(self) -> list[int]:
+        """Number of prompt tokens of every row, e.g. for `samplers.TokenBudgetBatchSampler`."""
+        if self.tokens is not None:
+            return np.diff(self.tokens["offsets"]).tolist()
+        return [
+            len(ids)
+            for ids in self.tokenizer(
+                self.get_prompts(list(range(len(self)))), truncation=True
+            )["input_ids"]
+        ]
+
+    @property
+    def filenames(self) -> list[str]:
+        return list(self.frames.values())[0]["filename"].tolist()
+
     def __getitem__(
         self, idx: int | slice | list[int]
     ) -> tuple[list[str], dict[str, Tensor]]:
@@ -56,35 +219,9 @@ class PhiEnsembleDataset(Dataset):
         filenames_batch = (
             list(self.frames.values())[0]["filename"].loc[idx].tolist()
         )
-        captions_batch: list[pd.Series[str]] = [
-            frame.loc[idx, "caption"] for frame in (self.frames.values())
-        ]
-        messages_batch: list[dict[str, Tensor]] = []
-        captions: tuple[str, ...]
-        for captions in zip(*captions_batch):
-            messages: list[dict[str, str]]
-            captions = tuple(
-                (
-                    f"{i}. {caption[:1000].replace('\n', ' ')}"
-                    for i, caption in enumerate(captions)
-                )
-            )
-            messages = [
-                {
-                    "role": "user",
-                    "content": f"{self.prompt.format(captions='\n'.join(captions))}",
-                },
-            ]
-            # messages_batch.append(messages)
-            messages_batch.append(
-                self.tokenizer.apply_chat_template(
-                    messages,
-                    # return_dict=True,
-                    tokenize=False,
-                    add_generation_prompt=True,
-                )
-            )
-            # print(messages_batch[-1][list(messages_batch[-1].keys())[0]].shape)
+        if self.tokens is not None:
+            return filenames_batch, self._pad(idx)
+        messages_batch = self.get_prompts(idx)
         logger.info("Finished messages batch")
         # messages_dict = self.tokenizer.apply_chat_template(
         #     messages_batch,
@@ -94,10 +231,6 @@ class PhiEnsembleDataset(Dataset):
         #     padding=True,
         #     truncation=True,
         # )
-        logger.debug(
-            f"{type(messages_batch) = }\n{type(messages_batch[0]) = }"
-        )
-        logger.debug(f"\n{messages_batch}")
         messages_dict = self.tokenizer(
             messages_batch,
             return_tensors="pt",
@@ -107,19 +240,56 @@ class PhiEnsembleDataset(Dataset):
         logger.info("Finished tokenization")
         return filenames_batch, messages_dict
 
+    def _pad(self, idx: list[int]) -> BatchEncoding:
+        """Batch of cached prompts, padded as the tokenizer pads."""
+        assert self.tokens is not None
+        ids, offsets = self.tokens["input_ids"], self.tokens["offsets"]
+        rows = [ids[offsets[i] : offsets[i + 1]] for i in idx]
+        length = max(len(row) for row in rows)
+        input_ids = np.full(
+            (len(rows), length), self.tokenizer.pad_token_id or 0, np.int64
+        )
+        attention_mask = np.zeros((len(rows), length), np.int64)
+        left = self.tokenizer.padding_side == "left"
+        for i, row in enumerate(rows):
+            span = slice(length - len(row), None) if left else slice(len(row))
+            input_ids[i, span] = row
+            attention_mask[i, span] = 1
+        return BatchEncoding(
+            {"input_ids": input_ids, "attention_mask": attention_mask},
+            tensor_type="pt",
+        )
+
 
 class PhiEnsemble(Ensemble):
     name = "Phi4Ensemble"
     checkpoint = checkpoint
     prompt = system_prompt
+    continuous_batching = True
 
     def __init__(
-        self, *args, temperature: float = 0.0, in_files: list[Path], **kwargs
+        self,
+        *args,
+        temperature: float = 0.0,
+        in_files: list[Path],
+        prefix_cache: bool = True,
+        compact: bool = True,
+        caption_tokens: Optional[int] = 512,
+        **kwargs,
     ):
+        """
+        Args:
+            in_files (list[Path]): Caption files of the models to ensemble.
+            prefix_cache (bool, optional): Compute the keys/values of the prompt text before
+                the captions once and reuse them for every batch, see `PrefixCache`. Defaults to True.
+            compact (bool, optional): Compact the captions given to `collate_captions`, as
+                `PhiEnsembleDataset` does, see `format_prompt`. Defaults to True.
+            caption_tokens (int, optional): Token budget of the captions of a prompt. Defaults to 512.
+        """
+        self.compact = compact
+        self.caption_tokens = caption_tokens
         super().__init__(*args, in_files=in_files, **kwargs)
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            self.checkpoint, trust_remote_code=True
-        )
+        self.tokenizer = get_tokenizer(self.checkpoint, trust_remote_code=True)
         self.model = AutoModelForCausalLM.from_pretrained(
             self.checkpoint,
             torch_dtype="auto",
@@ -132,6 +302,43 @@ class PhiEnsemble(Ensemble):
             do_sample=False,
         )  # ! temperature might be a bad choice to change, default is 1.0
         self.max_new_tokens = 1024
+        self.prefix_cache = (
+            PrefixCache.from_text(self.tokenizer, self.prompt_prefix())
+            if prefix_cache
+            else None
+        )
+
+    def prompt_prefix(self) -> str:
+        """The start of every chat-formatted prompt, up to the captions."""
+        marker = "\0captions\0"
+        return self.tokenizer.apply_chat_template(
+            [{"role": "user", "content": self.prompt.format(captions=marker)}],
+            tokenize=False,
+            add_generation_prompt=True,
+        ).split(marker)[0]
+
+    def collate_captions(
+        self, filenames: list[str], captions: Sequence[Sequence[str]]
+    ) -> tuple[list[str], dict[str, Tensor]]:
+        """
+        Batch for `predict_step` from the captions of each image (one per ensembled model,
+        in order), as `PhiEnsembleDataset` builds it from the caption files.
+        """
+        return filenames, self.tokenizer(
+            [
+                format_prompt(
+                    self.tokenizer,
+                    self.prompt,
+                    c,
+                    self.compact,
+                    self.caption_tokens,
+                )
+                for c in captions
+            ],
+            return_tensors="pt",
+            padding=True,
+            truncation=True,
+        )
 
     def predict_step(
         self, batch: tuple[list[str], dict[str, Tensor]], batch_idx
@@ -144,17 +351,38 @@ class PhiEnsemble(Ensemble):
         logger.debug(
             f"Length of batch = {len(filenames)}, {inputs['input_ids'].shape = }"
         )
-        out = self.model.generate(
-            **inputs,
-            max_new_tokens=self.max_new_tokens,
-            generation_config=self.generation_config,
-            # num_logits_to_keep=1,
+        pad_token_id = self.tokenizer.pad_token_id or 0
+        self.instrumentation.count_inputs(
+            inputs["input_ids"], inputs["attention_mask"]
         )
+        with self.instrumentation.generation() as stopping_criteria:
+            if self.prefix_cache is not None:
+                out = self.prefix_cache.generate(
+                    self.model,
+                    inputs["input_ids"],
+                    inputs["attention_mask"],
+                    pad_token_id=pad_token_id,
+                    max_new_tokens=self.max_new_tokens,
+                    generation_config=self.generation_config,
+                    stopping_criteria=stopping_criteria,
+                )
+            else:
+                out = self.model.generate(
+                    **inputs,
+                    max_new_tokens=self.max_new_tokens,
+                    generation_config=self.generation_config,
+                    stopping_criteria=stopping_criteria,
+                    # num_logits_to_keep=1,
+                )
+                out = out[:, inputs["input_ids"].shape[1] :]
         logger.info("Finished generation")
-        out = out[:, inputs["input_ids"].shape[1] :]
-        captions = self.tokenizer.batch_decode(
-            out, skip_special_tokens=True, clean_up_tokenization_spaces=False
-        )
+        self.instrumentation.count_outputs(out, pad_token_id)
+        with self.instrumentation.stage("batch_decode"):
+            captions = self.tokenizer.batch_decode(
+                out,
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=False,
+            )
         logger.debug(f"Output: {captions}")
         logger.info("Finished decoding")
         self._save(filenames, captions)
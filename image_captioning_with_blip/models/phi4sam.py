@@ -1,14 +1,19 @@
+import json
 from PIL import Image
 import soundfile as sf
 from transformers import AutoModelForCausalLM, AutoProcessor, GenerationConfig  # type: ignore
 from .base import Model
+from ..processors import get_processor
+from ..data import ImageSource, image_size
+from ..preprocessing import ProcessedImageDataset
+from ..descriptors import DescriptorStore
+from ..utils.array_store import content_key
 from torch import Tensor
-from torch.utils.data import Dataset
 from torchvision import transforms
 from pathlib import Path
-import pandas as pd
-import json
-from typing import TypedDict
+import numpy as np
+from typing import TypedDict, Optional
+from collections.abc import Collection
 from functools import partial
 
 checkpoint = "microsoft/Phi-4-multimodal-instruct"
@@ -44,7 +49,7 @@ def get_pos(pos: tuple[float, float], size: tuple[int, int]) -> str:
 
 
 def get_prompt_description(
-    image: Image.Image, descriptors: list[Descriptor]
+    image_size: tuple[int, int], descriptors: list[Descriptor]
 ) -> list[str]:
     descriptions = []
     for descriptor in descriptors:
@@ -54,14 +59,14 @@ def get_prompt_description(
             (rect_box[0] + rect_box[2]) / 2,
             (rect_box[1] + rect_box[3]) / 2,
         )
-        # width, height = image.size
-        pos = get_pos(centroid, image.size)
+        pos = get_pos(centroid, image_size)
         descriptions.append(f"{label} ({pos})")
     return descriptions
 
 
-class PhiSamImageDataset(Dataset):
+class PhiSamImageDataset(ProcessedImageDataset):
     checkpoint = checkpoint
+    processor_kwargs = {"trust_remote_code": True}
     prompt = """<|user|><|image_1|>This image depicts a scene from an Indian movie.
 Do not attempt to guess the name of the movie, or comment on the fact that it is a movie.
 The following objects have been identified in the image:
@@ -70,80 +75,88 @@ Describe the scene in detail, including the characters, their actions and clothi
 <|end|><|assistant|>"""
 
     def __init__(
-        self, images: dict[str, Image.Image], sam_outputs: str | Path
+        self,
+        images: ImageSource,
+        sam_outputs: str | Path,
+        skip: Optional[Collection[str]] = None,
+        cache_dir: Optional[str | Path] = None,
+        iou_threshold: Optional[float] = 0.7,
+        max_objects: Optional[int] = 8,
+        normalize_labels: bool = True,
     ):
         """Initialize the dataset with images and SAM outputs.
 
         Args:
-            images (dict[str, Image.Image]): Dictionary of image filenames and images.
+            images (ImageSource): Directory, manifest file or list of image paths, see `data.list_images`.
             sam_outputs (str | Path): Path to the SAM outputs file. (.tsv)
+            skip (Collection[str], optional): Filenames to leave out, e.g. `Model.completed` when resuming.
+            cache_dir (str | Path, optional): Preprocessing cache, see `ProcessedImageDataset`. Defaults to None.
+            iou_threshold (float, optional): Boxes overlapping a better box of the same image with a larger IoU
+                are left out of the prompt, see `DescriptorStore.select`. Defaults to 0.7 (None keeps them).
+            max_objects (int, optional): Number of objects in a prompt, the most confident first (then the
+                largest), see `DescriptorStore.select`. Defaults to 8 (None for all).
+            normalize_labels (bool, optional): Clean up the labels and drop repeated descriptions. Defaults to True.
         """
-        filenames, _images = zip(*images.items())
-        self.filenames: list[str] = list(filenames)
-        self.images: list[Image.Image] = list(_images)
-        self.processor = AutoProcessor.from_pretrained(
-            self.checkpoint, trust_remote_code=True
-        )
-        df = pd.read_csv(sam_outputs, sep="\t", index_col="image")
-        df["descriptor"] = df["descriptor"].apply(json.loads)
-        self.sam_outputs = [
-            get_prompt_description(image, descriptor)
-            for image, descriptor in zip(
-                self.images, df["descriptor"].loc[self.filenames]
-            )
-        ]
-
-    def __len__(self):
-        return len(self.images)
-
-    def __getitem__(
-        self, idx: int | list[int]
-    ) -> tuple[str | list[str], Tensor | list[Tensor]]:
-        filenames = (
-            [self.filenames[i] for i in idx]
-            if isinstance(idx, list)
-            else self.filenames[idx]
-        )
-        images = (
-            [self.images[i] for i in idx]
-            if isinstance(idx, list)
-            else self.images[idx]
+        super().__init__(images, skip, cache_dir)
+        # Only the image headers are read, for the sizes
+        sizes = np.array(
+            [image_size(path) for path in self.paths], dtype=np.int64
+        ).reshape(-1, 2)
+        self.sam_outputs = DescriptorStore.load(sam_outputs).describe(
+            self.filenames,
+            sizes,
+            iou_threshold=iou_threshold,
+            max_objects=max_objects,
+            normalize=normalize_labels,
         )
-        prompts = (
-            [
-                self.prompt.format(sam_outputs=", ".join(self.sam_outputs[i]))
-                for i in idx
-            ]
-            if isinstance(idx, list)
-            else self.prompt.format(
-                sam_outputs=", ".join(self.sam_outputs[idx]),
-            )
-        )
-        images = self.processor(
-            images=images,
-            text=prompts,
-            padding=True,
-            truncation=True,
-            return_tensors="pt",
-        )
-        return filenames, images
+
+    def get_prompt(self, idx: int) -> str:
+        return self.prompt.format(sam_outputs=", ".join(self.sam_outputs[idx]))
 
 
 class Phi4Sam(Model):
     name = "Phi4Sam"
     checkpoint = checkpoint
     prompt = PhiSamImageDataset.prompt
+    continuous_batching = True
+    forward_kwargs = {"num_logits_to_keep": 1}
+    # Selects the vision LoRA adapter on every forward call
+    step_inputs = ("input_mode",)
 
-    def __init__(self, *args, temperature: float = 0.0, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.processor = AutoProcessor.from_pretrained(
-            self.checkpoint, trust_remote_code=True
+    def __init__(
+        self,
+        *args,
+        temperature: float = 0.0,
+        attn_implementation: str = "flash_attention_2",
+        iou_threshold: Optional[float] = 0.7,
+        max_objects: Optional[int] = 8,
+        normalize_labels: bool = True,
+        **kwargs,
+    ):
+        """
+        Args:
+            attn_implementation (str, optional): Attention kernel of the model, "eager" or "sdpa" on GPUs
+                older than Ampere or on CPU. Defaults to "flash_attention_2".
+            iou_threshold, max_objects, normalize_labels: How the objects of the prompts are selected,
+                see `PhiSamImageDataset`, pass `descriptor_settings` to the dataset. Recorded in the
+                hyperparameters and in `cache_config`.
+        """
+        descriptor_settings = {
+            "iou_threshold": iou_threshold,
+            "max_objects": max_objects,
+            "normalize_labels": normalize_labels,
+        }
+        kwargs["hyperparameters"] = descriptor_settings | (
+            kwargs.get("hyperparameters") or {}
         )
+        super().__init__(*args, **kwargs)
+        self.descriptor_settings = descriptor_settings
+        self.processor = get_processor(self.checkpoint, trust_remote_code=True)
         self.model = AutoModelForCausalLM.from_pretrained(
             self.checkpoint,
             torch_dtype="auto",
             trust_remote_code=True,
-            _attn_implementation="flash_attention_2",
+            _attn_implementation=attn_implementation,
         )
         # if you do not use Ampere or later GPUs, change attention to "eager"
         self.generation_config = GenerationConfig.from_pretrained(
@@ -152,17 +165,35 @@ class Phi4Sam(Model):
         # (do_sample sets temperature to 0 in effect, and a warning is produced otherwise)
         self.max_new_tokens = 1024
 
+    def cache_config(self) -> str:
+        # The prompt of an image also depends on which of its objects are selected
+        return content_key(
+            super().cache_config(),
+            json.dumps(self.descriptor_settings, sort_keys=True),
+        )
+
     def predict_step(self, batch, batch_idx) -> str | list[str]:
         filenames, images = batch
-        out = self.model.generate(
-            **images,
-            max_new_tokens=self.max_new_tokens,
-            generation_config=self.generation_config,
-            num_logits_to_keep=1,
+        self.instrumentation.count_inputs(
+            images["input_ids"], images["attention_mask"]
         )
+        with self.instrumentation.generation() as stopping_criteria:
+            out = self.model.generate(
+                **images,
+                max_new_tokens=self.max_new_tokens,
+                generation_config=self.generation_config,
+                stopping_criteria=stopping_criteria,
+                **self.forward_kwargs,
+            )
         out = out[:, images["input_ids"].shape[1] :]
-        captions = self.processor.batch_decode(
-            out, skip_special_tokens=True, clean_up_tokenization_spaces=False
+        self.instrumentation.count_outputs(
+            out, self.processor.tokenizer.pad_token_id
         )
+        with self.instrumentation.stage("batch_decode"):
+            captions = self.processor.batch_decode(
+                out,
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=False,
+            )
         self._save(filenames, captions)
         return captions
@@ -0,0 +1,319 @@
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Collection, Sequence
+from pathlib import Path
+from typing import Any, Optional
+
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader
+
+from .captions import read_captions
+from .data import DecodedImageDataset, ImageFolderDataset, ImageSource
+from .models.base import Ensemble, Model
+
+logger = logging.getLogger(__name__)
+
+_done = object()  # end of stream on the queues
+
+
+class _Stopped(Exception):
+    """Another stage failed, the pipeline is shutting down."""
+
+
+class Captioner:
+    """A caption model, the dataset that prepares its inputs, and the device it runs on."""
+
+    def __init__(
+        self,
+        model: Model,
+        dataset: ImageFolderDataset,
+        device: Optional[str | torch.device] = None,
+    ):
+        """
+        Args:
+            model (Model): The caption model, its captions are also written to its own output files.
+            dataset (ImageFolderDataset): Dataset of the model over the same images, used for its
+                `from_images` (processor and prompts), it does not decode any image itself.
+            device (str | torch.device, optional): Device of the model. Captioners on the same device
+                run one after the other on each batch, captioners on different devices run in
+                parallel. Defaults to the model's current device.
+        """
+        self.model = model
+        self.dataset = dataset
+        self.device = torch.device(device) if device is not None else None
+
+    @property
+    def name(self) -> str:
+        return self.model.name
+
+
+class CaptionPipeline:
+    """
+    Captions a corpus with several models and summarizes their captions with an
+    ensemble model, in one pass over the images.
+
+    Each image is decoded once, in DataLoader workers, and the decoded batch is handed to
+    every captioner (see `Captioner`). Captions go straight to the ensemble model, which
+    summarizes an image as soon as every captioner is done with it, so no intermediate
+    caption file is read back. One thread runs per device, plus one for the ensemble, so the
+    wall time is about that of the slowest device instead of the sum of all runs.
+    Every model still writes its own output files through its sinks, and its throughput
+    summary (see `Model.metrics_file`).
+    """
+
+    def __init__(
+        self,
+        captioners: Sequence[Captioner],
+        ensemble: Optional[Ensemble] = None,
+        ensemble_device: Optional[str | torch.device] = None,
+        sources: Optional[Sequence[str | Path]] = None,
+        ensemble_batch_size: int = 25,
+        prefetch: int = 2,
+    ):
+        """
+        Args:
+            captioners (Sequence[Captioner]): The caption models, in the order their captions are
+                given to the ensemble.
+            ensemble (Ensemble, optional): Summarizes the captions of each image, see
+                `Ensemble.collate_captions`. Defaults to None (only the captioners run).
+            ensemble_device (str | torch.device, optional): Device of the ensemble model. Defaults to its current device.
+            sources (Sequence[str | Path], optional): Caption files of models that are not run here (e.g.
+                an external model), given to the ensemble after the captioners' captions. Defaults to None.
+            ensemble_batch_size (int, optional): Number of images summarized together. Defaults to 25.
+            prefetch (int, optional): Decoded batches queued per device. Defaults to 2.
+        """
+        if not captioners:
+            raise ValueError("CaptionPipeline needs at least one captioner")
+        self.captioners = list(captioners)
+        self.ensemble = ensemble
+        self.ensemble_device = (
+            torch.device(ensemble_device)
+            if ensemble_device is not None
+            else None
+        )
+        self.sources = {
+            str(f): read_captions(f)["caption"] for f in (sources or [])
+        }
+        self.ensemble_batch_size = ensemble_batch_size
+        self.prefetch = prefetch
+        self._stop = threading.Event()
+        self._errors: list[BaseException] = []
+        self.timings: dict[str, float] = defaultdict(float)
+
+    def _put(self, q: queue.Queue, item: Any) -> None:
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+        raise _Stopped
+
+    def _get(self, q: queue.Queue) -> Any:
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=1)
+            except queue.Empty:
+                continue
+        raise _Stopped
+
+    def _thread(self, name: str, target, *args) -> threading.Thread:
+        def run():
+            try:
+                target(*args)
+            except _Stopped:
+                pass
+            except BaseException as e:
+                logger.exception(f"Pipeline stage {name} failed")
+                self._errors.append(e)
+                self._stop.set()
+
+        thread = threading.Thread(target=run, name=name, daemon=True)
+        thread.start()
+        return thread
+
+    def _caption(
+        self,
+        captioners: list[tuple[int, Captioner]],
+        inputs: queue.Queue,
+        outputs: queue.Queue,
+    ) -> None:
+        """Run the captioners of one device on every decoded batch."""
+        for _, c in captioners:
+            if c.device is not None:
+                c.model.to(c.device)
+            c.model.eval()
+        batch_idx = 0
+        with torch.no_grad():
+            while (item := self._get(inputs)) is not _done:
+                filenames, images = item
+                for i, c in captioners:
+                    start = time.perf_counter()
+                    batch = c.model.transfer(
+                        c.dataset.from_images(filenames, images)
+                    )
+                    c.model.instrumentation.start_batch()
+                    captions = c.model.predict_step(batch, batch_idx)
+                    c.model.instrumentation.end_batch()
+                    self.timings[c.name] += time.perf_counter() - start
+                    self._put(outputs, (i, filenames, captions))
+                batch_idx += 1
+        for i, c in captioners:
+            c.model.on_predict_end()
+            self._put(outputs, (i, _done, None))
+
+    def _summarize(self, outputs: queue.Queue, results: dict) -> None:
+        """Collect the captions of each image, summarize complete images in batches."""
+        n = len(self.captioners)
+        pending: dict[str, list[Optional[str]]] = {}
+        batch: list[tuple[str, list[str]]] = []
+        remaining = n
+        if self.ensemble is not None:
+            if self.ensemble_device is not None:
+                self.ensemble.to(self.ensemble_device)
+            self.ensemble.eval()
+
+        def flush():
+            if self.ensemble is None or not batch:
+                return
+            start = time.perf_counter()
+            filenames = [f for f, _ in batch]
+            inputs = self.ensemble.transfer(
+                self.ensemble.collate_captions(
+                    filenames, [c for _, c in batch]
+                )
+            )
+            self.ensemble.instrumentation.start_batch()
+            with torch.no_grad():
+                summaries = self.ensemble.predict_step(inputs, 0)
+            self.ensemble.instrumentation.end_batch()
+            self.timings[self.ensemble.name] += time.perf_counter() - start
+            for f, summary in zip(filenames, summaries):
+                results[f].append(summary)
+            batch.clear()
+
+        while remaining:
+            i, filenames, captions = self._get(outputs)
+            if filenames is _done:
+                remaining -= 1
+                continue
+            for filename, caption in zip(filenames, captions):
+                row = pending.setdefault(filename, [None] * n)
+                row[i] = caption
+                if any(c is None for c in row):
+                    continue
+                del pending[filename]
+                captions_row: list[str] = row  # type: ignore
+                results[filename] = list(captions_row)
+                missing = [
+                    name
+                    for name, source in self.sources.items()
+                    if filename not in source
+                ]
+                if missing:
+                    logger.warning(
+                        f"No caption for {filename} in {missing}, not summarized"
+                    )
+                    continue
+                batch.append(
+                    (
+                        filename,
+                        captions_row
+                        + [s[filename] for s in self.sources.values()],
+                    )
+                )
+                if len(batch) >= self.ensemble_batch_size:
+                    flush()
+        flush()
+        if self.ensemble is not None:
+            self.ensemble.on_predict_end()
+
+    def run(
+        self,
+        images: ImageSource,
+        batch_size: int = 25,
+        num_workers: int = 8,
+        skip: Optional[Collection[str]] = None,
+    ) -> pd.DataFrame:
+        """
+        Caption (and summarize) every image.
+        Args:
+            images (ImageSource): Directory, manifest file or list of image paths, see `data.list_images`.
+                The captioners' datasets must contain these images.
+            batch_size (int, optional): Images decoded and captioned together. Defaults to 25.
+            num_workers (int, optional): DataLoader workers decoding the images. Defaults to 8.
+            skip (Collection[str], optional): Filenames to leave out, e.g. `ensemble.completed` when resuming.
+        Returns:
+            pd.DataFrame: Captions indexed by filename, one column per captioner (and one for the
+                ensemble), as `captions.caption_table`.
+        """
+        self._stop.clear()
+        self._errors = []
+        self.timings.clear()
+        dataset = DecodedImageDataset(images, skip)
+        loader = DataLoader(
+            dataset,
+            sampler=[
+                list(range(i, min(i + batch_size, len(dataset))))
+                for i in range(0, len(dataset), batch_size)
+            ],
+            batch_size=None,
+            num_workers=num_workers,
+        )
+        devices: dict[Any, list[tuple[int, Captioner]]] = defaultdict(list)
+        for i, c in enumerate(self.captioners):
+            devices[c.device or c.model.device].append((i, c))
+        outputs: queue.Queue = queue.Queue()
+        inputs = [queue.Queue(self.prefetch) for _ in devices]
+        results: dict[str, list[str]] = defaultdict(list)
+        threads = [
+            self._thread(f"caption-{device}", self._caption, group, q, outputs)
+            for (device, group), q in zip(devices.items(), inputs)
+        ]
+        threads.append(
+            self._thread("ensemble", self._summarize, outputs, results)
+        )
+        logger.info(
+            f"Captioning {len(dataset)} images with {[c.name for c in self.captioners]} "
+            f"on {len(devices)} devices"
+        )
+        start = time.perf_counter()
+        try:
+            for batch in loader:
+                decoded = time.perf_counter()
+                for q in inputs:
+                    self._put(q, batch)
+                self.timings["decode"] += decoded - start
+                start = time.perf_counter()
+            for q in inputs:
+                self._put(q, _done)
+        except _Stopped:
+            pass
+        except BaseException:
+            self._stop.set()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+        if self._errors:
+            raise self._errors[0]
+        logger.info(
+            "Pipeline stage times (s): "
+            + ", ".join(f"{k}: {v:.1f}" for k, v in self.timings.items())
+        )
+        columns = [c.name for c in self.captioners]
+        if self.ensemble is not None:
+            columns.append(self.ensemble.name)
+        columns = [
+            name if columns.count(name) == 1 else f"{name}__{i}"
+            for i, name in enumerate(columns)
+        ]
+        table = pd.DataFrame.from_dict(
+            results, orient="index", columns=columns
+        )
+        table.index.name = "filename"
+        return table
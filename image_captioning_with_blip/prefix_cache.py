@@ -0,0 +1,180 @@
+import copy
+import logging
+from collections.abc import Mapping, Sequence
+from typing import Any, Optional
+
+import torch
+from torch import Tensor
+from transformers import Cache, DynamicCache  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+
+def common_prefix(sequences: Sequence[Sequence[int]]) -> list[int]:
+    """Longest common prefix of several token sequences."""
+    if not sequences:
+        return []
+    prefix = list(sequences[0])
+    for seq in sequences[1:]:
+        n = 0
+        for a, b in zip(prefix, seq):
+            if a != b:
+                break
+            n += 1
+        prefix = prefix[:n]
+    return prefix
+
+
+class PrefixCache:
+    """
+    Reuses the key/value cache of a prompt prefix shared by every sample, so that
+    the prefill of each batch only covers the per-sample suffixes.
+
+    A left-padded batch `[pads][prefix][suffix]` is rearranged to
+    `[prefix][pads][suffix]`: the prefix keys/values are computed once (on the first
+    batch), copied and repeated for each batch, and the padding stays masked. Position
+    ids follow the attention mask, so every sample sees the same positions as in the
+    original batch. Batches with a row that does not start with the prefix are
+    generated without the cache.
+    """
+
+    def __init__(self, prefix_ids: Sequence[int]):
+        """
+        Args:
+            prefix_ids (Sequence[int]): Token ids every prompt starts with, see `from_text`.
+        """
+        self.prefix_ids = list(prefix_ids)
+        self._cache: Optional[Cache] = None
+        self._device: Optional[torch.device] = None
+        self._inputs: dict[str, Tensor] = {}
+
+    @classmethod
+    def from_text(
+        cls, tokenizer: Any, prefix: str, **tokenizer_kwargs
+    ) -> "PrefixCache":
+        """
+        Prefix cache for prompts starting with `prefix`. Only the tokens that do not
+        depend on the text that follows are kept (a token at the end of `prefix` can
+        merge with the start of the suffix).
+        Args:
+            tokenizer: Tokenizer used for the full prompts.
+            prefix (str): Text every prompt starts with.
+            **tokenizer_kwargs: Passed to the tokenizer, as for the full prompts.
+        """
+        probes = [
+            tokenizer(prefix + suffix, **tokenizer_kwargs)["input_ids"]
+            for suffix in ("0", "a", " A", "\n", "<", ".")
+        ]
+        prefix_ids = common_prefix(probes)
+        logger.info(
+            f"Caching a shared prompt prefix of {len(prefix_ids)} tokens"
+        )
+        return cls(prefix_ids)
+
+    def __len__(self) -> int:
+        return len(self.prefix_ids)
+
+    def past_key_values(
+        self, model: Any, batch_size: int, **model_inputs: Tensor
+    ) -> Cache:
+        """
+        Copy of the prefix cache for a batch, computed on first use.
+        Args:
+            model: Decoder-only Hugging Face model.
+            batch_size (int): Number of rows of the batch.
+            **model_inputs: Non-sequence inputs the model reads on every forward call (e.g.
+                the input mode of Phi-4-multimodal, which selects its LoRA adapter), passed to
+                the prefix forward. The prefix is recomputed when they change.
+        """
+        device = model.device
+        if (
+            self._cache is None
+            or self._device != device
+            or not _same_inputs(self._inputs, model_inputs)
+        ):
+            with torch.no_grad():
+                out = model(
+                    input_ids=torch.tensor([self.prefix_ids], device=device),
+                    use_cache=True,
+                    **model_inputs,
+                )
+            cache = out.past_key_values
+            if not isinstance(cache, Cache):
+                cache = DynamicCache.from_legacy_cache(cache)
+            self._cache, self._device = cache, device
+            self._inputs = dict(model_inputs)
+        cache = copy.deepcopy(self._cache)
+        cache.batch_repeat_interleave(batch_size)
+        return cache
+
+    def split(
+        self, input_ids: Tensor, attention_mask: Tensor, pad_token_id: int
+    ) -> Optional[tuple[Tensor, Tensor]]:
+        """
+        Rearrange a padded batch to `[prefix][pads][suffix]`.
+        Returns:
+            tuple[Tensor, Tensor] | None: The new input ids and attention mask, or None if
+                a row does not start with the prefix (or has nothing after it).
+        """
+        P = len(self.prefix_ids)
+        if P == 0:
+            return None
+        prefix = torch.tensor(self.prefix_ids, device=input_ids.device)
+        suffixes = []
+        for ids, mask in zip(input_ids, attention_mask):
+            ids = ids[mask.bool()]
+            if len(ids) <= P or not torch.equal(ids[:P], prefix):
+                return None
+            suffixes.append(ids[P:])
+        length = P + max(len(s) for s in suffixes)
+        new_ids = input_ids.new_full((len(suffixes), length), pad_token_id)
+        new_mask = attention_mask.new_zeros((len(suffixes), length))
+        new_ids[:, :P] = prefix
+        new_mask[:, :P] = 1
+        for i, suffix in enumerate(suffixes):
+            new_ids[i, length - len(suffix) :] = suffix
+            new_mask[i, length - len(suffix) :] = 1
+        return new_ids, new_mask
+
+    def generate(
+        self,
+        model: Any,
+        input_ids: Tensor,
+        attention_mask: Tensor,
+        pad_token_id: int,
+        prefix_inputs: Optional[Mapping[str, Tensor]] = None,
+        **kwargs,
+    ) -> Tensor:
+        """
+        `model.generate` with the prefix cache.
+        Args:
+            prefix_inputs (Mapping[str, Tensor], optional): Inputs of the batch that the model reads
+                on every forward call, see `past_key_values`. They must also be in `kwargs`. Defaults to None.
+        Returns:
+            Tensor: The generated tokens only (without the prompt).
+        """
+        split = self.split(input_ids, attention_mask, pad_token_id)
+        if split is None:
+            logger.warning(
+                "Batch does not share the cached prefix, generating without it"
+            )
+            out = model.generate(
+                input_ids=input_ids, attention_mask=attention_mask, **kwargs
+            )
+            return out[:, input_ids.shape[1] :]
+        new_ids, new_mask = split
+        out = model.generate(
+            input_ids=new_ids,
+            attention_mask=new_mask,
+            past_key_values=self.past_key_values(
+                model, len(new_ids), **(prefix_inputs or {})
+            ),
+            **kwargs,
+        )
+        return out[:, new_ids.shape[1] :]
+
+
+def _same_inputs(a: Mapping[str, Tensor], b: Mapping[str, Tensor]) -> bool:
+    return a.keys() == b.keys() and all(
+        torch.equal(a[key], b[key].to(a[key].device)) for key in a
+    )
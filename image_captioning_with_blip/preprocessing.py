@@ -0,0 +1,253 @@
+import hashlib
+import logging
+from collections.abc import Collection, Mapping, Sequence
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+import torch
+from torch import Tensor
+from torch.utils.data import DataLoader
+from transformers import AutoProcessor  # type: ignore
+
+from .data import ImageFolderDataset, ImageSource
+from .processors import get_processor, worker_init_fn
+from .utils.array_store import ArrayStore, content_key
+
+logger = logging.getLogger(__name__)
+
+default_cache_dir = Path(".cache/preprocessed")
+# Padded along the sequence, on the tokenizer's padding side
+sequence_keys = ("input_ids", "attention_mask")
+
+
+def file_hash(path: str | Path) -> str:
+    """Hash of the contents of a file, so renamed or copied images still hit the cache."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def pad_collate(
+    items: Sequence[Mapping[str, Tensor]],
+    pad_token_id: int = 0,
+    padding_side: str = "right",
+) -> dict[str, Tensor]:
+    """
+    Batch processor outputs of single images (each with a batch dimension of 1),
+    padding them as the processor does for a batch: `sequence_keys` on the tokenizer's
+    padding side, other tensors (e.g. image crops) with zeros at the end of every dimension.
+    0-dimensional tensors (flags such as the input mode) are taken from the first item.
+    """
+    batch: dict[str, Tensor] = {}
+    for key in items[0]:
+        values = [item[key] for item in items]
+        if values[0].ndim == 0:
+            batch[key] = values[0]
+            continue
+        shape = [
+            max(v.shape[d] for v in values) for d in range(values[0].ndim)
+        ]
+        padded = []
+        for v in values:
+            pad: list[int] = []  # F.pad order: last dimension first
+            for d in reversed(range(1, v.ndim)):
+                missing = shape[d] - v.shape[d]
+                if key in sequence_keys and padding_side == "left":
+                    pad += [missing, 0]
+                else:
+                    pad += [0, missing]
+            if any(pad):
+                v = torch.nn.functional.pad(
+                    v, pad, value=pad_token_id if key == "input_ids" else 0
+                )
+            padded.append(v)
+        batch[key] = torch.cat(padded)
+    return batch
+
+
+class PreprocessingCache:
+    """
+    Memory-mapped cache of processor outputs (pixel values, image masks, token ids, ...),
+    one entry per image, checkpoint and prompt, see `ArrayStore`.
+    """
+
+    def __init__(
+        self, checkpoint: str, cache_dir: str | Path = default_cache_dir
+    ):
+        """
+        Args:
+            checkpoint (str): Checkpoint of the processor, part of every key.
+            cache_dir (str | Path, optional): Root directory of the caches. Defaults to ".cache/preprocessed".
+        """
+        self.checkpoint = checkpoint
+        self.store = ArrayStore(Path(cache_dir) / content_key(checkpoint)[:16])
+
+    def key(self, image_hash: str, prompt: Optional[str]) -> str:
+        return content_key(
+            image_hash, self.checkpoint, content_key(prompt or "")
+        )
+
+    def get(self, key: str) -> dict[str, Tensor]:
+        # Copy out of the memory map, tensors may be modified (e.g. moved to pinned memory)
+        return {
+            name: torch.from_numpy(np.array(array))
+            for name, array in self.store.get(key).items()
+        }
+
+    def put_many(self, items: Mapping[str, Mapping[str, Tensor]]) -> None:
+        self.store.put_many(
+            {
+                key: {name: t.numpy() for name, t in arrays.items()}
+                for key, arrays in items.items()
+            }
+        )
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.store
+
+
+class ProcessedImageDataset(ImageFolderDataset):
+    """
+    Base class for datasets that run a Hugging Face processor on the images (and prompts).
+
+    Without a cache, each batch goes through the processor in `__getitem__`. With
+    `cache_dir`, `preprocess` runs the processor once per image and prompt and stores
+    the outputs in a `PreprocessingCache`; `__getitem__` then reads them from the memory
+    map and pads them into a batch, so changing only the prompt or rerunning a
+    caption job does not decode or resize the images again.
+    """
+
+    checkpoint: str
+    processor_class: Any = AutoProcessor
+    processor_kwargs: dict[str, Any] = {}
+
+    def __init__(
+        self,
+        images: ImageSource,
+        skip: Optional[Collection[str]] = None,
+        cache_dir: Optional[str | Path] = None,
+    ):
+        """
+        Args:
+            images (ImageSource): Directory, manifest file or list of image paths, see `data.list_images`.
+            skip (Collection[str], optional): Filenames to leave out, e.g. `Model.completed` when resuming.
+            cache_dir (str | Path, optional): Directory of the preprocessing cache. Defaults to None (no cache).
+        """
+        super().__init__(images, skip)
+        self.cache = (
+            PreprocessingCache(self.checkpoint, cache_dir)
+            if cache_dir is not None
+            else None
+        )
+        self._keys: dict[int, str] = {}
+
+    @property
+    def processor(self) -> Any:
+        """
+        The processor of `checkpoint`, shared by every dataset and model of the process
+        and never pickled into DataLoader workers, see `processors.get_processor`.
+        """
+        return get_processor(
+            self.checkpoint, self.processor_class, **self.processor_kwargs
+        )
+
+    def get_prompt(self, idx: int) -> Optional[str]:
+        """Text passed to the processor with image `idx`, None for image-only processors."""
+        return None
+
+    def process(self, images, prompts) -> Mapping[str, Tensor]:
+        """Run the processor on an image or a list of images, with the matching prompt(s)."""
+        return self.processor(
+            images=images,
+            text=prompts,
+            padding=True,
+            truncation=True,
+            return_tensors="pt",
+        )
+
+    def _process(self, idx: int | list[int]) -> Mapping[str, Tensor]:
+        prompts = (
+            [self.get_prompt(i) for i in idx]
+            if isinstance(idx, list)
+            else self.get_prompt(idx)
+        )
+        return self.process(self.get_images(idx), prompts)
+
+    def _preprocess_item(self, idx: int) -> tuple[int, dict[str, Tensor]]:
+        return idx, dict(self._process([idx]))
+
+    def cache_key(self, idx: int) -> str:
+        assert self.cache is not None
+        if idx not in self._keys:
+            self._keys[idx] = self.cache.key(
+                file_hash(self.paths[idx]), self.get_prompt(idx)
+            )
+        return self._keys[idx]
+
+    def __getitem__(
+        self, idx: int | slice | list[int]
+    ) -> tuple[str | list[str], Mapping[str, Tensor]]:
+        filenames = self.get_filenames(idx)
+        indices = self._indices(idx)
+        if self.cache is None:
+            return filenames, self._process(indices)
+        items = []
+        for i in indices if isinstance(indices, list) else [indices]:
+            key = self.cache_key(i)
+            items.append(
+                self.cache.get(key)
+                if key in self.cache
+                else self._preprocess_item(i)[1]
+            )
+        tokenizer = getattr(self.processor, "tokenizer", None)
+        return filenames, pad_collate(
+            items,
+            pad_token_id=getattr(tokenizer, "pad_token_id", None) or 0,
+            padding_side=getattr(tokenizer, "padding_side", "right"),
+        )
+
+    def from_images(
+        self, filenames: list[str], images: list
+    ) -> tuple[list[str], Mapping[str, Tensor]]:
+        """Run the processor on already decoded images, with the prompts of these filenames."""
+        prompts = [self.get_prompt(self.index(f)) for f in filenames]
+        return filenames, self.process(images, prompts)
+
+    def preprocess(self, num_workers: int = 0, write_every: int = 64) -> int:
+        """
+        Run the processor on every image (and prompt) that is not cached yet.
+        Images are processed in DataLoader workers, the cache is only written by this process.
+        Args:
+            num_workers (int, optional): DataLoader workers. Defaults to 0 (in this process).
+            write_every (int, optional): Number of images per write to the cache. Defaults to 64.
+        Returns:
+            int: Number of images that were processed.
+        """
+        if self.cache is None:
+            raise ValueError("preprocess needs a cache_dir")
+        missing = [
+            i for i in range(len(self)) if self.cache_key(i) not in self.cache
+        ]
+        if not missing:
+            return 0
+        logger.info(
+            f"Preprocessing {len(missing)} images ({len(self) - len(missing)} cached)"
+        )
+        loader = DataLoader(
+            missing,
+            batch_size=None,
+            num_workers=num_workers,
+            collate_fn=self._preprocess_item,
+            worker_init_fn=worker_init_fn,
+        )
+        pending: dict[str, dict[str, Tensor]] = {}
+        for i, arrays in loader:
+            pending[self.cache_key(i)] = arrays
+            if len(pending) >= write_every:
+                self.cache.put_many(pending)
+                pending = {}
+        self.cache.put_many(pending)
+        return len(missing)
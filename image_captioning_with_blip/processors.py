@@ -0,0 +1,83 @@
+import copy
+import logging
+import threading
+from typing import Any, Optional
+
+from torch.utils.data import get_worker_info
+from transformers import AutoProcessor, AutoTokenizer  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+# Loaded processors/tokenizers of this process, by class, checkpoint and options, and
+# their copies with another padding side.
+# Nothing here is pickled: DataLoader workers either inherit the loaded objects
+# through fork (copy-on-write) or load them once, on first use.
+_registry: dict[tuple, Any] = {}
+_lock = threading.Lock()
+
+
+def get_processor(
+    checkpoint: str,
+    cls: Any = AutoProcessor,
+    padding_side: Optional[str] = None,
+    **kwargs,
+) -> Any:
+    """
+    Load a processor (or tokenizer) once per process and return the shared instance.
+    Args:
+        checkpoint (str): Checkpoint to load.
+        cls (optional): Class whose `from_pretrained` is used. Defaults to `AutoProcessor`.
+        padding_side (str, optional): Padding side of the tokenizer. Another padding side than
+            the checkpoint's gets its own shallow copy of the loaded instance (the vocabulary
+            and image processor are still shared), so callers never change each other's
+            padding. Defaults to the checkpoint's.
+        **kwargs: Passed to `from_pretrained`, e.g. `trust_remote_code=True`.
+    Returns:
+        The processor. Do not modify it, it is shared by every dataset and model of the process.
+    """
+    key = (cls.__name__, checkpoint, tuple(sorted(kwargs.items())))
+    processor = _registry.get(key)
+    if processor is None:
+        with _lock:
+            if key not in _registry:
+                logger.info(f"Loading {cls.__name__} for {checkpoint}")
+                _registry[key] = cls.from_pretrained(checkpoint, **kwargs)
+            processor = _registry[key]
+    tokenizer = getattr(processor, "tokenizer", processor)
+    if padding_side is None or tokenizer.padding_side == padding_side:
+        return processor
+    variant_key = (*key, padding_side)
+    variant = _registry.get(variant_key)
+    if variant is None:
+        with _lock:
+            if variant_key not in _registry:
+                variant = copy.copy(tokenizer)
+                variant.padding_side = padding_side
+                if tokenizer is not processor:
+                    tokenizer_copy = variant
+                    variant = copy.copy(processor)
+                    variant.tokenizer = tokenizer_copy
+                _registry[variant_key] = variant
+            variant = _registry[variant_key]
+    return variant
+
+
+def get_tokenizer(
+    checkpoint: str, padding_side: Optional[str] = None, **kwargs
+) -> Any:
+    """Shared `AutoTokenizer` of a checkpoint, see `get_processor`."""
+    return get_processor(checkpoint, AutoTokenizer, padding_side, **kwargs)
+
+
+def worker_init_fn(worker_id: int) -> None:
+    """
+    DataLoader `worker_init_fn` that loads the dataset's processor (or tokenizer) when
+    the worker starts, instead of in its first batch. Loaded once per worker, and not
+    at all if the worker was forked from a process that already loaded it.
+    """
+    info = get_worker_info()
+    if info is None:
+        return
+    for name in ("processor", "tokenizer"):
+        if isinstance(getattr(type(info.dataset), name, None), property):
+            getattr(info.dataset, name)
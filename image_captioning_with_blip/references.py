@@ -0,0 +1,197 @@
+import json
+import logging
+import os
+from collections.abc import Iterable, Iterator, Sequence
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+
+
+def frame_filename(frame_time: int | str) -> str:
+    """Image file name of a frame, as written by `split_dataset`."""
+    return f"{frame_time}.jpg"
+
+
+class ReferenceStore:
+    """
+    Read-only, columnar index of the reference captions in a `Frames.json` file.
+
+    Every frame can have several reference captions. They are kept in a single
+    UTF-8 buffer with offsets (captions of frame `i` are `caption_offsets[i]` to
+    `caption_offsets[i + 1]`), so the whole index is a handful of NumPy arrays.
+    `ReferenceStore.load` caches them in a `.npz` file next to the JSON file,
+    rebuilt whenever the JSON file's size or modification time changes.
+    """
+
+    def __init__(
+        self,
+        frame_times: np.ndarray,
+        caption_offsets: np.ndarray,
+        text_offsets: np.ndarray,
+        text: np.ndarray,
+    ):
+        """
+        Args:
+            frame_times (np.ndarray): Frame time of each frame, shape (n,).
+            caption_offsets (np.ndarray): Index of each frame's first caption, shape (n + 1,).
+            text_offsets (np.ndarray): Byte offset of each caption in `text`, shape (m + 1,).
+            text (np.ndarray): UTF-8 encoded captions, concatenated (uint8).
+        """
+        self.frame_times = frame_times
+        self.caption_offsets = caption_offsets
+        self.text_offsets = text_offsets
+        self.text = text
+        self._rows = {
+            frame_filename(t): i for i, t in enumerate(frame_times.tolist())
+        }
+
+    @classmethod
+    def from_records(cls, records: Iterable[dict]) -> "ReferenceStore":
+        """
+        Build the index from `Frames.json` records
+        (`{"file", "frame_time", "captions": {caption: score}}`).
+        Captions are kept in file order. The records are not modified.
+        """
+        frame_times: list[int] = []
+        caption_offsets = [0]
+        text_offsets = [0]
+        chunks: list[bytes] = []
+        for record in records:
+            frame_times.append(int(record["frame_time"]))
+            for caption in record["captions"]:
+                chunk = caption.encode()
+                chunks.append(chunk)
+                text_offsets.append(text_offsets[-1] + len(chunk))
+            caption_offsets.append(len(text_offsets) - 1)
+        return cls(
+            np.array(frame_times, dtype=np.int64),
+            np.array(caption_offsets, dtype=np.int64),
+            np.array(text_offsets, dtype=np.int64),
+            np.frombuffer(b"".join(chunks), dtype=np.uint8),
+        )
+
+    @staticmethod
+    def cache_file(source: str | Path) -> Path:
+        source = Path(source)
+        return source.with_name(f"{source.stem}.references.npz")
+
+    @classmethod
+    def load(cls, source: str | Path) -> "ReferenceStore":
+        """
+        Load the references of a `Frames.json` file, from the cached index if it is
+        up to date, otherwise by parsing the JSON file (and caching the result).
+        Stores are also kept in memory (the latest version of each file), so repeated
+        calls in a process are free.
+        """
+        source = Path(source)
+        stat = os.stat(source)
+        path = str(source.resolve())
+        version = (stat.st_mtime_ns, stat.st_size)
+        if path in _loaded and _loaded[path][0] == version:
+            return _loaded[path][1]
+        store = cls._load_cache(source, stat)
+        if store is None:
+            logger.info(f"Indexing reference captions in {source}")
+            with open(source, "r") as f:
+                store = cls.from_records(json.load(f))
+            store._save_cache(source, stat)
+        # Replaces the store of an older version of the file
+        _loaded[path] = (version, store)
+        return store
+
+    @classmethod
+    def _load_cache(
+        cls, source: Path, stat: os.stat_result
+    ) -> "ReferenceStore | None":
+        cache_file = cls.cache_file(source)
+        if not cache_file.exists():
+            return None
+        try:
+            with np.load(cache_file) as data:
+                if data["meta"].tolist() != [
+                    CACHE_VERSION,
+                    stat.st_mtime_ns,
+                    stat.st_size,
+                ]:
+                    return None
+                return cls(
+                    data["frame_times"],
+                    data["caption_offsets"],
+                    data["text_offsets"],
+                    data["text"],
+                )
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable cache {cache_file}: {e}")
+            return None
+
+    def _save_cache(self, source: Path, stat: os.stat_result) -> None:
+        cache_file = self.cache_file(source)
+        # Write to a temporary file first, so a crash cannot leave a half-written cache
+        tmp = cache_file.with_name(f".{cache_file.stem}.tmp.npz")
+        try:
+            np.savez(
+                tmp,
+                meta=np.array(
+                    [CACHE_VERSION, stat.st_mtime_ns, stat.st_size],
+                    dtype=np.int64,
+                ),
+                frame_times=self.frame_times,
+                caption_offsets=self.caption_offsets,
+                text_offsets=self.text_offsets,
+                text=self.text,
+            )
+            os.replace(tmp, cache_file)
+        except OSError as e:
+            logger.warning(
+                f"Could not cache the references in {cache_file}: {e}"
+            )
+
+    def __len__(self) -> int:
+        return len(self.frame_times)
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self._rows
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._rows)
+
+    def __getitem__(self, filename: str) -> list[str]:
+        return self._captions(self._rows[filename])
+
+    def get(self, filename: str, default=None) -> list[str] | None:
+        """All reference captions of an image, or `default` if it has none."""
+        row = self._rows.get(filename)
+        return default if row is None else self._captions(row)
+
+    def _captions(self, row: int) -> list[str]:
+        start, end = self.caption_offsets[row : row + 2].tolist()
+        bounds = self.text_offsets[start : end + 1].tolist()
+        buffer = self.text[bounds[0] : bounds[-1]].tobytes()
+        base = bounds[0]
+        return [
+            buffer[a - base : b - base].decode()
+            for a, b in zip(bounds, bounds[1:])
+        ]
+
+    def references(self, filenames: Sequence[str]) -> list[list[str]]:
+        """The reference captions of each image, in order."""
+        return [self[filename] for filename in filenames]
+
+    def ground_truth(self) -> dict[str, str]:
+        """
+        One reference caption per image: the last one listed, which is what
+        `dict.popitem` returned in earlier versions of `load_ground_truth`.
+        """
+        return {
+            filename: captions[-1]
+            for filename in self._rows
+            if (captions := self[filename])
+        }
+
+
+# Loaded store by resolved path, with the (mtime_ns, size) it was read at
+_loaded: dict[str, tuple[tuple[int, int], ReferenceStore]] = {}
@@ -0,0 +1,141 @@
+import itertools
+import logging
+import os
+from collections.abc import Iterable, Iterator, Sequence
+from typing import Optional
+
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBudgetBatchSampler(Sampler[list[int]]):
+    """
+    Batch sampler that groups samples of similar length and fills each batch up to a
+    token budget instead of a fixed number of samples.
+
+    Samples are sorted by length (longest first, so running out of memory shows up in
+    the first batch), then packed greedily while the padded size of the batch,
+    `len(batch) * (longest prompt + extra_tokens)`, stays within `max_tokens`.
+    A sample longer than the budget gets a batch of its own. Batches do not come out
+    in dataset order, see `Model.set_output_order` to restore it in the output files.
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        max_tokens: int,
+        max_batch_size: Optional[int] = None,
+        extra_tokens: int = 0,
+    ):
+        """
+        Args:
+            lengths (Sequence[int]): Length (e.g. number of prompt tokens) of every sample.
+            max_tokens (int): Token budget of a batch, padding included.
+            max_batch_size (int, optional): Upper bound on the number of samples per batch. Defaults to None.
+            extra_tokens (int, optional): Tokens added to every sample, e.g. `max_new_tokens`
+                when the budget should cover the generated tokens too. Defaults to 0.
+        """
+        self.lengths = list(lengths)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.extra_tokens = extra_tokens
+        self.batches = self._pack()
+        if self.batches:
+            padded = sum(
+                len(batch) * (self.lengths[batch[0]] + extra_tokens)
+                for batch in self.batches
+            )
+            logger.info(
+                f"{len(self.lengths)} samples in {len(self.batches)} batches, "
+                f"{sum(self.lengths) + extra_tokens * len(self.lengths)} of {padded} tokens used"
+            )
+
+    def _pack(self) -> list[list[int]]:
+        order = sorted(
+            range(len(self.lengths)), key=lambda i: -self.lengths[i]
+        )
+        batches: list[list[int]] = []
+        batch: list[int] = []
+        for i in order:
+            # Sorted longest first, so the first sample of a batch is its longest
+            longest = self.lengths[batch[0]] if batch else self.lengths[i]
+            if batch and (
+                (len(batch) + 1) * (longest + self.extra_tokens)
+                > self.max_tokens
+                or len(batch) == self.max_batch_size
+            ):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __iter__(self) -> Iterator[list[int]]:
+        return iter(self.batches)
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+
+def shard_info() -> tuple[int, int]:
+    """
+    (index, count) of this process among the processes of a distributed run: from
+    `torch.distributed` once it is initialized, else from the `RANK`/`WORLD_SIZE`
+    environment variables (set by `torchrun`), else (0, 1).
+    """
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return int(os.environ.get("RANK", 0)), int(os.environ.get("WORLD_SIZE", 1))
+
+
+class ShardedBatchSampler(Sampler[list[int]]):
+    """
+    The batches of one shard of another batch sampler (e.g. a `BatchSampler` or a
+    `TokenBudgetBatchSampler`): shard `i` of `n` gets batches `i`, `i + n`, `i + 2n`, ...,
+    so the shards are disjoint, cover every sample exactly once (unlike
+    `DistributedSampler`, which pads the last shards with repeated samples) and get
+    batches of similar cost when the batches are sorted by length.
+
+    By default the shard is the rank of this process, read when the sampler is first
+    iterated, i.e. after `Trainer` has initialized the process group, so the sampler can
+    be created before the `Trainer`. Pass `use_distributed_sampler=False` to the `Trainer`
+    so that Lightning does not replace it. Every process must build the same dataset
+    (the same `skip`), see the `shard` argument of `Model` to split images over
+    independent jobs instead.
+    """
+
+    def __init__(
+        self,
+        batch_sampler: Iterable[list[int]],
+        num_shards: Optional[int] = None,
+        shard: Optional[int] = None,
+    ):
+        """
+        Args:
+            batch_sampler (Iterable[list[int]]): Batches of dataset indices, in a deterministic order.
+            num_shards (int, optional): Number of shards. Defaults to None (the world size).
+            shard (int, optional): Shard to iterate, from 0. Defaults to None (the global rank).
+        """
+        if (num_shards is None) != (shard is None):
+            raise ValueError("Pass both shard and num_shards, or neither")
+        if shard is not None and not 0 <= shard < num_shards:  # type: ignore
+            raise ValueError(f"shard must be in [0, {num_shards})")
+        self.batch_sampler = batch_sampler
+        self.num_shards = num_shards
+        self.shard = shard
+
+    def _shard(self) -> tuple[int, int]:
+        if self.shard is not None and self.num_shards is not None:
+            return self.shard, self.num_shards
+        return shard_info()
+
+    def __iter__(self) -> Iterator[list[int]]:
+        shard, num_shards = self._shard()
+        return itertools.islice(self.batch_sampler, shard, None, num_shards)
+
+    def __len__(self) -> int:
+        shard, num_shards = self._shard()
+        return len(range(shard, len(self.batch_sampler), num_shards))  # type: ignore
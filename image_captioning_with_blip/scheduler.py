@@ -0,0 +1,274 @@
+import itertools
+import logging
+from collections.abc import (
+    Collection,
+    Hashable,
+    Iterable,
+    Iterator,
+    Mapping,
+    Sequence,
+)
+from typing import Any, Optional
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+from transformers import Cache, DynamicCache  # type: ignore
+
+from .prefix_cache import PrefixCache
+from .preprocessing import pad_collate
+
+logger = logging.getLogger(__name__)
+
+Request = tuple[Hashable, Mapping[str, Tensor]]
+LegacyCache = list[tuple[Tensor, Tensor]]
+
+
+def _legacy(cache: Any) -> LegacyCache:
+    if isinstance(cache, Cache):
+        cache = cache.to_legacy_cache()
+    return [(k, v) for k, v in cache]
+
+
+class ContinuousBatcher:
+    """
+    Greedy decoding of a decoder-only model with a fixed pool of active sequences.
+
+    Instead of generating a static batch until its longest output is done, the pool
+    decodes one token per step for every active sequence, evicts sequences as soon as
+    they produce an end-of-sequence token (or reach `max_new_tokens`), and fills the
+    freed slots with new requests, which are prefilled together and joined to the pool.
+
+    The pool's key/value cache is left-padded: a joining group is padded on the left to
+    the length of the pool (or the other way around) and the padding stays masked.
+    Position ids follow the attention mask, so every sequence sees the same positions as
+    when generated alone. Columns that are padding for every sequence left in the pool
+    are dropped after each eviction. Other inputs (e.g. image features) only go to the
+    prefill, except `step_inputs`, which the model reads on every forward call.
+    """
+
+    def __init__(
+        self,
+        model: Any,
+        max_active: int = 32,
+        max_new_tokens: int = 1024,
+        eos_token_id: Optional[int | Sequence[int]] = None,
+        pad_token_id: int = 0,
+        admit_size: int = 1,
+        prefix_cache: Optional[PrefixCache] = None,
+        forward_kwargs: Optional[Mapping[str, Any]] = None,
+        step_inputs: Collection[str] = (),
+    ):
+        """
+        Args:
+            model: Decoder-only Hugging Face model (with a language modelling head).
+            max_active (int, optional): Number of sequences decoded together. Defaults to 32.
+            max_new_tokens (int, optional): Generated tokens after which a sequence is evicted. Defaults to 1024.
+            eos_token_id (int | Sequence[int], optional): Token(s) that end a sequence. Defaults to None.
+            pad_token_id (int, optional): Token used to left-pad the prompts of a joining group. Defaults to 0.
+            admit_size (int, optional): Number of free slots to wait for before prefilling new
+                requests, fewer but larger prefills. New requests are always admitted into an
+                empty pool. Defaults to 1.
+            prefix_cache (PrefixCache, optional): Shared prompt prefix whose keys/values are reused
+                for every prefill, see `PrefixCache`. Defaults to None.
+            forward_kwargs (Mapping[str, Any], optional): Passed to every forward call of the model. Defaults to None.
+            step_inputs (Collection[str], optional): Non-sequence inputs of the requests passed to every
+                forward call, not only to the prefill (flags such as the input mode of Phi-4-multimodal,
+                which selects its LoRA adapter). They must be the same for every request. Defaults to ().
+        """
+        self.model = model
+        self.max_active = max_active
+        self.max_new_tokens = max_new_tokens
+        if eos_token_id is None:
+            eos_token_id = []
+        elif isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        self.eos_token_ids = set(eos_token_id)
+        self.pad_token_id = pad_token_id
+        self.admit_size = max(1, min(admit_size, max_active))
+        self.prefix_cache = prefix_cache
+        self.forward_kwargs = dict(forward_kwargs or {})
+        self.step_inputs = tuple(step_inputs)
+        self._reset()
+
+    def _reset(self) -> None:
+        self._keys: list[Hashable] = []
+        self._tokens: list[list[int]] = []
+        self._last: Optional[Tensor] = None
+        self._mask: Optional[Tensor] = None
+        self._cache: LegacyCache = []
+        self._step_inputs: dict[str, Tensor] = {}
+
+    def __len__(self) -> int:
+        """Number of active sequences."""
+        return len(self._keys)
+
+    def run(
+        self, requests: Iterable[Request]
+    ) -> Iterator[tuple[Hashable, list[int]]]:
+        """
+        Generate for every request, admitting them in order as slots free up.
+        Args:
+            requests (Iterable[tuple[Hashable, Mapping[str, Tensor]]]): Key and model inputs of
+                every sample, with a batch dimension of 1 and no padding (at least `input_ids`
+                and `attention_mask`, on the model's device).
+        Yields:
+            tuple[Hashable, list[int]]: Key and generated tokens (without the prompt, with the
+                end-of-sequence token if there is one) of each request, in the order they finish.
+        """
+        self._reset()
+        requests = iter(requests)
+        exhausted = False
+        steps = 0
+        while True:
+            free = self.max_active - len(self)
+            if not exhausted and (free >= self.admit_size or not len(self)):
+                group = list(itertools.islice(requests, free))
+                exhausted = len(group) < free
+                if group:
+                    yield from self._admit(group)
+            if not len(self):
+                if exhausted:
+                    break
+                continue
+            yield from self._step()
+            steps += 1
+        logger.debug(f"Continuous batching finished after {steps} steps")
+
+    @torch.no_grad()
+    def _admit(self, group: list[Request]) -> list[tuple[Hashable, list[int]]]:
+        samples = [dict(sample) for _, sample in group]
+        step_inputs = self._pop_step_inputs(samples)
+        inputs = pad_collate(
+            samples,
+            pad_token_id=self.pad_token_id,
+            padding_side="left",
+        )
+        input_ids = inputs.pop("input_ids")
+        mask = inputs.pop("attention_mask")
+        past = None
+        start = 0
+        if self.prefix_cache is not None:
+            split = self.prefix_cache.split(input_ids, mask, self.pad_token_id)
+            if split is not None:
+                input_ids, mask = split
+                past = self.prefix_cache.past_key_values(
+                    self.model, len(input_ids), **step_inputs
+                )
+                start = len(self.prefix_cache)
+        position_ids = (mask.long().cumsum(-1) - 1).clamp(min=0)
+        out = self.model(
+            input_ids=input_ids[:, start:],
+            attention_mask=mask,
+            position_ids=position_ids[:, start:],
+            past_key_values=past,
+            use_cache=True,
+            **inputs,
+            **step_inputs,
+            **self.forward_kwargs,
+        )
+        cache = _legacy(out.past_key_values)
+        if not len(self):
+            self._cache, self._mask = cache, mask
+        else:
+            assert self._mask is not None
+            length = max(self._mask.shape[1], mask.shape[1])
+            self._cache = [
+                (
+                    torch.cat([_pad_left(k0, length), _pad_left(k1, length)]),
+                    torch.cat([_pad_left(v0, length), _pad_left(v1, length)]),
+                )
+                for (k0, v0), (k1, v1) in zip(self._cache, cache)
+            ]
+            self._mask = torch.cat(
+                [_pad_left(self._mask, length), _pad_left(mask, length)]
+            )
+        self._step_inputs = step_inputs
+        self._keys += [key for key, _ in group]
+        self._tokens += [[] for _ in group]
+        tokens = out.logits[:, -1].argmax(-1)
+        self._last = (
+            tokens if self._last is None else torch.cat([self._last, tokens])
+        )
+        return self._record(len(self) - len(group))
+
+    @torch.no_grad()
+    def _step(self) -> list[tuple[Hashable, list[int]]]:
+        assert self._mask is not None and self._last is not None
+        self._mask = F.pad(self._mask, (0, 1), value=1)
+        out = self.model(
+            input_ids=self._last[:, None],
+            attention_mask=self._mask,
+            position_ids=self._mask.long().sum(-1, keepdim=True) - 1,
+            past_key_values=DynamicCache.from_legacy_cache(tuple(self._cache)),
+            use_cache=True,
+            **self._step_inputs,
+            **self.forward_kwargs,
+        )
+        self._cache = _legacy(out.past_key_values)
+        self._last = out.logits[:, -1].argmax(-1)
+        return self._record(0)
+
+    def _pop_step_inputs(
+        self, samples: list[dict[str, Tensor]]
+    ) -> dict[str, Tensor]:
+        """Remove the `step_inputs` from `samples`, checking they match each other and the pool."""
+        step_inputs = {
+            key: samples[0][key]
+            for key in self.step_inputs
+            if key in samples[0]
+        }
+        reference = self._step_inputs if len(self) else step_inputs
+        for sample in samples:
+            values = {
+                key: sample.pop(key)
+                for key in self.step_inputs
+                if key in sample
+            }
+            if values.keys() != reference.keys() or not all(
+                torch.equal(values[key], reference[key]) for key in values
+            ):
+                raise ValueError(
+                    f"Requests with different {', '.join(self.step_inputs)} cannot be decoded together"
+                )
+        return step_inputs
+
+    def _record(self, start: int) -> list[tuple[Hashable, list[int]]]:
+        """Append the last tokens of the sequences from `start` on, evict the finished ones."""
+        assert self._last is not None and self._mask is not None
+        finished: list[tuple[Hashable, list[int]]] = []
+        keep: list[int] = list(range(start))
+        for i, token in enumerate(self._last[start:].tolist(), start):
+            self._tokens[i].append(token)
+            if (
+                token in self.eos_token_ids
+                or len(self._tokens[i]) >= self.max_new_tokens
+            ):
+                finished.append((self._keys[i], self._tokens[i]))
+            else:
+                keep.append(i)
+        if len(keep) == len(self):
+            return finished
+        if not keep:
+            self._reset()
+            return finished
+        index = torch.tensor(keep, device=self._mask.device)
+        self._keys = [self._keys[i] for i in keep]
+        self._tokens = [self._tokens[i] for i in keep]
+        self._last = self._last[index]
+        mask = self._mask[index]
+        # Drop the columns that only padded the evicted sequences
+        first = int(mask.any(0).long().argmax())
+        self._mask = mask[:, first:]
+        self._cache = [
+            (k[index, :, first:], v[index, :, first:]) for k, v in self._cache
+        ]
+        return finished
+
+
+def _pad_left(t: Tensor, length: int) -> Tensor:
+    """Pad a mask (batch, seq) or keys/values (batch, heads, seq, dim) on the left to `length`."""
+    missing = length - (t.shape[1] if t.ndim == 2 else t.shape[2])
+    if not missing:
+        return t
+    return F.pad(t, (missing, 0) if t.ndim == 2 else (0, 0, missing, 0))
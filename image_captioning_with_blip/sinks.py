@@ -0,0 +1,445 @@
+import csv
+import glob
+import json
+import logging
+import os
+import re
+import time
+from collections.abc import Iterator, Mapping, Sequence
+from pathlib import Path
+from typing import Optional
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # parquet output is optional
+    pa = None
+    pq = None
+
+logger = logging.getLogger(__name__)
+
+
+def escape_tsv(text: str) -> str:
+    """Escape backslashes, tabs and newlines so that a caption fits on one TSV line."""
+    return (
+        text.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def unescape_tsv(text: str) -> str:
+    """Inverse of `escape_tsv`."""
+    out: list[str] = []
+    chars = iter(text)
+    for c in chars:
+        if c != "\\":
+            out.append(c)
+            continue
+        nxt = next(chars, "")
+        out.append(
+            {"n": "\n", "t": "\t", "r": "\r", "\\": "\\"}.get(nxt, c + nxt)
+        )
+    return "".join(out)
+
+
+def read_jsonl(path: str | Path) -> Iterator[dict[str, str]]:
+    """
+    Read the records of a JSON Lines caption file.
+    A truncated last line (e.g. from a crash mid-write) is skipped with a warning.
+    """
+    with open(path, "r") as f:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping malformed line {line_no} in {path}")
+
+
+class CaptionSink:
+    """
+    Base class for caption writers.
+
+    Rows are buffered and written when either `flush_every` rows are pending or
+    `flush_interval` seconds have passed since the last flush, so the cost of a
+    write only depends on the size of the batch, not on how much was written before.
+    """
+
+    suffix: str
+
+    def __init__(
+        self,
+        path: str | Path,
+        flush_every: int = 1,
+        flush_interval: Optional[float] = None,
+    ):
+        """
+        Args:
+            path (str | Path): Path to the output file.
+            flush_every (int, optional): Number of buffered rows that triggers a flush. Defaults to 1 (flush on every write).
+            flush_interval (float, optional): Seconds after which pending rows are flushed regardless of count. Defaults to None.
+        """
+        self.path = Path(path)
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._buffer: list[tuple[str, str]] = []
+        self._last_flush = time.monotonic()
+
+    def write(self, filenames: Sequence[str], captions: Sequence[str]) -> None:
+        self._buffer.extend(zip(filenames, captions))
+        if len(self._buffer) >= self.flush_every or (
+            self.flush_interval is not None
+            and time.monotonic() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        if self._buffer:
+            self._write_rows(self._buffer)
+            self._buffer = []
+        self._last_flush = time.monotonic()
+
+    def _write_rows(self, rows: list[tuple[str, str]]) -> None:
+        raise NotImplementedError("Base class")
+
+    def finalize(self, order: Optional[Mapping[str, int]] = None) -> None:
+        """
+        Flush any pending rows and release the file. Called once at the end of a run.
+        Args:
+            order (Mapping[str, int], optional): Position of each filename in the final
+                output, for sinks that can rewrite their file once at the end (rows of
+                other filenames keep their place, before the ordered ones). Defaults to None (write order).
+        """
+        self.flush()
+
+
+def _ordered(
+    records: list[dict[str, str]], order: Optional[Mapping[str, int]]
+) -> list[dict[str, str]]:
+    if order is None:
+        return records
+    return sorted(records, key=lambda r: order.get(r["filename"], -1))
+
+
+class JSONLinesSink(CaptionSink):
+    """Append-only JSON Lines writer, one `{"filename", "caption"}` object per line."""
+
+    suffix = ".jsonl"
+
+    def __init__(
+        self,
+        path: str | Path,
+        flush_every: int = 1,
+        flush_interval: Optional[float] = None,
+        json_file: Optional[str | Path] = None,
+    ):
+        """
+        Args:
+            json_file (str | Path, optional): If given, `finalize` also writes the legacy
+                `.json` array (a list of `{"filename", "caption"}` objects) to this path.
+        """
+        super().__init__(path, flush_every, flush_interval)
+        self.json_file = Path(json_file) if json_file is not None else None
+
+    def _write_rows(self, rows: list[tuple[str, str]]) -> None:
+        with open(self.path, "a") as f:
+            for filename, caption in rows:
+                print(
+                    json.dumps({"filename": filename, "caption": caption}),
+                    file=f,
+                )
+
+    def finalize(self, order: Optional[Mapping[str, int]] = None) -> None:
+        super().finalize(order)
+        if self.json_file is None or not self.path.exists():
+            return
+        records = _ordered(list(read_jsonl(self.path)), order)
+        # Write to a temporary file first, so a crash cannot leave a half-written .json
+        tmp = self.json_file.with_name(f".{self.json_file.name}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(records, f, indent=2)
+        os.replace(tmp, self.json_file)
+
+
+class TSVSink(CaptionSink):
+    """Buffered TSV writer. Captions are escaped with `escape_tsv` so each row stays on one line."""
+
+    suffix = ".tsv"
+
+    def _write_rows(self, rows: list[tuple[str, str]]) -> None:
+        with open(self.path, "a", newline="") as f:
+            # Fields with quotes are quoted, so that pandas and csv read them back unchanged
+            writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+            for filename, caption in rows:
+                writer.writerow([filename, escape_tsv(caption)])
+
+    def finalize(self, order: Optional[Mapping[str, int]] = None) -> None:
+        super().finalize(order)
+        if order is None or not self.path.exists():
+            return
+        records = _ordered(read_captions_file(self.path), order)
+        tmp = self.path.with_name(f".{self.path.name}.tmp")
+        tmp.unlink(missing_ok=True)
+        TSVSink(tmp)._write_rows(
+            [(r["filename"], r["caption"]) for r in records]
+        )
+        os.replace(tmp, self.path)
+
+
+class ParquetSink(CaptionSink):
+    """
+    Parquet writer, one row group per flush. Requires pyarrow. The rows of an existing file
+    are kept, but the file is only readable once the sink is finalized.
+    """
+
+    suffix = ".parquet"
+
+    def __init__(
+        self,
+        path: str | Path,
+        flush_every: int = 256,
+        flush_interval: Optional[float] = None,
+    ):
+        if pa is None:
+            raise ImportError("pyarrow is required for ParquetSink")
+        super().__init__(path, flush_every, flush_interval)
+        self._schema = pa.schema(
+            [("filename", pa.string()), ("caption", pa.string())]
+        )
+        self._writer = None
+
+    def _write_rows(self, rows: list[tuple[str, str]]) -> None:
+        if self._writer is None:
+            # Opening the writer truncates the file, carry the rows of an earlier run
+            # over (e.g. when resuming), as the other sinks append to theirs
+            existing = None
+            if self.path.exists():
+                try:
+                    existing = pq.read_table(self.path, schema=self._schema)
+                except (pa.ArrowInvalid, OSError) as e:
+                    logger.warning(
+                        f"Could not read {self.path} ({e}), it is overwritten"
+                    )
+            self._writer = pq.ParquetWriter(self.path, self._schema)
+            if existing is not None and existing.num_rows:
+                self._writer.write_table(existing)
+        filenames, captions = zip(*rows)
+        self._writer.write_table(
+            pa.table(
+                {"filename": list(filenames), "caption": list(captions)},
+                schema=self._schema,
+            )
+        )
+
+    def finalize(self, order: Optional[Mapping[str, int]] = None) -> None:
+        # Row groups are already written, the Parquet file keeps the write order
+        super().finalize(order)
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+SINKS: dict[str, type[CaptionSink]] = {
+    "jsonl": JSONLinesSink,
+    "tsv": TSVSink,
+    "parquet": ParquetSink,
+}
+
+
+def make_sink(
+    kind: str,
+    out_file: str | Path,
+    flush_every: int = 1,
+    flush_interval: Optional[float] = None,
+) -> CaptionSink:
+    """
+    Create a sink of the given kind, writing next to `out_file` (same stem, the sink's suffix).
+    The JSON Lines sink also writes the legacy `.json` array when finalized.
+    """
+    if kind not in SINKS:
+        raise ValueError(
+            f"Unsupported sink: {kind}, expected one of {list(SINKS)}"
+        )
+    out_file = Path(out_file)
+    cls = SINKS[kind]
+    path = out_file.with_suffix(cls.suffix)
+    if cls is JSONLinesSink:
+        return JSONLinesSink(
+            path,
+            flush_every,
+            flush_interval,
+            json_file=out_file.with_suffix(".json"),
+        )
+    return cls(path, flush_every, flush_interval)
+
+
+# Column names of a header row of a delimited caption file
+_filename_columns = {"filename", "file", "image", "image_id", "frame"}
+_caption_columns = {"caption", "captions", "text", "description"}
+
+
+def _is_header(row: Sequence[str]) -> bool:
+    return (
+        row[0].strip().lower() in _filename_columns
+        and row[1].strip().lower() in _caption_columns
+    )
+
+
+def read_captions_file(path: str | Path) -> list[dict[str, str]]:
+    """
+    Read a caption file (.jsonl, .json, .tsv, .txt, .csv or .parquet) as a list of
+    `{"filename", "caption"}` records. See `captions.read_captions` for a cached,
+    filename-indexed table.
+
+    Delimited files may be quoted (as written by pandas/csv) and may start with a
+    header row naming a filename and a caption column (e.g. "filename", "caption"). Rows with a single field are treated as the continuation of the
+    previous caption (older runs wrote captions with unescaped newlines).
+    """
+    path = Path(path)
+    if path.suffix == ".jsonl":
+        return list(read_jsonl(path))
+    if path.suffix == ".json":
+        with open(path, "r") as f:
+            return [
+                {"filename": r["filename"], "caption": r["caption"]}
+                for r in json.load(f)
+            ]
+    if path.suffix == ".parquet":
+        if pq is None:
+            raise ImportError("pyarrow is required to read Parquet files")
+        return pq.read_table(path, columns=["filename", "caption"]).to_pylist()
+    if path.suffix not in (".tsv", ".txt", ".csv"):
+        raise ValueError(f"Unsupported file format: {path.suffix}")
+    delimiter = "," if path.suffix == ".csv" else "\t"
+    records: list[dict[str, str]] = []
+    with open(path, "r", newline="") as f:
+        for i, row in enumerate(csv.reader(f, delimiter=delimiter)):
+            if len(row) >= 2:
+                if i == 0 and _is_header(row):
+                    continue
+                records.append(
+                    {
+                        "filename": row[0],
+                        "caption": unescape_tsv(delimiter.join(row[1:])),
+                    }
+                )
+            elif records:
+                records[-1]["caption"] += "\n" + "".join(row)
+    return records
+
+
+def outputs_exist(out_file: str | Path, kinds: Sequence[str]) -> bool:
+    """
+    Whether a run already wrote to `out_file`: its own file, the file of any of the sinks
+    `kinds`, the legacy .json or shard files (see `shard_files`).
+    """
+    out_file = Path(out_file)
+    suffixes = {out_file.suffix, ".json"} | {SINKS[k].suffix for k in kinds}
+    return any(
+        out_file.with_suffix(suffix).exists() for suffix in suffixes
+    ) or bool(shard_files(out_file))
+
+
+def read_existing(out_file: str | Path) -> list[dict[str, str]]:
+    """
+    Read the captions already written for `out_file`, preferring the .jsonl file,
+    then the legacy .json array, then the .tsv file, then the .parquet file.
+    """
+    out_file = Path(out_file)
+    for suffix in (".jsonl", ".json", ".tsv", ".parquet"):
+        if out_file.with_suffix(suffix).exists():
+            return read_captions_file(out_file.with_suffix(suffix))
+    return []
+
+
+def shard_file(out_file: str | Path, shard: int) -> Path:
+    """Output file of one shard of a sharded run, `<stem>.shard<NNN><suffix>` next to `out_file`."""
+    out_file = Path(out_file)
+    return out_file.with_name(
+        f"{out_file.stem}.shard{shard:03d}{out_file.suffix}"
+    )
+
+
+def shard_files(out_file: str | Path) -> list[Path]:
+    """
+    Output files (with the suffix of `out_file`) of the shards of `out_file` found on disk,
+    written by any of the sinks, in shard order.
+    """
+    out_file = Path(out_file)
+    name = re.compile(rf"{re.escape(out_file.stem)}\.shard\d{{3,}}\.[^.]+")
+    return sorted(
+        {
+            path.with_suffix(out_file.suffix)
+            for path in out_file.parent.glob(
+                f"{glob.escape(out_file.stem)}.shard*"
+            )
+            if name.fullmatch(path.name)
+        }
+    )
+
+
+def remove_outputs(out_file: str | Path) -> None:
+    """Delete the files every sink (and the legacy .json) writes for `out_file`."""
+    out_file = Path(out_file)
+    for suffix in {cls.suffix for cls in SINKS.values()} | {".json"}:
+        out_file.with_suffix(suffix).unlink(missing_ok=True)
+
+
+def merge_shards(
+    out_file: str | Path,
+    kinds: Sequence[str] = ("jsonl", "tsv"),
+    order: Optional[Mapping[str, int]] = None,
+    flush_every: int = 1,
+    flush_interval: Optional[float] = None,
+) -> int:
+    """
+    Move the captions of every shard of `out_file` (see `shard_files`) into the files of
+    `out_file`, after the captions already there, and delete the shard files. Filenames
+    that are already captioned (or in an earlier shard) are skipped.
+    Args:
+        out_file (str | Path): Output file of the run.
+        kinds (Sequence[str], optional): Sinks to write, see `SINKS`. Defaults to ("jsonl", "tsv").
+        order (Mapping[str, int], optional): Position of each filename in the output, e.g. the dataset
+            order, so that the output does not depend on the number of shards. Every captioned filename must
+            have one. Defaults to None (shard by shard).
+        flush_every (int, optional): See `CaptionSink`. Defaults to 1.
+        flush_interval (float, optional): See `CaptionSink`. Defaults to None.
+    Returns:
+        int: Number of captions moved.
+    """
+    shards = shard_files(out_file)
+    if not shards:
+        return 0
+    seen = {r["filename"] for r in read_existing(out_file)}
+    records = []
+    for shard in shards:
+        for record in read_existing(shard):
+            if record["filename"] not in seen:
+                seen.add(record["filename"])
+                records.append(record)
+    if order is not None:
+        unknown = [
+            r["filename"] for r in records if r["filename"] not in order
+        ]
+        if unknown:
+            raise ValueError(
+                f"{len(unknown)} captions of the shards are not in the output order, e.g. {unknown[0]}"
+            )
+    records = _ordered(records, order)
+    for kind in kinds:
+        sink = make_sink(kind, out_file, flush_every, flush_interval)
+        if records:
+            sink.write(
+                [r["filename"] for r in records],
+                [r["caption"] for r in records],
+            )
+        sink.finalize(order)
+    for shard in shards:
+        remove_outputs(shard)
+    logger.info(
+        f"Merged {len(records)} captions from {len(shards)} shards into {out_file}"
+    )
+    return len(records)
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import logging
+from pathlib import Path
+from collections.abc import Iterator, Mapping
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ALIGNMENT = 64
+
+
+def content_key(*parts: str | bytes) -> str:
+    """Hash any number of strings/bytes into a hex key for an `ArrayStore`."""
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        h.update(len(part).to_bytes(8, "little"))
+        h.update(part)
+    return h.hexdigest()
+
+
+class ArrayStore:
+    """
+    Append-only, on-disk store of named NumPy arrays, read back through a memory map.
+
+    All arrays are appended to a single `data.bin` file and located through an
+    append-only `index.jsonl`, written after the data so that an interrupted write
+    never produces an index entry pointing at missing bytes. Only one process
+    should write to a store at a time, any number of processes can read it.
+    """
+
+    def __init__(self, directory: str | Path):
+        """
+        Args:
+            directory (str | Path): Directory holding the store, created if needed.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.data_file = self.directory / "data.bin"
+        self.index_file = self.directory / "index.jsonl"
+        self._index: dict[str, dict[str, tuple[str, list[int], int]]] = {}
+        self._mmap: np.memmap | None = None
+        if self.index_file.exists():
+            with open(self.index_file, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning(
+                            f"Skipping malformed index line in {self.index_file}"
+                        )
+                        continue
+                    self._index[entry["key"]] = entry["arrays"]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def __getstate__(self):
+        # Memory maps are reopened lazily in each process
+        state = self.__dict__.copy()
+        state["_mmap"] = None
+        return state
+
+    def put(self, key: str, arrays: Mapping[str, np.ndarray]) -> None:
+        """Store the arrays under `key`, see `put_many`."""
+        self.put_many({key: arrays})
+
+    def put_many(self, items: Mapping[str, Mapping[str, np.ndarray]]) -> None:
+        """
+        Store several entries with a single write to the data and index files.
+        Args:
+            items (Mapping[str, Mapping[str, np.ndarray]]): Arrays by name, by key.
+        """
+        if not items:
+            return
+        entries = []
+        with open(self.data_file, "ab") as f:
+            offset = f.tell()
+            for key, arrays in items.items():
+                entry: dict[str, tuple[str, list[int], int]] = {}
+                for name, array in arrays.items():
+                    array = np.ascontiguousarray(array)
+                    padding = -offset % ALIGNMENT
+                    f.write(b"\0" * padding)
+                    offset += padding
+                    entry[name] = (array.dtype.str, list(array.shape), offset)
+                    f.write(array.tobytes())
+                    offset += array.nbytes
+                entries.append((key, entry))
+        with open(self.index_file, "a") as f:
+            for key, entry in entries:
+                print(json.dumps({"key": key, "arrays": entry}), file=f)
+                self._index[key] = entry
+        self._mmap = None
+
+    def get(self, key: str) -> dict[str, np.ndarray]:
+        """
+        Read the arrays stored under `key`. The arrays are read-only views into the
+        memory-mapped data file, copy them before modifying.
+        """
+        entry = self._index[key]
+        if self._mmap is None:
+            self._mmap = np.memmap(self.data_file, dtype=np.uint8, mode="r")
+        arrays = {}
+        for name, (dtype, shape, offset) in entry.items():
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape))
+            arrays[name] = (
+                self._mmap[offset : offset + count * dtype.itemsize]
+                .view(dtype)
+                .reshape(shape)
+            )
+        return arrays
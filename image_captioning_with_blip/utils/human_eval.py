@@ -1,9 +1,11 @@
 from pathlib import Path
 from os import PathLike
 from typing import cast
-import pandas as pd
 import textwrap
 
+from ..captions import read_captions
+from ..references import ReferenceStore
+
 
 def generate_comparison(
     image_set: PathLike,
@@ -16,8 +18,8 @@ def generate_comparison(
 
     Args:
         image_set (PathLike): Path to the TSV file containing the image set.
-        ground_truth_captions (PathLike): Path to the TSV file containing the ground truth captions.
-        generated_captions (PathLike): Path to the TSV file containing the generated captions.
+        ground_truth_captions (PathLike): Path to the JSON file containing the ground truth captions (Frames.json).
+        generated_captions (PathLike): Path to the file containing the generated captions (any format `read_captions` supports).
 
     Returns:
         str: Markdown formatted string representing the comparison table.
@@ -40,26 +42,8 @@ def generate_comparison(
             )
         )
 
-    generated_captions_df = (
-        pd.read_csv(
-            generated_captions,
-            sep="\t",
-            header=None,
-            names=["caption"],
-            index_col=0,
-        )
-        if generated_captions.suffix == ".tsv"
-        else pd.read_json(generated_captions).set_index("filename")
-    )
-    generated_captions_df.sort_index(inplace=True)
-    ground_truth_captions_df = pd.read_json(ground_truth_captions)
-    ground_truth_captions_df["file"] = ground_truth_captions_df[
-        "frame_time"
-    ].apply(lambda x: f"{x}.jpg")
-    ground_truth_captions_df["caption"] = ground_truth_captions_df[
-        "captions"
-    ].apply(lambda x: x.popitem()[0])
-    ground_truth_captions_df.set_index("file", inplace=True)
+    generated_captions_df = read_captions(generated_captions).sort_index()
+    references = ReferenceStore.load(ground_truth_captions)
     with open(markdown_file, "w") as f:
         f.write("| Image | Ground Truth Caption | Generated Caption |\n")
         f.write("|-------|----------------------|-------------------|\n")
@@ -67,7 +51,7 @@ def generate_comparison(
             idx = cast(str, idx)
             image_path = Path("..") / image_set / idx
             # ! Do NOT use absolute paths, preview won't work
-            gt_caption = ground_truth_captions_df.loc[idx, "caption"]
+            gt_caption = "<br>".join(references.get(idx, []))
             gen_caption = row["caption"].replace("\n", "<br>")
             gen_caption = "<br>".join(textwrap.wrap(gen_caption, width=50))
             f.write(f"| ![]({image_path}) | {gt_caption} | {gen_caption} |\n")
@@ -85,12 +69,12 @@ def main():
     parser.add_argument(
         "ground_truth_captions",
         type=Path,
-        help="Path to the ground truth captions TSV file.",
+        help="Path to the ground truth captions JSON file.",
     )
     parser.add_argument(
         "generated_captions",
         type=Path,
-        help="Path to the generated captions TSV file.",
+        help="Path to the generated captions file (.jsonl, .json, .tsv, .csv or .parquet).",
     )
     parser.add_argument(
         "markdown_file",
@@ -0,0 +1,196 @@
+import logging
+import os
+from collections.abc import Sequence
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+
+from ..metrics import BatchEvaluator, corpus_scores, load_references
+from ..captions import read_captions
+
+logger = logging.getLogger(__name__)
+
+# When several files share a stem, the first suffix in this order is used
+CAPTION_SUFFIXES = (".jsonl", ".json", ".tsv", ".csv")
+default_metrics = ("bleu", "sacrebleu", "rouge", "meteor", "bertscore")
+
+
+def discover_outputs(
+    folder: str | Path,
+    exclude: Sequence[str] = (
+        "batch_descriptors*",
+        "*.metrics.json",
+        "*.shard[0-9][0-9][0-9]*",
+        "leaderboard*",
+    ),
+) -> list[Path]:
+    """
+    Find the caption files in a folder, one per stem.
+    Args:
+        folder (str | Path): Folder to search (not recursive).
+        exclude (Sequence[str], optional): Glob patterns of file names to ignore. Defaults to the SAM outputs,
+            the throughput summaries, the unmerged shards of sharded runs and leaderboards.
+    Returns:
+        list[Path]: The caption files, sorted by name.
+    """
+    by_stem: dict[str, Path] = {}
+    for path in sorted(Path(folder).iterdir()):
+        if path.suffix not in CAPTION_SUFFIXES or any(
+            fnmatch(path.name, pattern) for pattern in exclude
+        ):
+            continue
+        current = by_stem.get(path.stem)
+        if current is None or CAPTION_SUFFIXES.index(
+            path.suffix
+        ) < CAPTION_SUFFIXES.index(current.suffix):
+            by_stem[path.stem] = path
+    return sorted(by_stem.values())
+
+
+def build_leaderboard(
+    files: Sequence[Path],
+    ground_truth: str | Path,
+    metrics: Sequence[str] = default_metrics,
+    workers: Optional[int] = None,
+    bertscore_cache: Optional[str | Path] = ".cache/bertscore",
+    batch_size: int = 512,
+) -> pd.DataFrame:
+    """
+    Score several caption files against the same ground truth in one pass.
+
+    The ground truth is loaded once, and identical (caption, references) pairs
+    across files are only scored once, in shared batches. Every reference caption
+    of a frame is used.
+    Args:
+        files (Sequence[Path]): Caption files, see `read_captions` for the formats.
+        ground_truth (str | Path): Path to Frames.json.
+        metrics (Sequence[str], optional): Metrics to compute. Defaults to `default_metrics`.
+        workers (int, optional): Processes for the n-gram metrics. Defaults to the number of CPUs.
+        bertscore_cache (str | Path, optional): BERTScore embedding cache directory. Defaults to ".cache/bertscore".
+        batch_size (int, optional): BERTScore batch size. Defaults to 512.
+    Returns:
+        pd.DataFrame: One row per file with the number of scored samples and the corpus scores.
+    """
+    references = load_references(ground_truth)
+    pairs: dict[tuple[str, tuple[str, ...]], int] = {}
+    rows_by_file: dict[Path, list[int]] = {}
+    for file in files:
+        rows = []
+        for filename, caption in read_captions(file)["caption"].items():
+            refs = references.get(filename)
+            if not refs:
+                continue
+            key = (caption, tuple(refs))
+            rows.append(pairs.setdefault(key, len(pairs)))
+        if not rows:
+            logger.warning(f"No captions matching the ground truth in {file}")
+            continue
+        rows_by_file[file] = rows
+    logger.info(
+        f"Scoring {len(pairs)} unique captions from {len(rows_by_file)} files"
+    )
+
+    evaluator = BatchEvaluator(
+        *metrics,
+        batch_size=batch_size,
+        bertscore_cache=bertscore_cache,
+        workers=workers or os.cpu_count() or 1,
+    )
+    scores = evaluator.sample_scores(
+        [caption for caption, _ in pairs],
+        [refs for _, refs in pairs],
+    )
+    table: dict[str, dict[str, float]] = {}
+    for file, rows in rows_by_file.items():
+        _, corpus = corpus_scores(
+            {
+                name: [values[i] for i in rows]
+                for name, values in scores.items()
+            }
+        )
+        table[file.name] = {"samples": len(rows)} | corpus
+    return pd.DataFrame.from_dict(table, orient="index")
+
+
+def to_markdown(df: pd.DataFrame) -> str:
+    header = "| File | " + " | ".join(df.columns) + " |"
+    separator = "|" + "---|" * (len(df.columns) + 1)
+    rows = [
+        f"| {name} | "
+        + " | ".join(
+            f"{v:.4f}" if isinstance(v, float) else str(v) for v in row
+        )
+        + " |"
+        for name, row in zip(df.index, df.itertuples(index=False))
+    ]
+    return "\n".join([header, separator, *rows]) + "\n"
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Score every caption file in a folder and write a leaderboard."
+    )
+    parser.add_argument(
+        "outputs",
+        nargs="*",
+        type=Path,
+        default=[Path("outputs")],
+        help="Caption files, or folders to search for them. Defaults to ./outputs.",
+    )
+    parser.add_argument(
+        "--ground-truth",
+        type=Path,
+        default=Path("mastani/Frames.json"),
+        help="Path to the ground truth captions JSON file.",
+    )
+    parser.add_argument(
+        "--out",
+        type=Path,
+        default=Path("leaderboard.tsv"),
+        help="Output table (.tsv, .csv or .md). Defaults to ./leaderboard.tsv, outside the caption folder.",
+    )
+    parser.add_argument(
+        "--metrics",
+        nargs="+",
+        default=list(default_metrics),
+        help="Metrics to compute.",
+    )
+    parser.add_argument(
+        "--sort-by",
+        default="bertscore_f1",
+        help="Column to sort by (descending).",
+    )
+    parser.add_argument(
+        "--workers", type=int, help="Processes for the n-gram metrics."
+    )
+    parser.add_argument(
+        "--bertscore-cache",
+        type=Path,
+        default=Path(".cache/bertscore"),
+        help="BERTScore embedding cache directory.",
+    )
+    parser.add_argument("--batch-size", type=int, default=512)
+    args = parser.parse_args()
+
+    files: list[Path] = []
+    for path in args.outputs:
+        files.extend(discover_outputs(path) if path.is_dir() else [path])
+    df = build_leaderboard(
+        files,
+        args.ground_truth,
+        metrics=args.metrics,
+        workers=args.workers,
+        bertscore_cache=args.bertscore_cache,
+        batch_size=args.batch_size,
+    )
+    if args.sort_by in df.columns:
+        df = df.sort_values(args.sort_by, ascending=False)
+    if args.out.suffix == ".md":
+        args.out.write_text(to_markdown(df))
+    else:
+        df.to_csv(args.out, sep="," if args.out.suffix == ".csv" else "\t")
+    print(df.to_string())
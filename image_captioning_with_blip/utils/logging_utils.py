@@ -1,11 +1,78 @@
+import copy
+import hashlib
 import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
 class DuplicateFilter(logging.Filter):
-    def __init__(self, name: str = "") -> None:
+    """
+    Drops log records whose message was already logged.
+
+    Only an 8-byte hash of each message is kept, in a least recently used table of at
+    most `max_entries` messages, so memory stays bounded however long the run and
+    however large the messages. A message evicted from the table (or, with `window`,
+    last logged more than `window` seconds ago) is logged again.
+    """
+
+    def __init__(
+        self,
+        name: str = "",
+        max_entries: int = 10_000,
+        window: Optional[float] = None,
+        summary_interval: Optional[float] = 600.0,
+    ) -> None:
+        """
+        Args:
+            name (str, optional): Logger name the filter applies to, see `logging.Filter`. Defaults to "".
+            max_entries (int, optional): Number of message hashes remembered. Defaults to 10000.
+            window (float, optional): Seconds during which a repeated message is suppressed. Defaults to None (for as
+                long as it is remembered).
+            summary_interval (float, optional): Seconds after which the next logged record notes how many
+                duplicates were suppressed since the last note. Defaults to 600. None to never note them.
+        """
         super().__init__(name)
-        self._past_messages = set()
+        self.max_entries = max_entries
+        self.window = window
+        self.summary_interval = summary_interval
+        self._seen: OrderedDict[bytes, float] = OrderedDict()
+        self._suppressed = 0
+        self._last_summary = time.monotonic()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(record: logging.LogRecord) -> bytes:
+        return hashlib.blake2b(
+            str(record.msg).encode(errors="replace"), digest_size=8
+        ).digest()
 
-    def filter(self, record: logging.LogRecord) -> bool:
-        if record.msg in self._past_messages:
-            return False
-        self._past_messages.add(record.msg)
-        return True
\ No newline at end of file
+    def filter(self, record: logging.LogRecord) -> bool | logging.LogRecord:
+        key = self._key(record)
+        now = time.monotonic()
+        with self._lock:
+            last = self._seen.get(key)
+            if last is not None and (
+                self.window is None or now - last < self.window
+            ):
+                self._seen.move_to_end(key)
+                self._suppressed += 1
+                return False
+            self._seen[key] = now
+            self._seen.move_to_end(key)
+            if len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+            if (
+                self.summary_interval is None
+                or not self._suppressed
+                or now - self._last_summary < self.summary_interval
+            ):
+                return True
+            suppressed, self._suppressed = self._suppressed, 0
+            self._last_summary = now
+        # Note the count on a copy, the record is shared with the other handlers
+        record = copy.copy(record)
+        record.msg = f"{record.getMessage()} [{suppressed} duplicate messages suppressed]"
+        record.args = None
+        return record
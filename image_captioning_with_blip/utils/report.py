@@ -0,0 +1,206 @@
+import html
+import logging
+from collections.abc import Iterable, Mapping
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+
+from ..captions import caption_table
+
+logger = logging.getLogger(__name__)
+
+
+def frame_name(frame: int | str) -> str:
+    """Image file name of a frame given as a number, file name or path."""
+    name = Path(str(frame)).name
+    return name if name.endswith(".jpg") else f"{name}.jpg"
+
+
+class Renderer:
+    """Renders a report one frame at a time, see `write_report`."""
+
+    suffix: str
+
+    def header(self) -> str:
+        return ""
+
+    def frame(
+        self, image: Path, filename: str, captions: Mapping[str, str]
+    ) -> str:
+        raise NotImplementedError("Base class")
+
+    def footer(self) -> str:
+        return ""
+
+
+class MarkdownRenderer(Renderer):
+    suffix = ".md"
+
+    def frame(
+        self, image: Path, filename: str, captions: Mapping[str, str]
+    ) -> str:
+        blocks = [f"![]({image})\n"]
+        for name, caption in captions.items():
+            blocks.append(f"**{name}**: \n```\n{caption}\n```\n")
+        return "\n".join(blocks) + "\n"
+
+
+class LatexRenderer(Renderer):
+    """LaTeX for the report appendix, needs the `float`, `graphicx` and `listings` packages."""
+
+    suffix = ".tex"
+
+    def frame(
+        self, image: Path, filename: str, captions: Mapping[str, str]
+    ) -> str:
+        parts = [f"""\
+\\clearpage
+\\begin{{figure}}[H]
+    \\centering
+    \\includegraphics[width=0.3\\textwidth]{{{image}}}
+    \\caption{{{filename}}}
+    \\label{{fig:{filename}}}
+\\end{{figure}}
+
+"""]
+        for name, caption in captions.items():
+            parts.append(
+                f"\n\\begin{{lstlisting}}[caption={{{name} for {filename}}}]\n{caption}\n\\end{{lstlisting}}\n"
+            )
+        return "\n".join(parts) + "\n"
+
+
+class HTMLRenderer(Renderer):
+    suffix = ".html"
+
+    def header(self) -> str:
+        return (
+            "<!DOCTYPE html>\n<html>\n<head>\n<meta charset='utf-8'>\n"
+            "<title>Caption comparison</title>\n<style>\n"
+            "figure img { max-width: 40em; }\n"
+            "pre { white-space: pre-wrap; }\n"
+            "</style>\n</head>\n<body>\n"
+        )
+
+    def frame(
+        self, image: Path, filename: str, captions: Mapping[str, str]
+    ) -> str:
+        name = html.escape(filename)
+        rows = "".join(
+            f"<dt>{html.escape(source)}</dt><dd><pre>{html.escape(caption)}</pre></dd>\n"
+            for source, caption in captions.items()
+        )
+        return (
+            f"<section id='{name}'>\n<figure><img src='{html.escape(str(image))}' alt='{name}'>"
+            f"<figcaption>{name}</figcaption></figure>\n<dl>\n{rows}</dl>\n</section>\n"
+        )
+
+    def footer(self) -> str:
+        return "</body>\n</html>\n"
+
+
+RENDERERS: dict[str, type[Renderer]] = {
+    "md": MarkdownRenderer,
+    "tex": LatexRenderer,
+    "html": HTMLRenderer,
+}
+
+
+def write_report(
+    sources: Mapping[str, str | Path],
+    out_file: str | Path,
+    frames: Optional[Iterable[int | str]] = None,
+    image_dir: str | Path = "downloaded_images",
+    format: Optional[str] = None,
+) -> int:
+    """
+    Write the captions of several outputs side by side for a set of frames.
+
+    Every source is read once (see `captions.caption_table`) and the report is
+    written in a single pass, so its size is only limited by the output.
+    Args:
+        sources (Mapping[str, str | Path]): Caption files by display name, in display order.
+        out_file (str | Path): The report to write (overwritten).
+        frames (Iterable[int | str], optional): Frame numbers or image names. Defaults to every
+            image captioned by at least one source.
+        image_dir (str | Path, optional): Folder the report links the images from. Defaults to "downloaded_images".
+        format (str, optional): "md", "tex" or "html". Defaults to the suffix of `out_file`.
+    Returns:
+        int: Number of frames written.
+    """
+    out_file = Path(out_file)
+    format = format or out_file.suffix.lstrip(".")
+    if format not in RENDERERS:
+        raise ValueError(
+            f"Unsupported report format: {format}, expected one of {list(RENDERERS)}"
+        )
+    renderer = RENDERERS[format]()
+    table = caption_table(sources)
+    filenames = (
+        table.index if frames is None else [frame_name(f) for f in frames]
+    )
+    missing = pd.Index(filenames).difference(table.index)
+    if len(missing):
+        logger.warning(
+            f"No captions for {len(missing)} frames: {list(missing)}"
+        )
+    count = 0
+    with open(out_file, "w") as f:
+        f.write(renderer.header())
+        for filename in filenames:
+            if filename not in table.index:
+                continue
+            row = table.loc[filename]
+            captions = {
+                name: caption
+                for name, caption in row.items()
+                if isinstance(caption, str)
+            }
+            f.write(
+                renderer.frame(Path(image_dir) / filename, filename, captions)
+            )
+            count += 1
+        f.write(renderer.footer())
+    return count
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Render the captions of several outputs side by side as Markdown, LaTeX or HTML."
+    )
+    parser.add_argument(
+        "sources",
+        nargs="+",
+        help="Caption files, as NAME=PATH (or just PATH to use the file name).",
+    )
+    parser.add_argument(
+        "--frames",
+        nargs="*",
+        help="Frame numbers or image names. Defaults to every captioned frame.",
+    )
+    parser.add_argument(
+        "--out",
+        type=Path,
+        default=Path("view.md"),
+        help="Output file, the format is taken from its suffix (.md, .tex or .html).",
+    )
+    parser.add_argument(
+        "--image-dir",
+        type=Path,
+        default=Path("downloaded_images"),
+        help="Folder the report links the images from.",
+    )
+    args = parser.parse_args()
+    sources: dict[str, str] = {}
+    for source in args.sources:
+        name, sep, path = source.partition("=")
+        if not sep:
+            name, path = Path(source).stem, source
+        sources[name] = path
+    count = write_report(
+        sources, args.out, frames=args.frames, image_dir=args.image_dir
+    )
+    print(f"Wrote {count} frames to {args.out}")
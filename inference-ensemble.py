@@ -1,8 +1,10 @@
 import logging.config
 import yaml
 from pathlib import Path
-from torch.utils.data import DataLoader, BatchSampler, SequentialSampler
+from torch.utils.data import DataLoader
 import pytorch_lightning as pl
+from image_captioning_with_blip.processors import worker_init_fn
+from image_captioning_with_blip.samplers import TokenBudgetBatchSampler
 from image_captioning_with_blip.models.phi4ensemble import (
     PhiEnsembleDataset,
     PhiEnsemble,
@@ -28,16 +30,37 @@ files = [
     # "./outputs/Phi4__microsoft__Phi-4-multimodal-instruct__1.tsv",
 ]
 
-dataset = PhiEnsembleDataset(files)
-model = PhiEnsemble(in_files=[Path(f) for f in dataset.in_files])
+RESUME = False  # continue the latest output file, skipping captioned images
+model = PhiEnsemble(in_files=[Path(f) for f in files], resume=RESUME)
+# Prompts are built and tokenized once and cached, batches only slice and pad the token ids
+PRETOKENIZED = Path("./.cache/ensemble_prompts")  # None to tokenize in every batch
+dataset = PhiEnsembleDataset(
+    files, skip=model.completed, cache_dir=PRETOKENIZED
+)
+if PRETOKENIZED is not None:
+    dataset.precompute()
+# Batches of similar prompt length, filled up to MAX_TOKENS (prompt + generated tokens, padding included)
+# instead of 25 prompts padded to the longest one. Outputs are written back in dataset order.
+MAX_TOKENS = 25 * (1024 + model.max_new_tokens)
+sampler = TokenBudgetBatchSampler(
+    dataset.prompt_lengths(), MAX_TOKENS, extra_tokens=model.max_new_tokens
+)
+model.set_output_order(dataset.filenames)
 model.eval()
 model.freeze()
-trainer.predict(
-    model,
-    dataloaders=DataLoader(
-        dataset,
-        sampler=BatchSampler(SequentialSampler(dataset), 25, drop_last=False),
-        num_workers=10,
-        batch_size=None,
-    ),
+loader = DataLoader(
+    dataset,
+    sampler=sampler,
+    num_workers=10,
+    worker_init_fn=worker_init_fn,  # processors are loaded per worker, not pickled
+    batch_size=None,
 )
+# Decode a pool of MAX_ACTIVE sequences, admitting the next prompt as soon as a summary ends,
+# instead of generating each batch until its longest summary is done
+CONTINUOUS = False
+MAX_ACTIVE = 32
+if CONTINUOUS:
+    model.to("cuda")
+    model.predict_continuous(loader, max_active=MAX_ACTIVE)
+else:
+    trainer.predict(model, dataloaders=loader)
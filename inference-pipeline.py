@@ -0,0 +1,45 @@
+import logging.config
+import yaml
+from pathlib import Path
+from image_captioning_with_blip.pipeline import CaptionPipeline, Captioner
+from image_captioning_with_blip.models.blip2 import Blip2PL, ImageDataset
+from image_captioning_with_blip.models.phi4sam import (
+    Phi4Sam,
+    PhiSamImageDataset,
+)
+from image_captioning_with_blip.models.phi4ensemble import PhiEnsemble
+
+logging.config.dictConfig(yaml.safe_load(Path("logging.yaml").open()))
+logger = logging.getLogger(__name__)
+
+# Captions every image with all models and summarizes them in one pass: each image is
+# decoded once and the captions go straight to the ensemble, instead of one
+# inference.py run per model followed by inference-ensemble.py.
+FOLDER = Path("./data_subset")
+# Captions of models that are not run here, given to the ensemble after the others
+SOURCES = [
+    "./outputs/captions_GSAM.csv",
+    "./outputs/Qwen2.5__Qwen__Qwen-2.5-Omni-7B.tsv",
+]
+
+blip2 = Blip2PL()
+phi4sam = Phi4Sam()
+captioners = [
+    # Captioners on the same device take turns on each batch, devices run in parallel
+    Captioner(blip2, ImageDataset(FOLDER), device="cuda:0"),
+    Captioner(
+        phi4sam,
+        PhiSamImageDataset(
+            FOLDER, sam_outputs=Path("./outputs") / "batch_descriptors.tsv"
+        ),
+        device="cuda:1",
+    ),
+]
+ensemble = PhiEnsemble(
+    in_files=[c.model.out_file for c in captioners] + [Path(f) for f in SOURCES]
+)
+pipeline = CaptionPipeline(
+    captioners, ensemble, ensemble_device="cuda:0", sources=SOURCES
+)
+captions = pipeline.run(FOLDER, batch_size=25, num_workers=16)
+logger.info(f"Captioned {len(captions)} images")
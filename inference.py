@@ -1,10 +1,13 @@
 from collections.abc import Sequence
-from PIL import Image
 import logging.config
 import yaml
 from pathlib import Path
 from torch.utils.data import DataLoader, BatchSampler, SequentialSampler
 import pytorch_lightning as pl
+from image_captioning_with_blip.processors import worker_init_fn
+from image_captioning_with_blip.caption_cache import CaptionCache
+from image_captioning_with_blip.data import list_images
+from image_captioning_with_blip.samplers import ShardedBatchSampler
 from image_captioning_with_blip.models.phi4sam import (
     Phi4Sam,
     PhiSamImageDataset,
@@ -15,27 +18,54 @@ logger = logging.getLogger(__name__)
 
 ################# CAN BE CHANGED TO OTHER MODELS #################
 FOLDER = Path("./data_subset")
-model = Phi4Sam()
-
-images: dict[str, Image.Image] = {
-    f.name: Image.open(f) for f in FOLDER.glob("*.jpg")
-}
+RESUME = False  # continue the latest output file, skipping captioned images
+PREPROCESSED = Path("./.cache/preprocessed")  # None to run the processor in every batch
+CAPTION_CACHE = Path("./.cache/captions.sqlite")  # None to caption repeated frames again
+# (index, count) of this job to split the frames over independent jobs (e.g. one per node),
+# run sinks.merge_shards on the output file once every job is done. None for a single job.
+JOB = None
+images = list_images(FOLDER)
+if JOB is not None:
+    images = images[JOB[0] :: JOB[1]]
+model = Phi4Sam(
+    resume=RESUME,
+    caption_cache=CaptionCache(CAPTION_CACHE) if CAPTION_CACHE else None,
+    shard=JOB,
+)
+# Frames captioned in earlier runs (or near-duplicates of another frame) are not passed to the model
+skip = model.completed | model.apply_caption_cache(images)
 
+# FOLDER can also be a manifest file listing one image path per line.
+# Images are only decoded in the DataLoader workers.
 dataset = PhiSamImageDataset(
-    images, sam_outputs=Path("./outputs") / "batch_descriptors.tsv"
+    images,
+    sam_outputs=Path("./outputs") / "batch_descriptors.tsv",
+    skip=skip,
+    cache_dir=PREPROCESSED,
+    **model.descriptor_settings,  # the objects selected for the prompts, also in the caption cache key
 )
+if PREPROCESSED is not None:
+    dataset.preprocess(num_workers=32)
 
 ################# CAN BE CHANGED TO OTHER MODELS #################
 model.eval()
 model.freeze()
 
-trainer = pl.Trainer(accelerator="gpu", devices=2)
+# Each device captions every Nth batch and writes its own shard files, rank 0 merges them
+# into the output files in dataset order at the end
+model.set_output_order(dataset.filenames)
+trainer = pl.Trainer(
+    accelerator="gpu", devices=2, use_distributed_sampler=False
+)
 captions = trainer.predict(
     model,
     dataloaders=DataLoader(
         dataset,
-        sampler=BatchSampler(SequentialSampler(dataset), 25, drop_last=False),
+        sampler=ShardedBatchSampler(
+            BatchSampler(SequentialSampler(dataset), 25, drop_last=False)
+        ),
         num_workers=100,
+        worker_init_fn=worker_init_fn,  # processors are loaded per worker, not pickled
         batch_size=None,
     ),
     # !!! DO NOT USE A BATCH SIZE OF 2, the first input will get a response full of repeats up to max_new_tokens
@@ -1,5 +1,5 @@
 # %%
-import pandas as pd
+from image_captioning_with_blip.utils.report import write_report
 from argparse import ArgumentParser
 from pathlib import Path
 import re
@@ -35,15 +35,4 @@ OUTPUTS_FOLDER = {
     "Phi4": "./outputs/Phi4__microsoft__Phi-4-multimodal-instruct.json",
 }
 # %%
-frames = {
-    name: (pd.read_json(file)).set_index("filename").sort_index()
-    for name, file in OUTPUTS_FOLDER.items()
-}
-captions = {
-    name: frame.loc[img_file.name].item() for name, frame in frames.items()
-}
-# %%
-with open("./view.md", "w") as f:
-    print(f"![]({img_file})\n", file=f)
-    for name, caption in captions.items():
-        print(f"**{name}**: \n```\n{caption}\n```\n", file=f)
+write_report(OUTPUTS_FOLDER, "./view.md", frames=[img_file.name])